@@ -2,284 +2,3583 @@
 # Aplicación oficial: CronoAndes
 # Sistema de cronometraje deportivo en tiempo real – Formato Copa del Mundo
 
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, g, has_request_context
 from flask_cors import CORS
-from flask_socketio import SocketIO, join_room
+from flask_socketio import SocketIO, join_room, ConnectionRefusedError as ConexionRechazada
 import os
+import sys
+import time
 import psycopg2
-from datetime import datetime, timezone
+import psycopg2.extensions
+import psycopg2.errors
+from collections import namedtuple, OrderedDict, deque
+from contextlib import contextmanager
+import gevent
+import gevent.socket
+from gevent.event import Event, AsyncResult
+from gevent.queue import Queue
+from gevent.lock import BoundedSemaphore, RLock
+from gevent.socket import wait_read, wait_write
+from datetime import datetime, timedelta, timezone
+from bisect import bisect_left, insort
 import logging
 from statistics import median
-import re
+import json
+import uuid
+import atexit
+import signal
+import hashlib
+import hmac
+import shutil
+import tempfile
+import fcntl
+import csv
+import io
+import codecs
+import zlib
+from gzip import compress as gzip_compress, decompress as gzip_decompress
+import sqlite3
 
 # === Configuración ===
 logging.basicConfig(level=logging.INFO)
-app = Flask(__name__)
+app = Flask(__name__, static_folder=None)  # static/ se sirve precomprimido (ver Recursos estáticos)
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'cronoandes-secure-key-2025')
 CORS(app, resources={r"/*": {"origins": "*"}})
 socketio = SocketIO(app, cors_allowed_origins="*", async_mode='gevent')
 
-# === Función auxiliar: parsear timestamp ISO a datetime UTC ===
-def parse_iso_ts(ts_str):
-    """Convierte un string ISO 8601 a datetime UTC sin microsegundos."""
+# Pool de conexiones a PostgreSQL
+DB_SSLMODE = os.environ.get('DB_SSLMODE', 'require')
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', 10))            # conexiones simultáneas máximas
+DB_POOL_ESPERA = float(os.environ.get('DB_POOL_ESPERA', 5))     # segundos máximos esperando una conexión libre
+DB_POOL_VERIFICAR = float(os.environ.get('DB_POOL_VERIFICAR', 30))  # segundos inactiva antes de re-verificarla
+DB_POOL_VIDA_MAX = float(os.environ.get('DB_POOL_VIDA_MAX', 1800))  # segundos antes de reciclar una conexión
+# Crear/migrar el esquema en la primera petición; con 0 hay que ejecutar `python main.py migrate`
+DB_AUTO_MIGRAR = os.environ.get('DB_AUTO_MIGRAR', '1') == '1'
+# Lecturas (pantallas, consultas, exportaciones): pool propio, opcionalmente contra una réplica
+DATABASE_READ_URL = os.environ.get('DATABASE_READ_URL', '').strip()   # vacío = el primario (pool aparte, solo lectura)
+DB_LECTURA_POOL_MAX = int(os.environ.get('DB_LECTURA_POOL_MAX', 10))  # conexiones simultáneas de lectura
+DB_LECTURA_ESPERA = float(os.environ.get('DB_LECTURA_ESPERA', 0.5))   # s máximos esperando a que la réplica se ponga al día
+DB_LECTURA_PRIMARIO_POOL_MAX = int(os.environ.get('DB_LECTURA_PRIMARIO_POOL_MAX', 4))  # lecturas al primario si la réplica no llega
+DB_REPLICA_SONDEO = float(os.environ.get('DB_REPLICA_SONDEO', 0.1))   # s entre comparaciones de LSN primario/réplica
+
+# === Métricas en formato de texto de Prometheus (/metrics) ===
+# Contadores e histogramas en memoria del proceso: registrar una observación es un bisect y dos
+# sumas, así que pueden quedar activos en producción. Cada worker expone las suyas.
+LIMITES_S = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+metricas = []
+
+def _escapar_etiqueta(valor):
+    # Formato de exposición de Prometheus: \\, \" y \n dentro del valor
+    return str(valor).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _etiquetas(nombres, valores, extra=''):
+    pares = [f'{n}="{_escapar_etiqueta(v)}"' for n, v in zip(nombres, valores)]
+    if extra:
+        pares.append(extra)
+    return '{' + ','.join(pares) + '}' if pares else ''
+
+class Metrica:
+    tipo = 'untyped'
+
+    def __init__(self, nombre, ayuda, etiquetas=()):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.etiquetas = etiquetas
+        metricas.append(self)
+
+    def lineas(self):
+        yield f'# HELP {self.nombre} {self.ayuda}'
+        yield f'# TYPE {self.nombre} {self.tipo}'
+
+class Contador(Metrica):
+    tipo = 'counter'
+
+    def __init__(self, nombre, ayuda, etiquetas=()):
+        super().__init__(nombre, ayuda, etiquetas)
+        self._valores = {}
+
+    def sumar(self, *valores, n=1):
+        self._valores[valores] = self._valores.get(valores, 0) + n
+
+    def lineas(self):
+        yield from super().lineas()
+        for valores, total in list(self._valores.items()):
+            yield f'{self.nombre}{_etiquetas(self.etiquetas, valores)} {total}'
+
+class Histograma(Metrica):
+    tipo = 'histogram'
+
+    def __init__(self, nombre, ayuda, etiquetas=(), limites=LIMITES_S):
+        super().__init__(nombre, ayuda, etiquetas)
+        self.limites = limites
+        self._series = {}  # valores de etiquetas → [cuentas por cubeta (+Inf al final), suma]
+
+    def observar(self, segundos, *valores):
+        serie = self._series.get(valores)
+        if serie is None:
+            serie = self._series[valores] = [[0] * (len(self.limites) + 1), 0.0]
+        serie[0][bisect_left(self.limites, segundos)] += 1
+        serie[1] += segundos
+
+    def lineas(self):
+        yield from super().lineas()
+        for valores, (cuentas, suma) in list(self._series.items()):
+            acumulado = 0
+            for limite, n in zip(self.limites + ('+Inf',), cuentas):
+                acumulado += n
+                le = f'le="{limite}"'
+                yield f'{self.nombre}_bucket{_etiquetas(self.etiquetas, valores, le)} {acumulado}'
+            yield f'{self.nombre}_sum{_etiquetas(self.etiquetas, valores)} {suma:.6f}'
+            yield f'{self.nombre}_count{_etiquetas(self.etiquetas, valores)} {acumulado}'
+
+class MetricaLeida(Metrica):
+    """Valor que ya lleva otro objeto (pool, difusor, salas...): se lee al exponer. leer() → {valores: n}."""
+
+    def __init__(self, nombre, ayuda, tipo, leer, etiquetas=()):
+        super().__init__(nombre, ayuda, etiquetas)
+        self.tipo = tipo
+        self._leer = leer
+
+    def lineas(self):
+        yield from super().lineas()
+        try:
+            for valores, n in self._leer().items():
+                yield f'{self.nombre}{_etiquetas(self.etiquetas, valores)} {n}'
+        except Exception as e:
+            logging.warning(f"Métrica {self.nombre} no disponible: {e}")
+
+def exponer_metricas():
+    return '\n'.join(linea for m in metricas for linea in m.lineas()) + '\n'
+
+m_http = Histograma('crono_http_segundos', 'Latencia de las peticiones HTTP por ruta', ('ruta', 'metodo', 'estado'))
+m_db_sentencia = Histograma('crono_db_sentencia_segundos', 'Duración de cada viaje a PostgreSQL según la función que lo hace', ('funcion',))
+m_db_conexion = Histograma('crono_db_conexion_segundos', 'Tiempo de apertura de una conexión nueva a PostgreSQL')
+m_db_espera = Histograma('crono_db_pool_espera_segundos', 'Espera hasta obtener una conexión del pool', ('pool',))
+m_difusion = Histograma('crono_difusion_segundos', 'Desde que un cruce entra en la cola de una sala hasta que se emite')
+m_emision = Histograma('crono_emision_segundos', 'Duración de cada emit de Socket.IO a una sala')
+m_cruces = Contador('crono_cruces_total', 'Cruces nuevos guardados por este proceso, por evento', ('evento',))
+
+# === Timestamps: se guardan como milisegundos epoch UTC (columna BIGINT ts_ms) ===
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+_UN_MS = timedelta(milliseconds=1)
+
+def iso_a_ms(ts_str):
+    """Convierte un timestamp ISO 8601 a milisegundos epoch UTC. Sin zona se asume UTC; los µs se truncan."""
     if ts_str.endswith('Z'):
         ts_str = ts_str[:-1]
     dt = datetime.fromisoformat(ts_str)
     if dt.tzinfo is None:
         dt = dt.replace(tzinfo=timezone.utc)
-    else:
-        dt = dt.astimezone(timezone.utc)
-    return dt.replace(microsecond=0)
-
-# === Función auxiliar: truncar microsegundos a milisegundos en timestamps ISO ===
-def truncate_microseconds(ts_str):
-    """
-    Convierte un timestamp ISO con microsegundos (hasta 6 dígitos)
-    a uno con solo milisegundos (3 dígitos), terminado en 'Z'.
-    Ej: "2025-11-19T00:56:02.157868Z" → "2025-11-19T00:56:02.157Z"
-    """
-    if not ts_str:
-        return ts_str
-    # Normalizar a formato con 'Z'
-    clean_ts = ts_str.rstrip('Z').rstrip('+00:00')
-    if '.' in clean_ts:
-        base, frac = clean_ts.split('.', 1)
-        # Tomar hasta 6 dígitos y truncar a 3
-        frac = re.sub(r'[^0-9]', '', frac)
-        frac = frac[:6].ljust(6, '0')  # asegurar 6 dígitos
-        ms = frac[:3]  # milisegundos
-        return f"{base}.{ms}Z"
-    else:
-        return clean_ts + "Z"
+    return (dt - _EPOCH) // _UN_MS
+
+_prefijos_iso = {}  # segundo epoch → 'YYYY-MM-DDTHH:MM:SS.'
+
+def ms_a_iso(ms):
+    """
+    Milisegundos epoch UTC → 'YYYY-MM-DDTHH:MM:SS.mmmZ' (el formato que reciben las pantallas).
+    El prefijo de cada segundo se cachea: reconstruir /api/tiempos de un evento grande vuelve a
+    formatear los mismos segundos y cada fila queda en una concatenación.
+    """
+    segundo, resto = divmod(ms, 1000)
+    prefijo = _prefijos_iso.get(segundo)
+    if prefijo is None:
+        if len(_prefijos_iso) >= 200000:
+            _prefijos_iso.clear()
+        prefijo = _prefijos_iso[segundo] = '%04d-%02d-%02dT%02d:%02d:%02d.' % time.gmtime(segundo)[:6]
+    return '%s%03dZ' % (prefijo, resto)
 
 # === Base de datos ===
+class CursorContado(psycopg2.extensions.cursor):
+    def execute(self, query, vars=None):
+        self.connection.contar_viaje()
+        inicio = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            llamador = sys._getframe(1).f_code
+            m_db_sentencia.observar(time.perf_counter() - inicio, getattr(llamador, 'co_qualname', llamador.co_name))
+
+class ConexionContada(psycopg2.extensions.connection):
+    """
+    Conexión que cuenta sus viajes de ida y vuelta a PostgreSQL (sentencias, más el BEGIN
+    implícito y el COMMIT/ROLLBACK de las transacciones). Es un contador de proceso que
+    /health expone y bench.py usa para medir viajes a la BD por cruce.
+    """
+    viajes = 0
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cursor_factory = CursorContado
+
+    def _en_transaccion(self):
+        return self.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    def contar_viaje(self):
+        if not self.autocommit and not self._en_transaccion():
+            ConexionContada.viajes += 1  # BEGIN
+        ConexionContada.viajes += 1
+
+    def commit(self):
+        if self._en_transaccion():
+            ConexionContada.viajes += 1
+        inicio = time.perf_counter()
+        super().commit()
+        m_db_sentencia.observar(time.perf_counter() - inicio, 'commit')
+
+    def rollback(self):
+        if self._en_transaccion():
+            ConexionContada.viajes += 1
+        super().rollback()
+
+def conectar(db_url, **opciones):
+    if db_url.startswith("postgres://"):
+        db_url = db_url.replace("postgres://", "postgresql://", 1)
+    inicio = time.perf_counter()
+    conn = psycopg2.connect(db_url, sslmode=DB_SSLMODE, connection_factory=ConexionContada, **opciones)
+    m_db_conexion.observar(time.perf_counter() - inicio)
+    return conn
+
 def get_db_conn():
     db_url = os.environ.get('DATABASE_URL', '').strip()
     if not db_url:
         raise Exception("DATABASE_URL no está definida")
-    if db_url.startswith("postgres://"):
-        db_url = db_url.replace("postgres://", "postgresql://", 1)
-    return psycopg2.connect(db_url, sslmode='require')
+    return conectar(db_url)
+
+def get_db_conn_lectura(primario=False):
+    """Réplica (DATABASE_READ_URL) o, sin ella o con `primario`, el primario; siempre sesiones de solo lectura."""
+    db_url = (None if primario else DATABASE_READ_URL) or os.environ.get('DATABASE_URL', '').strip()
+    if not db_url:
+        raise Exception("DATABASE_URL no está definida")
+    return conectar(db_url, options='-c default_transaction_read_only=on')
+
+def _gevent_wait_callback(conn, timeout=None):
+    """Espera cooperativa de psycopg2: mientras PostgreSQL responde, otros greenlets siguen trabajando."""
+    while True:
+        state = conn.poll()
+        if state == psycopg2.extensions.POLL_OK:
+            break
+        elif state == psycopg2.extensions.POLL_READ:
+            wait_read(conn.fileno(), timeout=timeout)
+        elif state == psycopg2.extensions.POLL_WRITE:
+            wait_write(conn.fileno(), timeout=timeout)
+        else:
+            raise psycopg2.OperationalError(f"Estado de poll inesperado: {state}")
+
+psycopg2.extensions.set_wait_callback(_gevent_wait_callback)
+
+class PoolAgotado(Exception):
+    """No hubo conexión libre dentro del tiempo de espera del pool."""
+
+class PoolConexiones:
+    """
+    Pool acotado de conexiones reutilizables, seguro entre greenlets.
+    - Como máximo `maximo` conexiones abiertas a la vez.
+    - Quien pide una conexión espera a lo sumo `espera` segundos (luego PoolAgotado).
+    - Una conexión inactiva más de `verificar` segundos se comprueba con SELECT 1 antes de entregarla.
+    - Las conexiones con más de `vida_max` segundos, cerradas o en estado dudoso se descartan.
+    """
+
+    def __init__(self, conectar, maximo, espera, verificar, vida_max, nombre='primario'):
+        self._conectar = conectar
+        self.nombre = nombre
+        self.maximo = maximo
+        self.espera = espera
+        self.verificar = verificar
+        self.vida_max = vida_max
+        self._cupos = BoundedSemaphore(maximo)
+        self._libres = []  # pila LIFO de (conn, creada_en, ultimo_uso)
+        self.en_uso = 0
+        self.creadas = 0
+        self.descartadas = 0
+
+    def _descartar(self, conn):
+        self.descartadas += 1
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _sana(self, conn, creada_en, ultimo_uso):
+        ahora = time.monotonic()
+        if conn.closed or ahora - creada_en > self.vida_max:
+            return False
+        if ahora - ultimo_uso > self.verificar:
+            try:
+                conn.autocommit = True
+                cur = conn.cursor()
+                cur.execute("SELECT 1")
+                cur.close()
+            except psycopg2.Error:
+                return False
+        return True
+
+    def _tomar(self):
+        while self._libres:
+            conn, creada_en, ultimo_uso = self._libres.pop()
+            if self._sana(conn, creada_en, ultimo_uso):
+                return conn, creada_en
+            self._descartar(conn)
+        conn = self._conectar()
+        self.creadas += 1
+        return conn, time.monotonic()
+
+    def _devolver(self, conn, creada_en):
+        if not conn.closed:
+            try:
+                if conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+                conn.autocommit = False
+                self._libres.append((conn, creada_en, time.monotonic()))
+                return
+            except psycopg2.Error:
+                pass
+        self._descartar(conn)
+
+    @contextmanager
+    def conexion(self, autocommit=False):
+        """Presta una conexión del pool; al salir se devuelve (con rollback si quedó una transacción abierta)."""
+        inicio = time.perf_counter()
+        obtenida = self._cupos.acquire(timeout=self.espera)
+        m_db_espera.observar(time.perf_counter() - inicio, self.nombre)
+        if not obtenida:
+            raise PoolAgotado(f"sin conexiones libres tras {self.espera}s (máximo {self.maximo})")
+        try:
+            conn, creada_en = self._tomar()
+        except Exception:
+            self._cupos.release()
+            raise
+        self.en_uso += 1
+        try:
+            conn.autocommit = autocommit
+            yield conn
+        finally:
+            self.en_uso -= 1
+            self._devolver(conn, creada_en)
+            self._cupos.release()
+
+    def cerrar(self):
+        """Cierra las conexiones libres (p. ej. antes de crear procesos hijos)."""
+        while self._libres:
+            self._descartar(self._libres.pop()[0])
+
+    def estado(self):
+        return {
+            "pool": self.nombre,
+            "maximo": self.maximo,
+            "en_uso": self.en_uso,
+            "libres": len(self._libres),
+            "creadas": self.creadas,
+            "descartadas": self.descartadas,
+            "viajes": ConexionContada.viajes,
+        }
+
+pool_db = PoolConexiones(get_db_conn, DB_POOL_MAX, DB_POOL_ESPERA, DB_POOL_VERIFICAR, DB_POOL_VIDA_MAX)
+# Pool aparte: las consultas de las pantallas esperan su turno aquí y no quitan conexiones a la ingesta
+pool_lectura = PoolConexiones(get_db_conn_lectura, DB_LECTURA_POOL_MAX, DB_POOL_ESPERA, DB_POOL_VERIFICAR,
+                              DB_POOL_VIDA_MAX, nombre='lectura')
+# Lecturas que la réplica no sirve a tiempo: van al primario, pero por su propio pool acotado
+pool_lectura_primario = PoolConexiones(lambda: get_db_conn_lectura(primario=True), DB_LECTURA_PRIMARIO_POOL_MAX,
+                                       DB_POOL_ESPERA, DB_POOL_VERIFICAR, DB_POOL_VIDA_MAX,
+                                       nombre='lectura_primario') if DATABASE_READ_URL else None
+pools_db = [p for p in (pool_db, pool_lectura, pool_lectura_primario) if p is not None]
+
+def lsn_a_int(lsn):
+    alto, bajo = lsn.split('/')
+    return (int(alto, 16) << 32) + int(bajo, 16)
+
+class MonitorReplica:
+    """
+    Sabe hasta qué instante la réplica refleja todo lo confirmado en el primario.
+    Cada `sondeo` segundos anota (instante, LSN actual del primario) y mira el LSN reproducido por
+    la réplica: una muestra ya cubierta significa que todo lo confirmado antes de su instante es
+    visible en la réplica (`al_dia`). Una escritura hecha en el instante w se puede leer en la réplica
+    cuando al_dia >= w. Usa conexiones propias, fuera de los pools.
+    """
+
+    def __init__(self, sondeo):
+        self.sondeo = sondeo
+        self.al_dia = 0.0            # epoch hasta el que la réplica está al día
+        self.disponible = False
+        self.ultimo_error = None
+        self._muestras = deque(maxlen=1000)  # (instante, lsn del primario) aún no reproducidas; perder
+                                             # las más antiguas solo hace que al_dia avance a saltos
+        self._avance = Event()
+        self.iniciado = False
+
+    def iniciar(self):
+        if not self.iniciado:
+            self.iniciado = True
+            gevent.spawn(self._vigilar)
+
+    def _vigilar(self):
+        primario = replica = None
+        while True:
+            try:
+                if primario is None or primario.closed:
+                    primario = get_db_conn()
+                    primario.autocommit = True
+                if replica is None or replica.closed:
+                    replica = get_db_conn_lectura()
+                    replica.autocommit = True
+                instante = time.time()
+                cur = primario.cursor()
+                cur.execute("SELECT pg_current_wal_lsn()::text")
+                self._muestras.append((instante, lsn_a_int(cur.fetchone()[0])))
+                cur.close()
+                cur = replica.cursor()
+                cur.execute("SELECT pg_last_wal_replay_lsn()::text")
+                reproducido = cur.fetchone()[0]
+                cur.close()
+                # Sin LSN de reproducción no es un standby (p. ej. un pooler delante del primario): siempre al día
+                reproducido = lsn_a_int(reproducido) if reproducido is not None else None
+                while self._muestras and (reproducido is None or self._muestras[0][1] <= reproducido):
+                    self.al_dia = self._muestras.popleft()[0]
+                self.disponible = True
+                self.ultimo_error = None
+            except Exception as e:
+                self.disponible = False
+                self.ultimo_error = str(e)
+                self._muestras.clear()
+                for conn in (primario, replica):
+                    if conn is not None:
+                        conn.close()
+                primario = replica = None
+                logging.warning(f"Sin datos de la réplica de lectura: {e}")
+                gevent.sleep(1)
+            avance, self._avance = self._avance, Event()
+            avance.set()
+            gevent.sleep(self.sondeo)
+
+    def esperar(self, instante, espera):
+        """True si la réplica ya refleja lo confirmado hasta `instante` (esperando como mucho `espera` s)."""
+        limite = time.monotonic() + espera
+        while not (self.disponible and self.al_dia >= instante):
+            restante = limite - time.monotonic()
+            if restante <= 0:
+                return False
+            self._avance.wait(restante)
+        return True
+
+    def estado(self):
+        return {
+            "disponible": self.disponible,
+            "retraso_s": round(max(time.time() - self.al_dia, 0), 3) if self.disponible else None,
+            "muestras_pendientes": len(self._muestras),
+            "ultimo_error": self.ultimo_error,
+        }
+
+monitor_replica = MonitorReplica(DB_REPLICA_SONDEO) if DATABASE_READ_URL else None
+ultima_escritura = {}   # event_code → epoch en que este proceso supo de la última escritura del evento
+COOKIE_ESCRITURA = 'crono_escritura'
+
+def escritura_cliente():
+    """Epoch de la última escritura del cliente (cabecera X-Crono-Escritura o cookie), 0 si no hay."""
+    if not has_request_context():
+        return 0.0
+    valor = request.headers.get('X-Crono-Escritura') or request.cookies.get(COOKIE_ESCRITURA)
+    try:
+        return float(valor) / 1000 if valor else 0.0
+    except ValueError:
+        return 0.0
+
+@contextmanager
+def conexion_lectura(event_code=None, nube=False):
+    """
+    Conexión para una consulta de solo lectura. Va a la réplica si ya refleja tanto las escrituras
+    del cliente (lee lo que acaba de escribir) como la última del evento que conoce este proceso
+    (una caché rellenada tras una invalidación no queda vieja); si tras DB_LECTURA_ESPERA no es
+    así, o la réplica no responde, la consulta va al primario.
+    En una sede (SEDE_DB) las consultas van a su SQLite, salvo con `nube` (SQL propio de PostgreSQL).
+    """
+    if sede is not None and not nube:
+        with sede.conexion() as conn:
+            yield conn
+        return
+    pool = pool_lectura
+    if monitor_replica is not None:
+        requerido = max(escritura_cliente(), ultima_escritura.get(event_code, 0.0))
+        if not monitor_replica.esperar(requerido, DB_LECTURA_ESPERA):
+            pool = pool_lectura_primario
+    with pool.conexion() as conn:
+        yield conn
+
+def _ts_ms_pendiente(cur, tabla):
+    """True mientras ts_ms admita NULL: tabla de una versión anterior aún sin migrar del todo."""
+    cur.execute("""
+        SELECT is_nullable = 'YES' FROM information_schema.columns
+        WHERE table_name = %s AND column_name = 'ts_ms'
+    """, (tabla,))
+    return cur.fetchone()[0]
+
+def _exigir_ts_ms(conn, tabla):
+    """
+    ts_ms NOT NULL sin bloquear la ingesta: un CHECK NOT VALID se valida aparte (solo bloquea
+    cambios de esquema) y con él SET NOT NULL ya no necesita recorrer la tabla.
+    """
+    cur = conn.cursor()
+    cur.execute(f'ALTER TABLE {tabla} DROP CONSTRAINT IF EXISTS {tabla}_ts_ms_nn')
+    cur.execute(f'ALTER TABLE {tabla} ADD CONSTRAINT {tabla}_ts_ms_nn CHECK (ts_ms IS NOT NULL) NOT VALID')
+    conn.commit()
+    cur.execute(f'ALTER TABLE {tabla} VALIDATE CONSTRAINT {tabla}_ts_ms_nn')
+    conn.commit()
+    cur.execute(f'ALTER TABLE {tabla} ALTER COLUMN ts_ms SET NOT NULL')
+    cur.execute(f'ALTER TABLE {tabla} DROP CONSTRAINT {tabla}_ts_ms_nn')
+    conn.commit()
+    cur.close()
+
+def migrar_ts_tiempos(conn, lote=5000):
+    """
+    Migración en línea de tiempos.timestamp_iso (TEXT) a ts_ms: se rellena por lotes de `lote`
+    filas en orden de id, cada uno en su propia transacción corta, así que la ingesta sigue
+    funcionando durante la migración. Se interpreta igual que la API (sin zona → UTC); un texto
+    ilegible toma la hora de recepción (creado_en). timestamp_iso se conserva, ya sin NOT NULL.
+    """
+    cur = conn.cursor()
+    cur.execute('ALTER TABLE tiempos ALTER COLUMN timestamp_iso DROP NOT NULL')
+    conn.commit()
+    ultimo, total, ilegibles = 0, 0, 0
+    while True:
+        cur.execute('''
+            SELECT id, timestamp_iso, creado_en FROM tiempos
+            WHERE id > %s ORDER BY id LIMIT %s
+        ''', (ultimo, lote))
+        filas = cur.fetchall()
+        if not filas:
+            break
+        ultimo = filas[-1][0]
+        valores = []
+        for tiempo_id, ts, creado_en in filas:
+            if ts is None:
+                continue  # ya escrita con ts_ms
+            try:
+                valores.append((tiempo_id, iso_a_ms(ts.strip())))
+            except ValueError:
+                ilegibles += 1
+                creado = (creado_en.replace(tzinfo=timezone.utc) - _EPOCH) // _UN_MS if creado_en else 0
+                valores.append((tiempo_id, creado))
+        if valores:
+            cur.execute(b'UPDATE tiempos t SET ts_ms = v.ts_ms FROM (VALUES ' +
+                        b','.join(cur.mogrify('(%s::int, %s::bigint)', v) for v in valores) +
+                        b') AS v (id, ts_ms) WHERE t.id = v.id AND t.ts_ms IS NULL')
+            total += cur.rowcount
+        conn.commit()
+    if total:
+        logging.info(f"Migración ts_ms: {total} filas de tiempos ({ilegibles} con timestamp ilegible → creado_en)")
+    cur.close()
+    _exigir_ts_ms(conn, 'tiempos')
+
+def migrar_ts_actuales(conn):
+    """tiempos_actuales.ts_ms desde su fila del historial, un evento por transacción."""
+    cur = conn.cursor()
+    cur.execute('ALTER TABLE tiempos_actuales ALTER COLUMN timestamp_iso DROP NOT NULL')
+    conn.commit()
+    cur.execute('SELECT DISTINCT evento FROM tiempos_actuales WHERE ts_ms IS NULL')
+    for evento, in cur.fetchall():
+        cur.execute('''
+            UPDATE tiempos_actuales a SET ts_ms = t.ts_ms
+            FROM tiempos t
+            WHERE a.evento = %s AND a.ts_ms IS NULL AND t.id = a.tiempo_id
+        ''', (evento,))
+        conn.commit()
+    cur.close()
+    _exigir_ts_ms(conn, 'tiempos_actuales')
+
+# Particiones por evento (LIST): cada evento tiene su propia tabla de `tiempos` y de `inscritos`.
+# Las consultas de un evento solo leen la suya y borrar o archivar un evento desengancha y borra
+# una tabla entera en lugar de hacer DELETE fila a fila.
+TABLAS_POR_EVENTO = {  # tabla → (columna del evento, [(índice, definición, único)])
+    'tiempos': ('evento', [
+        ('idx_tiempos_evento_reemplazo', '(evento, reemplazado_por) WHERE reemplazado_por IS NOT NULL', False),
+        ('idx_tiempos_hit', '(evento, hit_id) WHERE hit_id IS NOT NULL', True),
+    ]),
+    'inscritos': ('event_code', [
+        ('idx_inscritos_evento_dorsal', '(event_code, dorsal)', True),
+    ]),
+}
+particiones_listas = set()  # (tabla, evento) cuya partición este proceso ya sabe que existe
+
+def nombre_particion(tabla, event_code):
+    """Identificador fijo y válido sea cual sea el código del evento."""
+    return f"{tabla}_e{hashlib.md5(event_code.encode('utf-8')).hexdigest()[:16]}"
+
+def crear_particion(cur, tabla, event_code, padre=None):
+    """
+    Tabla suelta + ATTACH en una sola transacción. Adjuntar solo toma SHARE UPDATE EXCLUSIVE sobre
+    la tabla padre: no espera a lecturas largas (exportaciones) ni frena la ingesta de otros eventos.
+    """
+    padre = padre or tabla
+    nombre = nombre_particion(tabla, event_code)
+    cur.execute(f"""
+        CREATE TABLE {nombre} (LIKE {padre} INCLUDING DEFAULTS);
+        ALTER TABLE {padre} ATTACH PARTITION {nombre} FOR VALUES IN (%s)
+    """, (event_code,))
+
+def asegurar_particion(tabla, event_code, cur=None):
+    """Crea la partición del evento si no existe. `cur` debe ser de una conexión en autocommit."""
+    if (tabla, event_code) in particiones_listas:
+        return
+    if cur is None:
+        with pool_db.conexion(autocommit=True) as conn:
+            return asegurar_particion(tabla, event_code, conn.cursor())
+    cur.execute("SELECT to_regclass(%s) IS NULL, (SELECT relkind = 'p' FROM pg_class WHERE oid = %s::regclass)",
+                (nombre_particion(tabla, event_code), tabla))
+    falta, particionada = cur.fetchone()
+    if falta and particionada:
+        try:
+            crear_particion(cur, tabla, event_code)
+        except (psycopg2.errors.DuplicateTable, psycopg2.errors.UniqueViolation):
+            # La creó otra conexión a la vez (ya adjuntada: iba en la misma transacción). Si las dos
+            # coinciden en el catálogo, el choque sale como UniqueViolation en pg_type
+            pass
+    particiones_listas.add((tabla, event_code))
+
+def borrar_particion(cur, tabla, event_code):
+    """
+    Desengancha y borra la partición del evento: el coste no depende de sus filas y no deja filas
+    muertas. Con PostgreSQL 14+ el DETACH es CONCURRENTLY: espera a que terminen las transacciones
+    ya abiertas (una sesión "idle in transaction" lo retiene), pero sin bloquear la tabla mientras
+    tanto. `cur` en autocommit. Devuelve las filas que tenía.
+    """
+    nombre = nombre_particion(tabla, event_code)
+    particiones_listas.discard((tabla, event_code))
+    cur.execute("SELECT to_regclass(%s) IS NOT NULL, (SELECT relkind = 'p' FROM pg_class WHERE oid = %s::regclass)",
+                (nombre, tabla))
+    existe, particionada = cur.fetchone()
+    if not particionada:
+        # Esquema aún sin migrar
+        cur.execute(f"DELETE FROM {tabla} WHERE {TABLAS_POR_EVENTO[tabla][0]} = %s", (event_code,))
+        return cur.rowcount
+    if not existe:
+        return 0
+    cur.execute(f"SELECT count(*) FROM {nombre}")
+    filas = cur.fetchone()[0]
+    if cur.connection.server_version >= 140000:
+        try:
+            cur.execute(f"ALTER TABLE {tabla} DETACH PARTITION {nombre} CONCURRENTLY")
+        except psycopg2.errors.ObjectNotInPrerequisiteState:
+            # Un DETACH CONCURRENTLY anterior se interrumpió a medias
+            cur.execute(f"ALTER TABLE {tabla} DETACH PARTITION {nombre} FINALIZE")
+    else:
+        cur.execute(f"ALTER TABLE {tabla} DETACH PARTITION {nombre}")
+    cur.execute(f"DROP TABLE {nombre}")
+    return filas
+
+def migrar_particiones(conn, tabla, en_linea=False):
+    """
+    Convierte `tabla` (todos los eventos en una sola tabla) en una tabla particionada por evento:
+    1) `<tabla>_particionada` con las mismas columnas y valores por defecto (misma secuencia de id),
+    2) con `en_linea`, se copia evento a evento, cada uno en su transacción, todo lo confirmado
+       hasta el id máximo al empezar; la ingesta sigue mientras tanto,
+    3) con la tabla vieja bloqueada se copia lo llegado después y los reemplazos marcados
+       durante la copia, se borra la vieja y se intercambian los nombres (un bloqueo breve:
+       solo lo escrito durante la copia). Sin `en_linea` todo se copia en este paso (tablas
+       pequeñas o con UPDATE arbitrarios, como inscritos).
+    La autorreferencia reemplazado_por → tiempos(id) desaparece: en una tabla particionada el id
+    solo es único junto con el evento.
+    """
+    nueva = f"{tabla}_particionada"
+    cur = conn.cursor()
+    cur.execute("SELECT relkind = 'p' FROM pg_class WHERE oid = %s::regclass", (tabla,))
+    if cur.fetchone()[0]:
+        cur.close()
+        return
+    # Varios procesos arrancan a la vez: solo uno migra, los demás esperan y ven la tabla ya particionada
+    cur.execute("SELECT pg_advisory_lock(hashtext(%s))", (nueva,))
+    try:
+        cur.execute("SELECT relkind = 'p' FROM pg_class WHERE oid = %s::regclass", (tabla,))
+        if not cur.fetchone()[0]:
+            _copiar_a_particionada(conn, cur, tabla, nueva, en_linea)
+    finally:
+        conn.rollback()
+        cur.execute("SELECT pg_advisory_unlock(hashtext(%s))", (nueva,))
+        conn.commit()
+        cur.close()
+
+def _copiar_a_particionada(conn, cur, tabla, nueva, en_linea):
+    columna, indices = TABLAS_POR_EVENTO[tabla]
+    inicio = time.perf_counter()
+    cur.execute(f"DROP TABLE IF EXISTS {nueva} CASCADE")  # intento anterior interrumpido
+    cur.execute(f"""
+        CREATE TABLE {nueva} (LIKE {tabla} INCLUDING DEFAULTS, PRIMARY KEY ({columna}, id))
+        PARTITION BY LIST ({columna})
+    """)
+    for nombre, definicion, unico in indices:
+        cur.execute(f"CREATE {'UNIQUE ' if unico else ''}INDEX {nombre}_p ON {nueva} {definicion}")
+    # Que la secuencia sobreviva al DROP de la tabla vieja (se vuelve a asignar al final)
+    cur.execute(f"ALTER SEQUENCE {tabla}_id_seq OWNED BY NONE")
+    conn.commit()
+
+    creadas = set()
+    hasta = 0
+    if en_linea:
+        # SHARE espera a las escrituras en curso: todo id <= hasta queda confirmado
+        cur.execute(f"LOCK TABLE {tabla} IN SHARE MODE")
+        cur.execute(f"SELECT COALESCE(max(id), 0) FROM {tabla}")
+        hasta = cur.fetchone()[0]
+        conn.commit()
+        cur.execute(f"SELECT DISTINCT {columna} FROM {tabla} WHERE id <= %s", (hasta,))
+        for evento, in cur.fetchall():
+            crear_particion(cur, tabla, evento, padre=nueva)
+            creadas.add(evento)
+            cur.execute(f"""
+                INSERT INTO {nombre_particion(tabla, evento)}
+                SELECT * FROM {tabla} WHERE {columna} = %s AND id <= %s
+            """, (evento, hasta))
+            conn.commit()
+
+    # ACCESS EXCLUSIVE desde el principio: pedirlo después para el DROP, con escrituras ya en
+    # cola, acaba en interbloqueo
+    cur.execute(f"LOCK TABLE {tabla} IN ACCESS EXCLUSIVE MODE")
+    cur.execute(f"SELECT DISTINCT {columna} FROM {tabla} WHERE id > %s", (hasta,))
+    for evento, in cur.fetchall():
+        if evento not in creadas:
+            crear_particion(cur, tabla, evento, padre=nueva)
+            creadas.add(evento)
+        cur.execute(f"""
+            INSERT INTO {nombre_particion(tabla, evento)}
+            SELECT * FROM {tabla} WHERE {columna} = %s AND id > %s
+        """, (evento, hasta))
+        if en_linea:
+            # Filas ya copiadas que un cruce posterior reemplazó durante la copia
+            cur.execute(f"""
+                UPDATE {nueva} n SET reemplazado_por = t.reemplazado_por
+                FROM {tabla} t
+                WHERE t.{columna} = %s AND t.reemplazado_por > %s AND t.id <= %s
+                  AND n.{columna} = t.{columna} AND n.id = t.id
+            """, (evento, hasta, hasta))
+    cur.execute(f"DROP TABLE {tabla}")
+    cur.execute(f"ALTER TABLE {nueva} RENAME TO {tabla}")
+    cur.execute(f"ALTER TABLE {tabla} RENAME CONSTRAINT {nueva}_pkey TO {tabla}_pkey")
+    for nombre, _, _ in indices:
+        cur.execute(f"ALTER INDEX {nombre}_p RENAME TO {nombre}")
+    conn.commit()
+    cur.execute(f"ALTER SEQUENCE {tabla}_id_seq OWNED BY {tabla}.id")
+    conn.commit()
+    logging.info(f"Migración: {tabla} particionada en {len(creadas)} eventos "
+                 f"({time.perf_counter() - inicio:.1f} s)")
+
+def init_db():
+    """Crea/migra el esquema. Se ejecuta una vez por proceso (ver asegurar_esquema) o con `python main.py migrate`."""
+    with pool_db.conexion() as conn:
+        cur = conn.cursor()
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS tiempos (
+                id SERIAL PRIMARY KEY,
+                evento TEXT NOT NULL,
+                dorsal TEXT NOT NULL,
+                action TEXT NOT NULL,
+                ts_ms BIGINT NOT NULL,
+                creado_en TIMESTAMP DEFAULT NOW(),
+                reemplazado_por INTEGER REFERENCES tiempos(id)
+            )
+        ''')
+        # Añadir columna 'reemplazado_por' si no existe (tablas creadas por versiones antiguas)
+        cur.execute("""
+            DO $$
+            BEGIN
+                IF NOT EXISTS (SELECT 1 FROM information_schema.columns 
+                               WHERE table_name='tiempos' AND column_name='reemplazado_por') THEN
+                    ALTER TABLE tiempos ADD COLUMN reemplazado_por INTEGER REFERENCES tiempos(id);
+                END IF;
+            END $$;
+        """)
+        # Hora del cruce en ms epoch UTC; las tablas antiguas la tenían como texto en timestamp_iso
+        cur.execute('ALTER TABLE tiempos ADD COLUMN IF NOT EXISTS ts_ms BIGINT')
+        conn.commit()
+        if _ts_ms_pendiente(cur, 'tiempos'):
+            migrar_ts_tiempos(conn)
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS inscritos (
+                id SERIAL PRIMARY KEY,
+                event_code TEXT NOT NULL,
+                dorsal TEXT NOT NULL,
+                nombre TEXT NOT NULL,
+                categoria TEXT NOT NULL,
+                club TEXT NOT NULL,
+                rfid TEXT,
+                creado_en TIMESTAMP DEFAULT NOW()
+            )
+        ''')
+        # Importación por diferencias: un inscrito por (evento, dorsal)
+        cur.execute("SELECT to_regclass('idx_inscritos_evento_dorsal') IS NULL")
+        if cur.fetchone()[0]:
+            # Cargas antiguas podían duplicar dorsales: se conserva la fila más reciente
+            cur.execute('''
+                DELETE FROM inscritos a USING inscritos b
+                WHERE a.event_code = b.event_code AND a.dorsal = b.dorsal AND a.id < b.id
+            ''')
+            cur.execute('CREATE UNIQUE INDEX idx_inscritos_evento_dorsal ON inscritos (event_code, dorsal)')
+        # Sincronización delta (?since=): bajas por reemplazado_por
+        cur.execute('CREATE INDEX IF NOT EXISTS idx_tiempos_evento_reemplazo ON tiempos (evento, reemplazado_por) WHERE reemplazado_por IS NOT NULL')
+        # Estado vigente: un registro por (evento, dorsal, action); `tiempos` queda como historial
+        cur.execute("SELECT to_regclass('tiempos_actuales') IS NULL")
+        crear_actuales = cur.fetchone()[0]
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS tiempos_actuales (
+                evento TEXT NOT NULL,
+                dorsal TEXT NOT NULL,
+                action TEXT NOT NULL,
+                tiempo_id INTEGER NOT NULL,
+                ts_ms BIGINT NOT NULL,
+                PRIMARY KEY (evento, dorsal, action)
+            )
+        ''')
+        cur.execute('CREATE INDEX IF NOT EXISTS idx_tiempos_actuales_id ON tiempos_actuales (evento, tiempo_id)')
+        # Consultas por franja horaria (?desde=/?hasta=)
+        cur.execute('ALTER TABLE tiempos_actuales ADD COLUMN IF NOT EXISTS ts_ms BIGINT')
+        cur.execute('CREATE INDEX IF NOT EXISTS idx_tiempos_actuales_ts ON tiempos_actuales (evento, ts_ms)')
+        conn.commit()
+        if _ts_ms_pendiente(cur, 'tiempos_actuales'):
+            migrar_ts_actuales(conn)
+        if crear_actuales:
+            # Migración: el registro activo más reciente de cada clave del historial existente
+            cur.execute('''
+                INSERT INTO tiempos_actuales (evento, dorsal, action, tiempo_id, ts_ms)
+                SELECT DISTINCT ON (evento, dorsal, action) evento, dorsal, action, id, ts_ms
+                FROM tiempos
+                WHERE reemplazado_por IS NULL
+                ORDER BY evento, dorsal, action, id DESC
+            ''')
+        # Las lecturas de tiempos activos ya no filtran el historial
+        cur.execute('DROP INDEX IF EXISTS idx_tiempos_activos')
+        cur.execute('DROP INDEX IF EXISTS idx_tiempos_evento_id')
+        # Identificador único de cada cruce (diario local, reintentos): reenviarlo no duplica la fila
+        cur.execute('ALTER TABLE tiempos ADD COLUMN IF NOT EXISTS hit_id TEXT')
+        cur.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_tiempos_hit ON tiempos (evento, hit_id) WHERE hit_id IS NOT NULL')
+        # Puntos de control intermedios: su código es el `action` de los cruces que se toman en ellos
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS puntos_control (
+                evento TEXT NOT NULL,
+                codigo TEXT NOT NULL,
+                orden INTEGER NOT NULL,
+                nombre TEXT NOT NULL,
+                distancia_m INTEGER,
+                PRIMARY KEY (evento, codigo)
+            )
+        ''')
+        # Eventos archivados: historial, inscritos y puntos en JSON por columnas comprimido con gzip
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS eventos_archivados (
+                evento TEXT PRIMARY KEY,
+                archivado_en TIMESTAMP NOT NULL DEFAULT NOW(),
+                tiempos INTEGER NOT NULL,
+                inscritos INTEGER NOT NULL,
+                datos BYTEA NOT NULL
+            )
+        ''')
+        conn.commit()
+        # Una partición por evento (la primera vez se copian las tablas existentes)
+        migrar_particiones(conn, 'tiempos', en_linea=True)
+        migrar_particiones(conn, 'inscritos')
+        cur.close()
+
+_esquema_listo = False
+_esquema_lock = RLock()
+
+def asegurar_esquema():
+    """Ejecuta init_db() una sola vez por proceso, aunque lleguen muchas peticiones a la vez."""
+    global _esquema_listo
+    if _esquema_listo:
+        return
+    with _esquema_lock:
+        if not _esquema_listo:
+            init_db()
+            _esquema_listo = True
+
+@app.before_request
+def preparar_proceso():
+    g.inicio = time.perf_counter()
+    asegurar_servicios()
+    # En una sede el esquema de la nube lo prepara la sincronización: sin enlace no debe frenar peticiones
+    if DB_AUTO_MIGRAR and not _esquema_listo and sede is None:
+        try:
+            asegurar_esquema()
+        except Exception as e:
+            # Se reintenta en la próxima petición; la ruta reportará su propio error de BD
+            logging.error(f"No se pudo preparar el esquema: {e}")
+
+# === WebSockets ===
+@socketio.on('connect')
+def handle_connect():
+    asegurar_servicios()
+    logging.info(f"Nuevo cliente conectado: {request.sid}")
+
+@socketio.on('disconnect')
+def handle_disconnect():
+    logging.info(f"Cliente desconectado: {request.sid}")
+
+@socketio.on('subscribe')
+def on_subscribe(data):
+    """
+    {'event_code': ...} → un 'nuevo_tiempo' por cruce, al momento (protocolo original).
+    {'event_code': ..., 'formato': 'lotes'} → cruces completos agrupados en 'nuevos_tiempos'.
+    {'event_code': ..., 'formato': 'compacto', 'inscritos_etag': ...} → 'inscritos' (dorsal, nombre
+    y categoría) una vez por suscripción, salvo que el cliente ya tenga esa versión, y después
+    'tiempos_compactos' en columnas y sin metadatos.
+    {'event_code': ..., 'formato': 'parciales'} → 'parciales': posición, tiempo y diferencia de cada
+    dorsal en cada punto de control por el que pasa (la clasificación del evento se carga ya).
+    """
+    event_code = data.get('event_code', '').strip()
+    if event_code:
+        if data.get('formato') == 'compacto':
+            join_room(sala_compacta(event_code))
+            enviar_inscritos(event_code, request.sid, data.get('inscritos_etag'))
+        elif data.get('formato') == 'parciales':
+            join_room(sala_parciales(event_code))
+            gevent.spawn(precargar_clasificacion, event_code)
+        elif data.get('formato') == 'lotes':
+            join_room(sala_lotes(event_code))
+        else:
+            join_room(event_code)
+        logging.info(f"Cliente {request.sid} suscrito a evento: {event_code}")
+
+def sala_lotes(event_code):
+    return f"{event_code}#lotes"
+
+def sala_compacta(event_code):
+    return f"{event_code}#compacto"
+
+def sala_parciales(event_code):
+    return f"{event_code}#parciales"
+
+def precargar_clasificacion(event_code):
+    """Los parciales se difunden solo para eventos en memoria: se carga al suscribirse."""
+    try:
+        motor_resultados.estado(event_code)
+    except Exception as e:
+        logging.error(f"No se pudo cargar la clasificación de {event_code}: {e}")
+
+def sala_ocupada(sala):
+    try:
+        return next(iter(socketio.server.manager.get_participants('/', sala)), None) is not None
+    except Exception:
+        return False
+
+def metadatos_inscritos(event_code):
+    return a_columnas([{"dorsal": p["dorsal"], "nombre": p["nombre"], "categoria": p["categoria"]}
+                       for p in consultar_inscritos(event_code)])
+
+def enviar_inscritos(event_code, destino, etag_cliente=None):
+    """Metadatos de los inscritos a un sid o a la sala compacta (desde la caché de 'inscritos')."""
+    try:
+        cuerpo, etag = cache_payloads.obtener('inscritos', event_code, metadatos_inscritos, 'metadatos')
+        if etag != etag_cliente:
+            socketio.emit('inscritos', {'etag': etag, 'inscritos': json.loads(cuerpo)}, to=destino)
+    except Exception as e:
+        logging.error(f"No se pudieron enviar los inscritos de {event_code}: {e}")
+
+# === Caché de respuestas por evento (con ETag) ===
+CACHE_MAX_BYTES = int(os.environ.get('CACHE_MAX_BYTES', 64 * 1024 * 1024))  # memoria máxima de la caché
+COMPRESION_MIN = 1024  # bytes; por debajo no compensa comprimir
+
+# Dependencias opcionales: sin ellas simplemente no se ofrecen esos formatos
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+TIPOS_FORMATO = {
+    'json': 'application/json',
+    'columnas': 'application/json',  # {"columna": [valores...]} sin repetir claves por fila
+    'msgpack': 'application/msgpack',
+}
+
+def a_columnas(filas):
+    """[{k: v}, ...] → {k: [v, ...]} (claves de la primera fila)."""
+    return {k: [f[k] for f in filas] for k in (filas[0] if filas else ())}
+
+def serializar(formato, datos):
+    if formato == 'msgpack':
+        return msgpack.packb(datos, use_bin_type=True)
+    return app.json.dumps(datos).encode('utf-8')
+
+def comprimir(codificacion, cuerpo):
+    if codificacion == 'br':
+        return brotli.compress(cuerpo, quality=5)
+    return gzip_compress(cuerpo, compresslevel=6, mtime=0)
+
+class CachePayloads:
+    """
+    Respuestas ya serializadas por (tipo, evento, formato, codificación), p. ej.
+    ('tiempos', 'maraton25', 'columnas', 'br').
+    - Acotada a `max_bytes`: al superarse se descartan las entradas usadas hace más tiempo (LRU).
+    - Cada escritura invalida todas las variantes del evento y sube su generación; una consulta
+      que empezó antes de la invalidación no guarda su resultado (ya estaría viejo).
+    - Si muchas pantallas piden a la vez un evento que no está en caché, solo una consulta la BD.
+      Una variante comprimida se obtiene comprimiendo (una vez) la variante sin comprimir.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.aciertos = 0
+        self.fallos = 0
+        self._entradas = OrderedDict()  # (tipo, event_code, formato, codificacion) -> (cuerpo, etag)
+        self._variantes = {}            # (tipo, event_code) -> {claves de _entradas}
+        self._generacion = {}           # (tipo, event_code) -> int
+        self._cargando = {}             # clave -> Event
+
+    def obtener(self, tipo, event_code, construir, formato='json', codificacion='identity'):
+        """
+        Devuelve (cuerpo, etag); si no está, construir(event_code) da los datos a serializar en
+        `formato` y el resultado se comprime con `codificacion` ('identity', 'gzip' o 'br').
+        """
+        clave = (tipo, event_code, formato, codificacion)
+        while True:
+            entrada = self._entradas.get(clave)
+            if entrada is not None:
+                self._entradas.move_to_end(clave)
+                self.aciertos += 1
+                return entrada
+            cargando = self._cargando.get(clave)
+            if cargando is None:
+                break
+            cargando.wait()
+
+        self.fallos += 1
+        cargando = self._cargando[clave] = Event()
+        generacion = self._generacion.get((tipo, event_code), 0)
+        try:
+            if codificacion == 'identity':
+                cuerpo = serializar(formato, construir(event_code))
+            else:
+                cuerpo = comprimir(codificacion, self.obtener(tipo, event_code, construir, formato)[0])
+            entrada = (cuerpo, hashlib.blake2b(cuerpo, digest_size=10).hexdigest())
+            if self._generacion.get((tipo, event_code), 0) == generacion and len(cuerpo) <= self.max_bytes:
+                self._guardar(clave, entrada)
+            return entrada
+        finally:
+            del self._cargando[clave]
+            cargando.set()
+
+    def _guardar(self, clave, entrada):
+        previa = self._entradas.pop(clave, None)
+        if previa is not None:
+            self.bytes -= len(previa[0])
+        self._entradas[clave] = entrada
+        self._variantes.setdefault(clave[:2], set()).add(clave)
+        self.bytes += len(entrada[0])
+        while self.bytes > self.max_bytes:
+            vieja, (cuerpo, _) = self._entradas.popitem(last=False)
+            self._variantes[vieja[:2]].discard(vieja)
+            self.bytes -= len(cuerpo)
+
+    def invalidar(self, tipo, event_code):
+        evento = (tipo, event_code)
+        self._generacion[evento] = self._generacion.get(evento, 0) + 1
+        for clave in self._variantes.pop(evento, ()):
+            entrada = self._entradas.pop(clave, None)
+            if entrada is not None:
+                self.bytes -= len(entrada[0])
+
+    def estado(self):
+        return {
+            "entradas": len(self._entradas),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "aciertos": self.aciertos,
+            "fallos": self.fallos,
+        }
+
+cache_payloads = CachePayloads(CACHE_MAX_BYTES)
+
+def negociar_formato():
+    """?formato=json|columnas|msgpack o, sin él, Accept: application/msgpack. ValueError si no se ofrece."""
+    formato = request.args.get('formato')
+    if formato is None:
+        formato = 'msgpack' if msgpack is not None and request.accept_mimetypes.best == 'application/msgpack' else 'json'
+    if formato not in TIPOS_FORMATO or (formato == 'msgpack' and msgpack is None):
+        raise ValueError(f"formato no disponible: {formato}")
+    return formato
+
+def negociar_codificacion(tamano):
+    if tamano < COMPRESION_MIN:
+        return 'identity'
+    ofrecidas = ['br', 'gzip'] if brotli is not None else ['gzip']
+    return request.accept_encodings.best_match(ofrecidas) or 'identity'
+
+def respuesta_cacheada(tipo, event_code, construir, columnas=None):
+    """
+    Responde desde la caché con ETag; si el cliente ya tiene esa versión, 304 sin cuerpo.
+    El formato ('columnas'/'msgpack' usan construir `columnas`, o la lista de `construir`
+    traspuesta) y la compresión (br/gzip) se negocian por petición; cada variante tiene su ETag.
+    """
+    try:
+        formato = negociar_formato()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 406
+    if formato == 'json':
+        construir_formato = construir
+    else:
+        construir_formato = columnas or (lambda ev: a_columnas(construir(ev)))
+    cuerpo, etag = cache_payloads.obtener(tipo, event_code, construir_formato, formato)
+    codificacion = negociar_codificacion(len(cuerpo))
+    if codificacion != 'identity':
+        cuerpo, etag = cache_payloads.obtener(tipo, event_code, construir_formato, formato, codificacion)
+    resp = app.response_class(cuerpo, mimetype=TIPOS_FORMATO[formato])
+    resp.set_etag(etag)
+    resp.headers['Cache-Control'] = 'no-cache'
+    resp.headers['Vary'] = 'Accept, Accept-Encoding'
+    if codificacion != 'identity':
+        resp.headers['Content-Encoding'] = codificacion
+    return resp.make_conditional(request)
+
+# === Ingesta de cruces (ruta común de escritura) ===
+Cruce = namedtuple('Cruce', 'event_code dorsal action ts_ms hit_id', defaults=(None,))  # ts_ms: epoch UTC
+
+CRONO_LOTE_MAX = int(os.environ.get('CRONO_LOTE_MAX', 2000))  # cruces máximos por POST a /api/crono/batch
+HIT_ID_MAX = 128  # caracteres del identificador de cruce que genera el dispositivo
+CERROJO_EVENTO = 4242  # clase de los advisory locks por evento: pg_advisory_*(CERROJO_EVENTO, hashtext(evento))
+
+def sql_cerrojo_evento(cur, eventos, sesion=False):
+    """
+    Toma el cerrojo de cada evento, en orden (sin interbloqueos entre lotes de varios eventos).
+    La escritura de cruces lo toma hasta el commit: así los id de un evento se hacen visibles en
+    el orden en que se asignaron y un cliente que ya sincronizó hasta un id no puede perderse uno
+    menor confirmado después. Con `sesion`, hasta pg_advisory_unlock (borrar o archivar un evento).
+    """
+    funcion = 'pg_advisory_lock' if sesion else 'pg_advisory_xact_lock'
+    return b''.join(cur.mogrify(f"SELECT {funcion}(%s, hashtext(%s));", (CERROJO_EVENTO, ev)) for ev in sorted(eventos))
+
+@contextmanager
+def ingesta_detenida(conn, event_code):
+    """
+    Sin escrituras de cruces del evento mientras dure el bloque (borrar, archivar). Es el mismo
+    cerrojo que la ingesta toma antes que cualquier otro bloqueo, así que no hay interbloqueos:
+    las escrituras en curso terminan antes y las nuevas esperan a que se suelte.
+    """
+    cur = conn.cursor()
+    cur.execute(sql_cerrojo_evento(cur, [event_code], sesion=True))
+    try:
+        yield cur
+    finally:
+        conn.rollback()
+        cur.execute("SELECT pg_advisory_unlock(%s, hashtext(%s))", (CERROJO_EVENTO, event_code))
+        if not conn.autocommit:
+            conn.commit()
+        cur.close()
+
+def normalizar_cruce(data, event_code_defecto='demo'):
+    """Valida un cruce recibido como dict y lo devuelve como Cruce. Lanza ValueError si no es válido."""
+    if not isinstance(data, dict):
+        raise ValueError("cada cruce debe ser un objeto JSON")
+    dorsal = str(data.get('dorsal', '')).strip()
+    action = str(data.get('action', 'llegada')).strip().lower()
+    provided_ts = data.get('timestamp')
+    if isinstance(provided_ts, int) and not isinstance(provided_ts, bool):
+        ts_ms = provided_ts  # ya en milisegundos epoch
+    elif provided_ts:
+        ts_ms = iso_a_ms(str(provided_ts).strip())  # sin zona → UTC
+    else:
+        ts_ms = time.time_ns() // 1000000
+
+    event_code = str(data.get('event_code', event_code_defecto)).strip()
+
+    if not dorsal or not event_code:
+        raise ValueError("dorsal y event_code requeridos")
+
+    # Id único del cruce generado por el dispositivo: reenviarlo (reintento) no escribe de nuevo
+    hit_id = data.get('hit_id')
+    if hit_id is not None:
+        hit_id = str(hit_id).strip()
+        if not hit_id or len(hit_id) > HIT_ID_MAX:
+            raise ValueError(f"hit_id debe tener entre 1 y {HIT_ID_MAX} caracteres")
+
+    return Cruce(event_code, dorsal, action, ts_ms, hit_id)
+
+class EscriturasEvento:
+    """
+    Escrituras de cruces de este proceso, por evento. Las que llegan mientras se escribe la anterior
+    del mismo evento esperan y se escriben juntas en una sola llamada a escribir_cruces (hasta
+    CRONO_LOTE_MAX cruces); cada llamada recibe su parte del resultado. El cerrojo del evento ya
+    serializa sus escrituras hasta el commit (ver sql_cerrojo_evento): así cada worker ocupa una
+    sola conexión por evento y cada commit lleva todo lo que esperaba, en vez de una conexión del
+    pool parada en el cerrojo por cada petición.
+    """
+
+    def __init__(self):
+        self.pendientes = {}   # (evento, nube) → deque de (cruces, AsyncResult) aún sin escribir
+        self._escritores = {}  # (evento, nube) → greenlet que las escribe
+        self.escrituras = 0
+        self.agrupadas = 0     # llamadas que viajaron junto con otras
+
+    def registrar(self, cruces, nube):
+        clave = (cruces[0].event_code, nube)
+        resultado = AsyncResult()
+        self.pendientes.setdefault(clave, deque()).append((cruces, resultado))
+        if clave not in self._escritores:
+            self._escritores[clave] = gevent.spawn(self._escribir, clave)
+        return resultado.get()
+
+    def _escribir(self, clave):
+        cola = self.pendientes[clave]
+        try:
+            while cola:
+                tanda = [cola.popleft()]
+                n = len(tanda[0][0])
+                while cola and n + len(cola[0][0]) <= CRONO_LOTE_MAX:
+                    tanda.append(cola.popleft())
+                    n += len(tanda[-1][0])
+                self._escribir_tanda(tanda, clave[1])
+        finally:
+            del self._escritores[clave]
+            del self.pendientes[clave]
+
+    def _escribir_tanda(self, tanda, nube):
+        self.escrituras += 1
+        if len(tanda) > 1:
+            self.agrupadas += len(tanda)
+        try:
+            filas = escribir_cruces([c for cruces, _ in tanda for c in cruces], nube)
+        except Exception as e:
+            for _, resultado in tanda:
+                resultado.set_exception(e)
+            return
+        inicio = 0
+        for cruces, resultado in tanda:
+            resultado.set(filas[inicio:inicio + len(cruces)])
+            inicio += len(cruces)
+
+    def estado(self):
+        return {"escrituras": self.escrituras, "agrupadas": self.agrupadas,
+                "esperando": sum(len(c) for c in self.pendientes.values())}
+
+escrituras_evento = EscriturasEvento()
+
+def registrar_cruces(cruces, nube=False):
+    """
+    Registra una lista de cruces (ver escribir_cruces). Las listas de un solo evento pasan por
+    escrituras_evento, que junta en una sentencia las de este proceso que coinciden en el tiempo.
+    Devuelve una lista [(id, nombre, categoria, nuevo)] en el orden de `cruces`.
+    En una sede (SEDE_DB) se escribe en su SQLite; `nube` fuerza PostgreSQL (la sincronización).
+    """
+    if sede is not None and not nube:
+        return sede.registrar(cruces)
+    if not cruces:
+        return []
+    if len({c.event_code for c in cruces}) == 1:
+        return escrituras_evento.registrar(cruces, nube)
+    return escribir_cruces(cruces, nube)
+
+def escribir_cruces(cruces, nube=False):
+    """
+    Escribe una lista de cruces en una sola sentencia (una transacción, un viaje a la BD):
+    - inserta todas las filas en el historial `tiempos` con INSERT multi-fila,
+    - el último cruce de cada (evento, dorsal, action) pasa a ser el vigente en `tiempos_actuales`
+      (upsert por clave primaria) y el anterior queda en el historial con reemplazado_por apuntando
+      al nuevo; los repetidos dentro del mismo lote se encadenan igual. Todo son búsquedas por
+      clave, así que el coste no crece con el tamaño del evento,
+    - resuelve nombre y categoría desde `inscritos` en la misma consulta.
+    Un cruce con hit_id ya guardado para su evento no se vuelve a escribir: devuelve la fila original.
+    El primer cruce de un evento crea su partición de `tiempos` (ver asegurar_particion).
+    Devuelve una lista [(id, nombre, categoria, nuevo)] en el orden de `cruces`. Con `nube` (la
+    sincronización de una sede) los cruces no cuentan en crono_cruces_total.
+    """
+    # Un hit_id repetido dentro del mismo lote se escribe una sola vez
+    primero = {}
+    unicos = []
+    for i, c in enumerate(cruces):
+        if c.hit_id is not None:
+            clave = (c.event_code, c.hit_id)
+            if clave in primero:
+                continue
+            primero[clave] = i
+        unicos.append(i)
+    valores = [(i, cruces[i].event_code, cruces[i].dorsal, cruces[i].action, cruces[i].ts_ms, cruces[i].hit_id)
+               for i in unicos]
+    eventos = sorted({v[1] for v in valores})
+    with pool_db.conexion(autocommit=True) as conn:
+        cur = conn.cursor()
+        for event_code in eventos:
+            asegurar_particion('tiempos', event_code, cur)
+        filas = b','.join(cur.mogrify("(%s::int, %s, %s, %s, %s::bigint, %s)", v) for v in valores)
+        # Tres pasos en un mismo envío (una transacción implícita, un viaje a la BD):
+        # 0) el cerrojo de cada evento hasta el commit (ver sql_cerrojo_evento),
+        # 1) bloquear la fila vigente de cada clave; un cruce concurrente del mismo dorsal espera aquí,
+        # 2) escribir. La 2ª toma su instantánea tras el bloqueo, así ve la fila que dejó el otro
+        #    cruce y la cadena reemplazado_por del historial no se rompe.
+        sentencia = sql_cerrojo_evento(cur, eventos) + """
+            SELECT 1 FROM tiempos_actuales a
+            JOIN (VALUES {valores}) AS e (ord, evento, dorsal, action, ts_ms, hit_id)
+              ON a.evento = e.evento AND a.dorsal = e.dorsal AND a.action = e.action
+            ORDER BY a.evento, a.dorsal, a.action
+            FOR UPDATE OF a;
+
+            WITH recibidos AS (
+                SELECT e.*, t.id AS existente
+                FROM (VALUES {valores}) AS e (ord, evento, dorsal, action, ts_ms, hit_id)
+                LEFT JOIN tiempos t ON e.hit_id IS NOT NULL AND t.evento IN {eventos}
+                                    AND t.evento = e.evento AND t.hit_id = e.hit_id
+            ), entrada AS (
+                SELECT nextval('tiempos_id_seq') AS id, r.ord, r.evento, r.dorsal, r.action, r.ts_ms, r.hit_id
+                FROM recibidos r
+                WHERE r.existente IS NULL
+                ORDER BY r.ord
+            ), marcado AS (
+                SELECT entrada.*,
+                       lead(id) OVER (PARTITION BY evento, dorsal, action ORDER BY ord) AS reemplazado_por
+                FROM entrada
+            ), insertados AS (
+                INSERT INTO tiempos (id, evento, dorsal, action, ts_ms, reemplazado_por, hit_id)
+                SELECT id, evento, dorsal, action, ts_ms, reemplazado_por, hit_id FROM marcado
+            ), ultimos AS (
+                SELECT * FROM marcado WHERE reemplazado_por IS NULL
+            ), previos AS (
+                SELECT a.evento, a.dorsal, a.action, a.tiempo_id
+                FROM tiempos_actuales a
+                JOIN ultimos u ON a.evento = u.evento AND a.dorsal = u.dorsal AND a.action = u.action
+            ), actuales AS (
+                INSERT INTO tiempos_actuales (evento, dorsal, action, tiempo_id, ts_ms)
+                SELECT evento, dorsal, action, id, ts_ms FROM ultimos
+                ON CONFLICT (evento, dorsal, action) DO UPDATE
+                SET tiempo_id = EXCLUDED.tiempo_id, ts_ms = EXCLUDED.ts_ms
+                WHERE tiempos_actuales.tiempo_id < EXCLUDED.tiempo_id
+            ), reemplazados AS (
+                UPDATE tiempos t
+                SET reemplazado_por = u.id
+                FROM previos p
+                JOIN ultimos u ON p.evento = u.evento AND p.dorsal = u.dorsal AND p.action = u.action
+                WHERE t.evento IN {eventos} AND t.evento = p.evento AND t.id = p.tiempo_id
+            )
+            SELECT r.ord, COALESCE(r.existente, m.id), i.nombre, i.categoria, r.existente IS NULL
+            FROM recibidos r
+            LEFT JOIN marcado m ON m.ord = r.ord
+            LEFT JOIN LATERAL (
+                SELECT nombre, categoria FROM inscritos
+                WHERE event_code IN {eventos} AND event_code = r.evento AND dorsal = r.dorsal
+                LIMIT 1
+            ) i ON TRUE
+            ORDER BY r.ord
+        """.encode().replace(b'{valores}', filas).replace(b'{eventos}', cur.mogrify('%s', (tuple(eventos),)))
+        # `IN {eventos}` va como literal para que el planificador descarte al planificar las
+        # particiones de los demás eventos (con `= e.evento` solo no puede).
+        # El mismo hit_id enviado a la vez (reintento con el original aún en curso) choca con el índice
+        # único si es el primer cruce de su clave: al repetir, la sentencia ya ve la fila del otro
+        try:
+            cur.execute(sentencia)
+        except psycopg2.errors.UniqueViolation:
+            cur.execute(sentencia)
+        except psycopg2.errors.CheckViolation:
+            # Sin partición para la fila: otro proceso borró o archivó el evento después de que este
+            # la diera por creada
+            for event_code in eventos:
+                particiones_listas.discard(('tiempos', event_code))
+                asegurar_particion('tiempos', event_code, cur)
+            cur.execute(sentencia)
+        rows = cur.fetchall()
+        cur.close()
+    por_ord = {r[0]: (r[1], r[2] or "", r[3] or "", r[4]) for r in rows}
+    for r in rows:
+        if r[4] and not nube:
+            m_cruces.sumar(cruces[r[0]].event_code)
+    resultado = []
+    for i, c in enumerate(cruces):
+        if i in por_ord:
+            resultado.append(por_ord[i])
+        else:
+            tiempo_id, nombre, categoria, _ = por_ord[primero[(c.event_code, c.hit_id)]]
+            resultado.append((tiempo_id, nombre, categoria, False))
+    return resultado
+
+def payload_cruce(cruce, tiempo_id, nombre, categoria):
+    return {
+        'event_code': cruce.event_code,
+        'dorsal': cruce.dorsal,
+        'action': cruce.action,
+        'timestamp': ms_a_iso(cruce.ts_ms),
+        'nombre': nombre,
+        'categoria': categoria,
+        'cursor': tiempo_id
+    }
+
+def ingerir_lote(items, event_code_defecto):
+    """
+    Valida, registra y difunde una lista de cruces: la ruta de escritura de /api/crono/batch y del
+    canal de dispositivos. Devuelve (cuerpo, estado HTTP) con un resultado por elemento.
+    """
+    resultados = [None] * len(items)
+    validos = []
+    posiciones = []
+    for i, item in enumerate(items):
+        try:
+            validos.append(normalizar_cruce(item, event_code_defecto))
+            posiciones.append(i)
+        except ValueError as e:
+            resultados[i] = {"index": i, "status": "invalido", "error": str(e)}
+
+    if diario is not None:
+        try:
+            hit_ids = diario.anotar(validos)
+        except Exception as e:
+            logging.error(f"Error al anotar un lote en el diario: {e}")
+            for i in posiciones:
+                resultados[i] = {"index": i, "status": "reintentar", "error": str(e)}
+            return {"status": "error", "error": str(e), "resultados": resultados}, 500
+        for i, hit_id in zip(posiciones, hit_ids):
+            resultados[i] = {"index": i, "status": "ok", "hit_id": hit_id}
+        todos_ok = len(validos) == len(items)
+        return {
+            "status": "accepted" if todos_ok else "partial",
+            "registrados": len(validos),
+            "resultados": resultados
+        }, 202 if todos_ok else 207
+
+    try:
+        registrados = registrar_cruces(validos)
+    except Exception as e:
+        logging.error(f"Error al registrar un lote: {e}")
+        for i in posiciones:
+            resultados[i] = {"index": i, "status": "reintentar", "error": str(e)}
+        return {"status": "error", "error": str(e), "resultados": resultados}, 503 if isinstance(e, PoolAgotado) else 500
+
+    # Un solo mensaje al bus; cada sala de evento recibe sus cruces en un lote
+    payloads = []
+    for i, cruce, (tiempo_id, nombre, categoria, nuevo) in zip(posiciones, validos, registrados):
+        resultados[i] = {"index": i, "status": "ok", "id": tiempo_id, "hit_id": cruce.hit_id, "duplicado": not nuevo}
+        if nuevo:
+            payloads.append(payload_cruce(cruce, tiempo_id, nombre, categoria))
+    if payloads:
+        bus.publicar('cruces', payloads)
+
+    todos_ok = len(validos) == len(items)
+    return {
+        "status": "success" if todos_ok else "partial",
+        "registrados": len(validos),
+        "resultados": resultados
+    }, 201 if todos_ok else 207
+
+# === Difusión a las pantallas: envíos agrupados por sala de evento ===
+DIFUSION_INTERVALO = float(os.environ.get('DIFUSION_INTERVALO', 0.2))  # s entre envíos a una sala (0 = envío inmediato)
+DIFUSION_LOTE_MAX = int(os.environ.get('DIFUSION_LOTE_MAX', 500))     # cruces máximos por mensaje
+DIFUSION_COLA_MAX = int(os.environ.get('DIFUSION_COLA_MAX', 5000))    # cruces pendientes por sala antes de pedir resincronizar
+DIFUSION_CLIENTE_MAX = int(os.environ.get('DIFUSION_CLIENTE_MAX', 50))  # paquetes en cola de un cliente para considerarlo lento
+
+def compactar_lote(lote):
+    """
+    Lote de 'nuevos_tiempos' en columnas, sin event_code/nombre/categoria (el cliente compacto ya
+    tiene los inscritos) y con la hora en ms. 'anterior' solo del primero: en un lote cada cruce
+    sigue al anterior, así que la cadena de cursores se reconstruye igual.
+    """
+    return {
+        "anterior": lote[0]['anterior'] if lote else None,
+        "cursor": [p['cursor'] for p in lote],
+        "dorsal": [p['dorsal'] for p in lote],
+        "action": [p['action'] for p in lote],
+        "ms": [iso_a_ms(p['timestamp']) for p in lote],
+    }
+
+class Difusor:
+    """
+    Agrupa los cruces de cada evento y los envía como un único 'nuevos_tiempos' (o
+    'tiempos_compactos') cada `intervalo` segundos, con a lo sumo `lote_max` cruces por mensaje.
+    Los clientes suscritos sin formato siguen recibiendo un 'nuevo_tiempo' por cruce, al momento.
+
+    Cada payload lleva 'cursor' y 'anterior' (el cursor enviado justo antes a la misma sala).
+    Así, cuando algo se descarta, el cliente ve un hueco y pide /api/tiempos?since=:
+    - si la cola de una sala pasa de `cola_max`, se vacía y se envía 'resincronizar';
+    - a un cliente cuya cola de salida en el socket pasa de `cliente_max` paquetes no se le
+      envían más lotes hasta que se ponga al día (luego detecta el hueco y se resincroniza).
+    """
+
+    def __init__(self, intervalo, lote_max, cola_max, cliente_max):
+        self.intervalo = intervalo
+        self.lote_max = lote_max
+        self.cola_max = cola_max
+        self.cliente_max = cliente_max
+        self._colas = {}            # event_code -> deque de payloads pendientes
+        self._desde = {}            # event_code -> monotonic del payload más antiguo pendiente
+        self._programado = set()    # salas con un vaciado ya programado
+        self._cursor_emitido = {}   # event_code -> último cursor encolado para la sala
+        self.envios = 0
+        self.descartados = 0
+        self.omitidos_lentos = 0
+        self.ultima_latencia = 0.0  # s entre el primer cruce encolado y su envío
+
+    def publicar(self, event_code, payloads):
+        anterior = self._cursor_emitido.get(event_code)
+        for p in payloads:
+            p['anterior'] = anterior
+            anterior = p['cursor']
+        self._cursor_emitido[event_code] = anterior
+        if sala_ocupada(event_code):
+            for p in payloads:
+                socketio.emit('nuevo_tiempo', p, room=event_code)
+
+        if self.intervalo <= 0:
+            for i in range(0, len(payloads), self.lote_max):
+                self._emitir(event_code, payloads[i:i + self.lote_max])
+            return
+
+        cola = self._colas.setdefault(event_code, deque())
+        if not cola:
+            self._desde[event_code] = time.monotonic()
+        cola.extend(payloads)
+        if len(cola) > self.cola_max:
+            self.descartados += len(cola)
+            del self._colas[event_code]
+            logging.warning(f"Cola de difusión de {event_code} desbordada; se pide resincronizar")
+            socketio.emit('resincronizar', {'cursor': anterior}, room=sala_lotes(event_code))
+            socketio.emit('resincronizar', {'cursor': anterior}, room=sala_compacta(event_code))
+            return
+        if event_code not in self._programado:
+            self._programado.add(event_code)
+            gevent.spawn_later(self.intervalo, self._vaciar, event_code)
+
+    def _vaciar(self, event_code):
+        cola = self._colas.get(event_code)
+        try:
+            if cola:
+                self.ultima_latencia = time.monotonic() - self._desde.get(event_code, time.monotonic())
+                m_difusion.observar(self.ultima_latencia)
+                lote = [cola.popleft() for _ in range(min(self.lote_max, len(cola)))]
+                self._emitir(event_code, lote)
+        except Exception as e:
+            logging.error(f"Error difundiendo a {event_code}: {e}")
+        if cola:
+            self._desde[event_code] = time.monotonic()
+            gevent.spawn_later(self.intervalo, self._vaciar, event_code)
+        else:
+            self._programado.discard(event_code)
+            self._colas.pop(event_code, None)
+            self._desde.pop(event_code, None)
+
+    def _clientes_lentos(self, sala):
+        """sids de la sala con demasiados paquetes sin enviar en su socket."""
+        lentos = []
+        try:
+            servidor = socketio.server
+            for sid, eio_sid in servidor.manager.get_participants('/', sala):
+                sock = servidor.eio.sockets.get(eio_sid)
+                if sock is not None and sock.queue.qsize() > self.cliente_max:
+                    lentos.append(sid)
+        except Exception:
+            return []
+        return lentos
+
+    def _emitir(self, event_code, lote):
+        inicio = time.perf_counter()
+        sala = sala_lotes(event_code)
+        lentos = self._clientes_lentos(sala)
+        self.omitidos_lentos += len(lentos)
+        socketio.emit('nuevos_tiempos', lote, room=sala, skip_sid=lentos or None)
+        sala = sala_compacta(event_code)
+        lentos = self._clientes_lentos(sala)
+        self.omitidos_lentos += len(lentos)
+        socketio.emit('tiempos_compactos', compactar_lote(lote), room=sala, skip_sid=lentos or None)
+        self.envios += 1
+        m_emision.observar(time.perf_counter() - inicio)
+
+    def estado(self):
+        return {
+            "intervalo": self.intervalo,
+            "colas": {ev: len(c) for ev, c in self._colas.items()},
+            "envios": self.envios,
+            "descartados": self.descartados,
+            "omitidos_lentos": self.omitidos_lentos,
+            "ultima_latencia_ms": round(self.ultima_latencia * 1000, 1),
+        }
+
+difusor = Difusor(DIFUSION_INTERVALO, DIFUSION_LOTE_MAX, DIFUSION_COLA_MAX, DIFUSION_CLIENTE_MAX)
+
+# === Motor de resultados: clasificación incremental por (evento, categoría) ===
+RESULTADOS_EVENTOS_MAX = int(os.environ.get('RESULTADOS_EVENTOS_MAX', 50))  # eventos en memoria a la vez
+SIN_CATEGORIA = 'SIN CATEGORÍA'
+def formatear_tiempo(ms):
+    """Igual que la pantalla: mm:ss.mmm (los minutos pueden pasar de 59)."""
+    return f"{ms // 60000:02d}:{ms // 1000 % 60:02d}.{ms % 1000:03d}"
+
+class ClasificacionEvento:
+    """
+    Estado en memoria de un evento. Replica la lógica de /pantalla (última salida vs. última
+    llegada activas, agrupado por categoría y ordenado por tiempo) pero se actualiza cruce a cruce:
+    cada categoría es una lista ordenada de (tiempo_ms, dorsal), así que ubicar a un corredor
+    cuesta O(log n) y solo se toca la fila del dorsal que cruzó.
+    Los puntos de control intermedios del evento se clasifican igual que la meta, con el tiempo
+    desde la salida hasta el paso por el punto: un cruce toca solo su punto (la salida, todos los
+    del dorsal).
+    """
+
+    def __init__(self):
+        self.listo = Event()
+        self.error = None
+        self.inscritos = {}    # dorsal -> (nombre, categoria)
+        self.marcas = {}       # (dorsal, action) -> (tiempo_id, ts_ms)
+        self.recorrido = ['llegada']  # puntos de control en orden de paso; la meta es el último
+        self.tablas = {'llegada': {}}  # punto -> categoria -> [(tiempo_ms, dorsal), ...] ordenada
+        self.ubicados = {}     # (punto, dorsal) -> (categoria, tiempo_ms) tal como está en su tabla
+        self.pendientes = []   # cruces recibidos mientras se carga; se aplican al terminar la carga
+
+    def definir_puntos(self, puntos):
+        """Puntos intermedios en orden de paso; las tablas se rehacen con las marcas ya aplicadas."""
+        self.recorrido = [*puntos, 'llegada']
+        self.tablas = {p: {} for p in self.recorrido}
+        self.ubicados = {}
+        for dorsal in {d for d, _ in self.marcas}:
+            for punto in self.recorrido:
+                self._reubicar(punto, dorsal)
+
+    def puntos_afectados(self, action):
+        if action == 'salida':
+            return self.recorrido
+        return (action,) if action in self.tablas else ()
+
+    def aplicar(self, tiempo_id, dorsal, action, ts_ms):
+        """Aplica un cruce; el de mayor id gana, así el orden de llegada no importa."""
+        puntos = self.puntos_afectados(action)
+        if not puntos:
+            return
+        actual = self.marcas.get((dorsal, action))
+        if actual is not None and actual[0] >= tiempo_id:
+            return
+        self.marcas[(dorsal, action)] = (tiempo_id, ts_ms)
+        for punto in puntos:
+            self._reubicar(punto, dorsal)
+
+    def _reubicar(self, punto, dorsal):
+        tabla = self.tablas[punto]
+        previo = self.ubicados.pop((punto, dorsal), None)
+        if previo is not None:
+            categoria, tiempo_ms = previo
+            lista = tabla[categoria]
+            del lista[bisect_left(lista, (tiempo_ms, dorsal))]
+            if not lista:
+                del tabla[categoria]
+
+        inscrito = self.inscritos.get(dorsal)
+        salida = self.marcas.get((dorsal, 'salida'))
+        paso = self.marcas.get((dorsal, punto))
+        if inscrito is None or salida is None or paso is None or paso[1] < salida[1]:
+            return
+        tiempo_ms = paso[1] - salida[1]
+        categoria = inscrito[1]
+        insort(tabla.setdefault(categoria, []), (tiempo_ms, dorsal))
+        self.ubicados[(punto, dorsal)] = (categoria, tiempo_ms)
+
+    def posicion(self, dorsal, punto='llegada'):
+        """Posición (1..n) del dorsal en su categoría, o None si aún no tiene tiempo."""
+        previo = self.ubicados.get((punto, dorsal))
+        if previo is None:
+            return None
+        categoria, tiempo_ms = previo
+        return bisect_left(self.tablas[punto][categoria], (tiempo_ms, dorsal)) + 1
+
+    def fila(self, pos, tiempo_ms, dorsal, lider_ms=None):
+        nombre, categoria = self.inscritos[dorsal]
+        diferencia = tiempo_ms - (tiempo_ms if lider_ms is None else lider_ms)
+        return {
+            "pos": pos,
+            "dorsal": dorsal,
+            "nombre": nombre,
+            "categoria": categoria,
+            "tiempo_ms": tiempo_ms,
+            "tiempo": formatear_tiempo(tiempo_ms),
+            "diferencia_ms": diferencia,
+            "diferencia": "+" + formatear_tiempo(diferencia) if diferencia else ""
+        }
+
+    def fila_dorsal(self, dorsal, punto='llegada'):
+        """Fila del dorsal en `punto` (con su diferencia al primero de la categoría), o None."""
+        previo = self.ubicados.get((punto, dorsal))
+        if previo is None:
+            return None
+        categoria, tiempo_ms = previo
+        lista = self.tablas[punto][categoria]
+        return self.fila(bisect_left(lista, (tiempo_ms, dorsal)) + 1, tiempo_ms, dorsal, lista[0][0])
+
+    def parciales(self, dorsal):
+        """Paso del dorsal por cada punto alcanzado: tiempo, tramo desde el punto anterior, posición y diferencia."""
+        resultado = []
+        anterior_ms = 0
+        for punto in self.recorrido:
+            f = self.fila_dorsal(dorsal, punto)
+            if f is None:
+                continue
+            resultado.append({
+                "punto": punto,
+                "pos": f["pos"],
+                "tiempo_ms": f["tiempo_ms"],
+                "tiempo": f["tiempo"],
+                "tramo_ms": f["tiempo_ms"] - anterior_ms,
+                "diferencia_ms": f["diferencia_ms"],
+            })
+            anterior_ms = f["tiempo_ms"]
+        return resultado
+
+    def tabla(self, categoria=None, top=None, punto='llegada'):
+        tablas = self.tablas[punto]
+        categorias = [categoria] if categoria is not None else sorted(tablas)
+        resultado = []
+        for cat in categorias:
+            lista = tablas.get(cat, [])
+            filas = lista[:top] if top is not None else lista
+            resultado.append({
+                "categoria": cat,
+                "total": len(lista),
+                "clasificacion": [self.fila(i + 1, t, d, lista[0][0]) for i, (t, d) in enumerate(filas)]
+            })
+        return resultado
+
+class MotorResultados:
+    """
+    Clasificaciones de los eventos activos. Un evento se carga desde la BD la primera vez que
+    se consulta y, desde entonces, /api/crono lo mantiene al día con cada cruce registrado.
+    Los eventos menos usados se descartan cuando hay más de `max_eventos` en memoria.
+    """
+
+    def __init__(self, max_eventos):
+        self.max_eventos = max_eventos
+        self._eventos = OrderedDict()
+
+    def estado(self, event_code):
+        est = self._eventos.get(event_code)
+        if est is None:
+            est = ClasificacionEvento()
+            self._eventos[event_code] = est
+            while len(self._eventos) > self.max_eventos:
+                self._eventos.popitem(last=False)
+            try:
+                self._cargar(event_code, est)
+                for cruce in est.pendientes:
+                    est.aplicar(*cruce)
+                est.pendientes = []
+            except Exception as e:
+                est.error = e
+                if self._eventos.get(event_code) is est:
+                    del self._eventos[event_code]
+            est.listo.set()
+        else:
+            self._eventos.move_to_end(event_code)
+            est.listo.wait()
+        if est.error is not None:
+            raise est.error
+        return est
+
+    def _cargar(self, event_code, est):
+        with conexion_lectura(event_code) as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT dorsal, nombre, categoria FROM inscritos WHERE event_code = %s ORDER BY id", (event_code,))
+            for dorsal, nombre, categoria in cur.fetchall():
+                est.inscritos.setdefault(dorsal, (nombre, categoria or SIN_CATEGORIA))
+            cur.execute("SELECT codigo FROM puntos_control WHERE evento = %s ORDER BY orden", (event_code,))
+            est.definir_puntos([r[0] for r in cur.fetchall()])
+            acciones = ['salida', *est.recorrido]
+            cur.execute(f"""
+                SELECT tiempo_id, dorsal, action, ts_ms FROM tiempos_actuales
+                WHERE evento = %s AND action IN ({', '.join(['%s'] * len(acciones))})
+            """, (event_code, *acciones))
+            rows = cur.fetchall()
+            cur.close()
+        for tiempo_id, dorsal, action, ts_ms in rows:
+            est.aplicar(tiempo_id, dorsal, action, ts_ms)
+
+    def registrar(self, event_code, tiempo_id, dorsal, action, timestamp):
+        """Aplica un cruce ya guardado; si el evento no está en memoria no hace nada (se cargará al consultarlo)."""
+        est = self._eventos.get(event_code)
+        if est is None:
+            return
+        if not est.listo.is_set():
+            # Aún cargándose: la consulta de la carga puede no incluirlo; se aplica al terminar
+            est.pendientes.append((tiempo_id, dorsal, action, iso_a_ms(timestamp)))
+        else:
+            est.aplicar(tiempo_id, dorsal, action, iso_a_ms(timestamp))
+
+    def invalidar(self, event_code):
+        self._eventos.pop(event_code, None)
+
+motor_resultados = MotorResultados(RESULTADOS_EVENTOS_MAX)
+
+# === Bus entre procesos: varios workers o nodos detrás del mismo servicio ===
+# ''/'local' → un solo proceso | 'unix:///ruta/dir' → workers de una misma máquina | 'postgres' → varios nodos (LISTEN/NOTIFY)
+BUS_URL = os.environ.get('BUS_URL', '').strip()
+WORKERS = int(os.environ.get('WORKERS', 1))  # procesos que comparten el puerto en `python main.py`
+
+class BusLocal:
+    """
+    Reparte los hechos del sistema ('cruces' guardados, 'invalidar' cachés) a los suscriptores.
+    El proceso que publica los aplica al momento; las subclases además los envían, en orden y
+    desde un greenlet propio, a los demás procesos, que los aplican al recibirlos. Así cada
+    worker mantiene su caché, su clasificación y sus salas Socket.IO como si hubiera recibido
+    el cruce él mismo.
+    """
+    limite = 60000  # bytes por mensaje; las listas más grandes se trocean
+
+    def __init__(self):
+        self.origen = uuid.uuid4().hex[:12]
+        self.iniciado = False
+        self.enviados = 0
+        self.recibidos = 0
+        self._suscriptores = {}
+        self._salida = None
+
+    def suscribir(self, tipo, funcion):
+        self._suscriptores.setdefault(tipo, []).append(funcion)
+
+    def iniciar(self):
+        self.iniciado = True
+
+    def publicar(self, tipo, datos):
+        mensajes = self._trocear(tipo, datos) if self._salida is not None else []
+        self._entregar(tipo, datos)
+        for mensaje in mensajes:
+            self._salida.put(mensaje)
+
+    def _entregar(self, tipo, datos):
+        for funcion in self._suscriptores.get(tipo, []):
+            try:
+                funcion(datos)
+            except Exception as e:
+                logging.error(f"Error aplicando mensaje '{tipo}' del bus: {e}")
+
+    def _trocear(self, tipo, datos):
+        mensaje = json.dumps({"o": self.origen, "t": tipo, "d": datos}, ensure_ascii=False, separators=(',', ':'))
+        if len(mensaje.encode('utf-8')) <= self.limite or not isinstance(datos, list) or len(datos) < 2:
+            return [mensaje]
+        mitad = len(datos) // 2
+        return self._trocear(tipo, datos[:mitad]) + self._trocear(tipo, datos[mitad:])
+
+    def _recibir(self, envio):
+        for mensaje in envio.split('\n'):
+            m = json.loads(mensaje)
+            if m["o"] == self.origen:
+                continue
+            self.recibidos += 1
+            self._entregar(m["t"], m["d"])
+
+    def _enviar_pendientes(self):
+        # Los mensajes que se acumulan mientras se envía el anterior viajan juntos, uno por línea
+        # (json.dumps no deja saltos de línea dentro), hasta `limite` bytes: con carga, un envío a
+        # cada proceso lleva muchos cruces en lugar de uno por petición
+        while True:
+            mensajes = [self._salida.get()]
+            tamano = len(mensajes[0].encode('utf-8'))
+            while not self._salida.empty():
+                siguiente = len(self._salida.peek_nowait().encode('utf-8')) + 1
+                if tamano + siguiente > self.limite:
+                    break
+                mensajes.append(self._salida.get_nowait())
+                tamano += siguiente
+            try:
+                self._enviar('\n'.join(mensajes))
+                self.enviados += len(mensajes)
+            except Exception as e:
+                logging.error(f"Error enviando mensaje del bus: {e}")
+
+    def estado(self):
+        return {
+            "tipo": type(self).__name__,
+            "origen": self.origen,
+            "enviados": self.enviados,
+            "recibidos": self.recibidos,
+            "pendientes": self._salida.qsize() if self._salida is not None else 0,
+        }
+
+class BusUnix(BusLocal):
+    """
+    Workers de una misma máquina: cada proceso escucha en un socket Unix de datagramas dentro
+    de `directorio` y publica enviando el mensaje a todos los demás sockets del directorio.
+    No necesita ningún servicio externo (sirve también para pruebas locales).
+    """
+
+    def __init__(self, directorio):
+        super().__init__()
+        self.directorio = directorio
+        self.ruta = None
+        self._sock = None
+
+    def iniciar(self):
+        # Se llama ya dentro de cada worker: identidad y socket propios de este proceso
+        self.origen = uuid.uuid4().hex[:12]
+        self.ruta = os.path.join(self.directorio, f"{os.getpid()}-{self.origen}.sock")
+        os.makedirs(self.directorio, exist_ok=True)
+        self._sock = gevent.socket.socket(gevent.socket.AF_UNIX, gevent.socket.SOCK_DGRAM)
+        self._sock.setsockopt(gevent.socket.SOL_SOCKET, gevent.socket.SO_SNDBUF, 4 * 1024 * 1024)
+        self._sock.bind(self.ruta)
+        self._sock.settimeout(None)
+        atexit.register(self.cerrar)
+        self._salida = Queue()
+        gevent.spawn(self._escuchar)
+        gevent.spawn(self._enviar_pendientes)
+        self.iniciado = True
+
+    def _escuchar(self):
+        while True:
+            try:
+                self._recibir(self._sock.recv(self.limite + 4096).decode('utf-8'))
+            except Exception as e:
+                logging.error(f"Error recibiendo del bus unix: {e}")
+
+    def _enviar(self, mensaje):
+        datos = mensaje.encode('utf-8')
+        for nombre in os.listdir(self.directorio):
+            ruta = os.path.join(self.directorio, nombre)
+            if not nombre.endswith('.sock') or ruta == self.ruta:
+                continue
+            try:
+                with gevent.Timeout(1):
+                    self._sock.sendto(datos, ruta)
+            except (FileNotFoundError, ConnectionRefusedError):
+                # Socket de un worker que ya no existe
+                try:
+                    os.unlink(ruta)
+                except OSError:
+                    pass
+            except gevent.Timeout:
+                logging.warning(f"Worker del bus sin leer sus mensajes: {nombre}")
+
+    def cerrar(self):
+        try:
+            os.unlink(self.ruta)
+        except OSError:
+            pass
+
+class BusPostgres(BusLocal):
+    """
+    Varios nodos: los mensajes viajan por LISTEN/NOTIFY de la misma base de datos, así que
+    no hace falta ningún servicio adicional. NOTIFY admite < 8000 bytes por mensaje.
+    """
+    limite = 7800
+    canal = 'cronoandes_bus'
+
+    def iniciar(self):
+        self.origen = uuid.uuid4().hex[:12]
+        self._salida = Queue()
+        gevent.spawn(self._escuchar)
+        gevent.spawn(self._enviar_pendientes)
+        self.iniciado = True
+
+    def _enviar(self, mensaje):
+        with pool_db.conexion(autocommit=True) as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT pg_notify(%s, %s)", (self.canal, mensaje))
+            cur.close()
+
+    def _escuchar(self):
+        while True:
+            conn = None
+            try:
+                conn = get_db_conn()
+                conn.autocommit = True
+                cur = conn.cursor()
+                cur.execute(f"LISTEN {self.canal}")
+                while True:
+                    wait_read(conn.fileno())
+                    conn.poll()
+                    while conn.notifies:
+                        self._recibir(conn.notifies.pop(0).payload)
+            except Exception as e:
+                logging.error(f"Bus postgres desconectado, reintentando: {e}")
+                if conn is not None:
+                    conn.close()
+                gevent.sleep(1)
+
+def crear_bus(url):
+    if url.startswith('unix://'):
+        return BusUnix(url[len('unix://'):])
+    if url == 'postgres':
+        return BusPostgres()
+    if url not in ('', 'local'):
+        raise ValueError(f"BUS_URL no soportada: {url}")
+    return BusLocal()
+
+def aplicar_cruces(payloads):
+    """Efectos de cruces ya guardados (aquí o en otro worker): caché, clasificación y pantallas de este proceso."""
+    por_evento = {}
+    for p in payloads:
+        por_evento.setdefault(p['event_code'], []).append(p)
+    for event_code, lista in por_evento.items():
+        ultima_escritura[event_code] = time.time()
+        cache_payloads.invalidar('tiempos', event_code)
+        try:
+            for p in lista:
+                motor_resultados.registrar(event_code, p['cursor'], p['dorsal'], p['action'], p['timestamp'])
+        except Exception as e:
+            # Un fallo de la clasificación no debe quitar el cruce a las pantallas: se descarta
+            # el evento y se vuelve a cargar desde la BD en la próxima consulta
+            logging.error(f"Error actualizando la clasificación de {event_code}: {e}")
+            motor_resultados.invalidar(event_code)
+        difusor.publicar(event_code, lista)
+        if sala_ocupada(sala_parciales(event_code)):
+            enviar_parciales(event_code, lista)
+
+def enviar_parciales(event_code, payloads):
+    """
+    Fila actual de cada (dorsal, punto) que tocan estos cruces, leída de la clasificación ya al
+    día (sin recorrer los cruces del dorsal). `lider_ms` es el tiempo del primero de su categoría en
+    ese punto, para recalcular diferencias; una fila sin 'pos' indica que el dorsal salió del punto.
+    """
+    try:
+        est = motor_resultados.estado(event_code)
+    except Exception as e:
+        logging.error(f"No se pudieron calcular los parciales de {event_code}: {e}")
+        return
+    filas = {}
+    for p in payloads:
+        for punto in est.puntos_afectados(p['action']):
+            f = est.fila_dorsal(p['dorsal'], punto)
+            if f is not None:
+                f["lider_ms"] = f["tiempo_ms"] - f["diferencia_ms"]
+            filas[(p['dorsal'], punto)] = {"punto": punto, **(f or {"dorsal": p['dorsal']})}
+    if filas:
+        socketio.emit('parciales', list(filas.values()), room=sala_parciales(event_code))
+
+def aplicar_invalidacion(datos):
+    """{'event_code': ..., 'tipos': ['tiempos', 'inscritos']} tras borrar o reemplazar datos de un evento."""
+    ultima_escritura[datos['event_code']] = time.time()
+    for tipo in datos['tipos']:
+        cache_payloads.invalidar(tipo, datos['event_code'])
+    motor_resultados.invalidar(datos['event_code'])
+    if 'inscritos' in datos['tipos']:
+        indice_tags.invalidar(datos['event_code'])
+        # Las pantallas compactas de este proceso reciben los metadatos nuevos
+        sala = sala_compacta(datos['event_code'])
+        if sala_ocupada(sala):
+            gevent.spawn(enviar_inscritos, datos['event_code'], sala)
+
+def configurar_bus(url):
+    global bus
+    bus = crear_bus(url)
+    bus.suscribir('cruces', aplicar_cruces)
+    bus.suscribir('invalidar', aplicar_invalidacion)
+
+configurar_bus(BUS_URL)
+
+# === Diario local de ingesta: confirmar al dispositivo sin esperar a PostgreSQL ===
+DIARIO_DIR = os.environ.get('DIARIO_DIR', '').strip()          # si se define, /api/crono confirma tras escribir aquí
+DIARIO_LOTE = int(os.environ.get('DIARIO_LOTE', 500))          # cruces máximos por transacción al vaciar el diario
+DIARIO_ESPERA = float(os.environ.get('DIARIO_ESPERA', 0.05))   # s que se espera para agrupar cruces antes de escribir
+DIARIO_SLOTS = 64                                              # archivos de diario posibles (uno por worker vivo)
+
+class DiarioIngesta:
+    """
+    Diario append-only en disco (una línea JSON por cruce) con fsync antes de confirmar.
+    - Escritura: las líneas de todas las peticiones concurrentes se sincronizan con un único
+      fsync (el primero que llega lo hace por todos; el resto espera a esa ronda).
+    - Vaciado: un greenlet lee desde la posición ya aplicada y escribe hasta DIARIO_LOTE cruces
+      por transacción con registrar_cruces(). Cada cruce lleva un hit_id único, así que repetir
+      un tramo (caída entre el INSERT y guardar la posición) no duplica filas.
+    - Al arrancar se reaplica todo lo pendiente. Cada worker toma su propio archivo con flock.
+    """
+
+    def __init__(self, directorio, lote_max, espera):
+        self.directorio = directorio
+        self.lote_max = lote_max
+        self.espera = espera
+        self.iniciado = False
+        self.ruta = None
+        self._fd = None
+        self._lock = RLock()
+        self._escrito = 0          # bytes escritos en el archivo
+        self._sincronizado = 0     # bytes con fsync hecho
+        self._ronda_fsync = None   # Event de la ronda de fsync en curso
+        self._aplicado = 0         # bytes ya escritos en PostgreSQL
+        self._hay_datos = Event()
+        self.pendientes = 0
+        self.aplicados = 0
+        self.duplicados = 0
+        self.ultimo_error = None
+        self._mas_antiguo = None   # epoch del cruce pendiente más antiguo
+
+    def iniciar(self):
+        os.makedirs(self.directorio, exist_ok=True)
+        for slot in range(DIARIO_SLOTS):
+            ruta = os.path.join(self.directorio, f"diario-{slot}.log")
+            fd = os.open(ruta, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                os.close(fd)
+                continue
+            self.ruta, self._fd = ruta, fd
+            break
+        else:
+            raise RuntimeError(f"Todos los diarios de {self.directorio} están en uso")
+
+        tamano = os.fstat(self._fd).st_size
+        self._aplicado = min(self._leer_posicion(), tamano)
+        # Una línea a medio escribir (caída durante write) nunca se confirmó: se descarta
+        if tamano:
+            with open(self.ruta, 'rb') as f:
+                f.seek(max(0, tamano - 65536))
+                cola = f.read()
+            if not cola.endswith(b'\n'):
+                corte = tamano - len(cola) + cola.rfind(b'\n') + 1 if b'\n' in cola else 0
+                os.ftruncate(self._fd, max(corte, self._aplicado))
+                tamano = os.fstat(self._fd).st_size
+        self._escrito = self._sincronizado = tamano
+        self.pendientes = self._contar_pendientes()
+        if self.pendientes:
+            logging.info(f"Diario {self.ruta}: {self.pendientes} cruces pendientes de aplicar")
+            self._mas_antiguo = self._recepcion_pendiente()
+            self._hay_datos.set()
+        gevent.spawn(self._vaciar)
+        self.iniciado = True
+
+    def _ruta_posicion(self):
+        return self.ruta + '.pos'
+
+    def _leer_posicion(self):
+        try:
+            with open(self._ruta_posicion()) as f:
+                return int(f.read().strip() or 0)
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def _guardar_posicion(self):
+        tmp = self._ruta_posicion() + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(str(self._aplicado))
+        os.replace(tmp, self._ruta_posicion())
+
+    def _contar_pendientes(self):
+        with open(self.ruta, 'rb') as f:
+            f.seek(self._aplicado)
+            return sum(bloque.count(b'\n') for bloque in iter(lambda: f.read(1 << 20), b''))
+
+    def anotar(self, cruces):
+        """Escribe los cruces en el diario y vuelve cuando están en disco. Devuelve sus hit_id."""
+        ahora = time.time()
+        cruces = [c if c.hit_id else c._replace(hit_id=uuid.uuid4().hex) for c in cruces]
+        datos = ''.join(json.dumps({
+            "h": c.hit_id, "e": c.event_code, "d": c.dorsal, "a": c.action, "t": c.ts_ms, "r": ahora
+        }, ensure_ascii=False, separators=(',', ':')) + '\n' for c in cruces).encode('utf-8')
+        with self._lock:
+            os.write(self._fd, datos)
+            self._escrito += len(datos)
+            hasta = self._escrito
+            self.pendientes += len(cruces)
+            if self._mas_antiguo is None:
+                self._mas_antiguo = ahora
+        self._sincronizar(hasta)
+        self._hay_datos.set()
+        return [c.hit_id for c in cruces]
+
+    def _sincronizar(self, hasta):
+        """fsync agrupado: una sola llamada cubre todas las escrituras hechas hasta ese momento."""
+        while self._sincronizado < hasta:
+            ronda = self._ronda_fsync
+            if ronda is not None:
+                ronda.wait()
+                continue
+            ronda = self._ronda_fsync = Event()
+            objetivo = self._escrito
+            try:
+                # fsync en el pool de hilos de gevent para no detener a los demás greenlets
+                gevent.get_hub().threadpool.apply(os.fsync, (self._fd,))
+                self._sincronizado = max(self._sincronizado, objetivo)
+            finally:
+                self._ronda_fsync = None
+                ronda.set()
+
+    def _leer_lote(self):
+        """Lee hasta lote_max cruces ya sincronizados desde la posición aplicada."""
+        cruces = []
+        fin = self._aplicado
+        with open(self.ruta, 'rb') as f:
+            f.seek(self._aplicado)
+            while len(cruces) < self.lote_max and fin < self._sincronizado:
+                linea = f.readline()
+                if not linea.endswith(b'\n'):
+                    break
+                fin += len(linea)
+                e = json.loads(linea)
+                # Diarios anteriores a ts_ms guardaban la hora como texto ISO
+                ts_ms = e["t"] if isinstance(e["t"], int) else iso_a_ms(e["t"])
+                cruces.append((Cruce(e["e"], e["d"], e["a"], ts_ms, e["h"]), e.get("r")))
+        return cruces, fin
+
+    def _vaciar(self):
+        while True:
+            self._hay_datos.wait(timeout=1)
+            self._hay_datos.clear()
+            gevent.sleep(self.espera)
+            while self._aplicado < self._sincronizado:
+                leidos, fin = self._leer_lote()
+                if not leidos:
+                    break
+                try:
+                    registrados = registrar_cruces([c for c, _ in leidos])
+                except Exception as e:
+                    self.ultimo_error = str(e)
+                    logging.error(f"No se pudo vaciar el diario (se reintenta): {e}")
+                    gevent.sleep(1)
+                    continue
+                self.ultimo_error = None
+                payloads = []
+                for (cruce, _), (tiempo_id, nombre, categoria, nuevo) in zip(leidos, registrados):
+                    if nuevo:
+                        payloads.append(payload_cruce(cruce, tiempo_id, nombre, categoria))
+                    else:
+                        self.duplicados += 1
+                self._aplicado = fin
+                self._guardar_posicion()
+                self.aplicados += len(leidos)
+                with self._lock:
+                    self.pendientes -= len(leidos)
+                    if self._aplicado == self._escrito and self._ronda_fsync is None:
+                        # Todo aplicado: se vacía el archivo para que no crezca sin límite
+                        os.ftruncate(self._fd, 0)
+                        self._aplicado = self._escrito = self._sincronizado = 0
+                        self._guardar_posicion()
+                        self.pendientes = 0
+                        self._mas_antiguo = None
+                    else:
+                        self._mas_antiguo = self._recepcion_pendiente()
+                if payloads:
+                    bus.publicar('cruces', payloads)
+
+    def _recepcion_pendiente(self):
+        """Hora de recepción del primer cruce pendiente (para medir el retraso)."""
+        with open(self.ruta, 'rb') as f:
+            f.seek(self._aplicado)
+            linea = f.readline()
+        try:
+            return json.loads(linea).get("r")
+        except ValueError:
+            return None
+
+    def estado(self):
+        return {
+            "archivo": self.ruta,
+            "pendientes": self.pendientes,
+            "bytes_pendientes": self._escrito - self._aplicado,
+            "retraso_s": round(time.time() - self._mas_antiguo, 3) if self._mas_antiguo else 0.0,
+            "aplicados": self.aplicados,
+            "duplicados": self.duplicados,
+            "ultimo_error": self.ultimo_error,
+        }
+
+diario = DiarioIngesta(DIARIO_DIR, DIARIO_LOTE, DIARIO_ESPERA) if DIARIO_DIR else None
+
+# === Sede: nodo en el recinto con SQLite local y sincronización con la nube ===
+# Con SEDE_DB el proceso corre en el recinto: cruces, inscritos y puntos de control se guardan y
+# leen en un SQLite local (latencia de LAN para dispositivos y pantallas) y un greenlet sube los
+# cruces a DATABASE_URL por lotes, reanudando tras los cortes del enlace.
+SEDE_DB = os.environ.get('SEDE_DB', '').strip()                      # ruta del SQLite; vacío = sin sede
+SEDE_LOTE = int(os.environ.get('SEDE_LOTE', 500))                    # cruces por lote subido a la nube
+SEDE_SONDEO = float(os.environ.get('SEDE_SONDEO', 1))                # s entre comprobaciones sin cruces nuevos
+SEDE_DESCARGA = float(os.environ.get('SEDE_DESCARGA', 60))           # s entre descargas de inscritos/puntos
+SEDE_EVENTOS = [e.strip() for e in os.environ.get('SEDE_EVENTOS', '').split(',') if e.strip()]  # descargar aunque no tengan cruces
+
+class CursorSede:
+    """Lo que las consultas de lectura usan de un cursor de psycopg2, sobre SQLite (%s → ?)."""
+
+    def __init__(self, cur):
+        self._cur = cur
+
+    def execute(self, sql, params=()):
+        self._cur.execute(sql.replace('%s', '?'), params)
+
+    def fetchone(self):
+        return self._cur.fetchone()
+
+    def fetchall(self):
+        return self._cur.fetchall()
+
+    def close(self):
+        self._cur.close()
+
+class ConexionSede:
+    def __init__(self, conn):
+        self._conn = conn
+
+    def cursor(self):
+        return CursorSede(self._conn.cursor())
+
+class SedeLocal:
+    """
+    Almacén SQLite de una sede (modo WAL, synchronous=FULL: un cruce confirmado está en disco).
+    - Escritura: registrar() aplica las mismas reglas que registrar_cruces() en PostgreSQL
+      (el último cruce de cada clave es el vigente y el anterior queda con reemplazado_por; un
+      hit_id repetido devuelve la fila original) en una transacción en el pool de hilos de gevent.
+      Cada cruce recibe un hit_id si no lo trae, para que subirlo sea idempotente.
+    - Subida: los cruces del historial se envían en orden de id con registrar_cruces(nube=True),
+      así que la nube reconstruye la misma cadena de reemplazos; lo ya subido se recuerda en la
+      tabla `sincronizacion`. Un lote repetido tras un corte no duplica filas (hit_id).
+    - Bajada: inscritos y puntos de control de los eventos de la sede se copian de la nube cuando
+      cambian (huella md5), al arrancar, cada SEDE_DESCARGA s y tras una invalidación.
+    Con varios workers, solo el que toma el flock de `<SEDE_DB>.sync` sincroniza.
+    """
+
+    ESQUEMA = """
+        CREATE TABLE IF NOT EXISTS tiempos (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            evento TEXT NOT NULL,
+            dorsal TEXT NOT NULL,
+            action TEXT NOT NULL,
+            ts_ms INTEGER NOT NULL,
+            reemplazado_por INTEGER,
+            hit_id TEXT NOT NULL,
+            UNIQUE (evento, hit_id)
+        );
+        CREATE INDEX IF NOT EXISTS idx_tiempos_evento_reemplazo ON tiempos (evento, reemplazado_por)
+            WHERE reemplazado_por IS NOT NULL;
+        CREATE TABLE IF NOT EXISTS tiempos_actuales (
+            evento TEXT NOT NULL,
+            dorsal TEXT NOT NULL,
+            action TEXT NOT NULL,
+            tiempo_id INTEGER NOT NULL,
+            ts_ms INTEGER NOT NULL,
+            PRIMARY KEY (evento, dorsal, action)
+        );
+        CREATE INDEX IF NOT EXISTS idx_tiempos_actuales_id ON tiempos_actuales (evento, tiempo_id);
+        CREATE INDEX IF NOT EXISTS idx_tiempos_actuales_ts ON tiempos_actuales (evento, ts_ms);
+        CREATE TABLE IF NOT EXISTS inscritos (
+            id INTEGER PRIMARY KEY,
+            event_code TEXT NOT NULL,
+            dorsal TEXT NOT NULL,
+            nombre TEXT NOT NULL,
+            categoria TEXT NOT NULL,
+            club TEXT NOT NULL,
+            rfid TEXT,
+            UNIQUE (event_code, dorsal)
+        );
+        CREATE TABLE IF NOT EXISTS puntos_control (
+            evento TEXT NOT NULL,
+            codigo TEXT NOT NULL,
+            orden INTEGER NOT NULL,
+            nombre TEXT NOT NULL,
+            distancia_m INTEGER,
+            PRIMARY KEY (evento, codigo)
+        );
+        CREATE TABLE IF NOT EXISTS sincronizacion (
+            clave TEXT PRIMARY KEY,
+            valor TEXT NOT NULL
+        );
+    """
+
+    def __init__(self, ruta, lote, sondeo, cada_descarga, eventos):
+        self.ruta = ruta
+        self.lote = lote
+        self.sondeo = sondeo
+        self.cada_descarga = cada_descarga
+        self.eventos = set(eventos)
+        self.iniciado = False
+        self._lectura = None           # conexión del hilo principal (lecturas, sin bloqueo en WAL)
+        self._escritura = None         # conexión que usan los hilos del pool, de uno en uno
+        self._turno = BoundedSemaphore(1)
+        self._hay_datos = Event()
+        self._por_descargar = set()
+        self._lock_fd = None
+        self._aviso = BusPostgres()    # solo para avisar a los nodos de la nube de lo subido
+        self.subido_hasta = 0
+        self.subidos = 0
+        self.duplicados = 0
+        self.ultima_subida = None
+        self.ultimo_error = None
+
+    def _abrir(self, **opciones):
+        conn = sqlite3.connect(self.ruta, isolation_level=None, timeout=30, **opciones)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=FULL')
+        return conn
+
+    def iniciar(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.ruta)), exist_ok=True)
+        self._escritura = self._abrir(check_same_thread=False)
+        self._escritura.executescript(self.ESQUEMA)
+        self._lectura = self._abrir()
+        self.subido_hasta = int(self._valor('subido_hasta') or 0)
+        bus.suscribir('invalidar', self._invalidado)
+        gevent.spawn(self._sincronizar)
+        self.iniciado = True
+
+    @contextmanager
+    def conexion(self):
+        yield ConexionSede(self._lectura)
+
+    def _valor(self, clave):
+        fila = self._lectura.execute("SELECT valor FROM sincronizacion WHERE clave = ?", (clave,)).fetchone()
+        return fila[0] if fila else None
+
+    def _en_hilo(self, funcion, *args):
+        """Transacción de escritura en el pool de hilos: el fsync no detiene a los demás greenlets."""
+        with self._turno:
+            return gevent.get_hub().threadpool.apply(funcion, args)
+
+    def registrar(self, cruces):
+        cruces = [c if c.hit_id else c._replace(hit_id=uuid.uuid4().hex) for c in cruces]
+        resultado = self._en_hilo(self._registrar, cruces)
+        for c, r in zip(cruces, resultado):
+            if r[3]:
+                m_cruces.sumar(c.event_code)
+        self._hay_datos.set()
+        return resultado
+
+    def _registrar(self, cruces):
+        conn = self._escritura
+        resultado = []
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            for c in cruces:
+                fila = conn.execute("SELECT id FROM tiempos WHERE evento = ? AND hit_id = ?",
+                                    (c.event_code, c.hit_id)).fetchone()
+                nuevo = fila is None
+                if nuevo:
+                    tiempo_id = conn.execute("""
+                        INSERT INTO tiempos (evento, dorsal, action, ts_ms, hit_id) VALUES (?, ?, ?, ?, ?)
+                    """, (c.event_code, c.dorsal, c.action, c.ts_ms, c.hit_id)).lastrowid
+                    clave = (c.event_code, c.dorsal, c.action)
+                    conn.execute("""
+                        UPDATE tiempos SET reemplazado_por = ?
+                        WHERE id = (SELECT tiempo_id FROM tiempos_actuales WHERE evento = ? AND dorsal = ? AND action = ?)
+                    """, (tiempo_id, *clave))
+                    conn.execute("""
+                        INSERT INTO tiempos_actuales (evento, dorsal, action, tiempo_id, ts_ms) VALUES (?, ?, ?, ?, ?)
+                        ON CONFLICT (evento, dorsal, action) DO UPDATE
+                        SET tiempo_id = excluded.tiempo_id, ts_ms = excluded.ts_ms
+                    """, (*clave, tiempo_id, c.ts_ms))
+                else:
+                    tiempo_id = fila[0]
+                inscrito = conn.execute("SELECT nombre, categoria FROM inscritos WHERE event_code = ? AND dorsal = ?",
+                                        (c.event_code, c.dorsal)).fetchone() or ("", "")
+                resultado.append((tiempo_id, inscrito[0], inscrito[1], nuevo))
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return resultado
+
+    def borrar_tiempos(self, event_code):
+        def borrar():
+            conn = self._escritura
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute("DELETE FROM tiempos_actuales WHERE evento = ?", (event_code,))
+            conn.execute("DELETE FROM tiempos WHERE evento = ?", (event_code,))
+            conn.execute('COMMIT')
+        self._en_hilo(borrar)
+
+    def _guardar_valor(self, conn, clave, valor):
+        conn.execute("""
+            INSERT INTO sincronizacion (clave, valor) VALUES (?, ?)
+            ON CONFLICT (clave) DO UPDATE SET valor = excluded.valor
+        """, (clave, str(valor)))
+
+    # --- Sincronización con la nube ---
+    def _invalidado(self, datos):
+        if {'inscritos', 'puntos'} & set(datos['tipos']):
+            self._por_descargar.add(datos['event_code'])
+            self._hay_datos.set()
+
+    def _tomar_turno(self):
+        """flock de `<SEDE_DB>.sync`: un solo proceso de la sede sube y descarga."""
+        if self._lock_fd is None:
+            fd = os.open(self.ruta + '.sync', os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                os.close(fd)
+                return False
+            self._lock_fd = fd
+        return True
+
+    def _sincronizar(self):
+        espera = 1
+        proxima_descarga = 0
+        while True:
+            try:
+                if self._tomar_turno():
+                    asegurar_esquema()
+                    if self._por_descargar or time.monotonic() >= proxima_descarga:
+                        completa = time.monotonic() >= proxima_descarga
+                        self._descargar(completa)
+                        if completa:
+                            proxima_descarga = time.monotonic() + self.cada_descarga
+                    while self._subir():
+                        pass
+                self.ultimo_error = None
+                espera = 1
+            except Exception as e:
+                # Sin enlace (o la nube no responde): se reintenta con espera creciente, sin perder nada
+                self.ultimo_error = str(e)
+                logging.warning(f"Sede sin sincronizar (se reintenta en {espera} s): {e}")
+                gevent.sleep(espera)
+                espera = min(espera * 2, 30)
+                continue
+            self._hay_datos.wait(timeout=self.sondeo)
+            self._hay_datos.clear()
+
+    def _subir(self):
+        """Sube el siguiente lote del historial local; False si no queda nada."""
+        filas = self._lectura.execute("""
+            SELECT id, evento, dorsal, action, ts_ms, hit_id FROM tiempos
+            WHERE id > ? ORDER BY id LIMIT ?
+        """, (self.subido_hasta, self.lote)).fetchall()
+        if not filas:
+            return False
+        cruces = [Cruce(e, d, a, t, h) for _, e, d, a, t, h in filas]
+        registrados = registrar_cruces(cruces, nube=True)
+        hasta = filas[-1][0]
+
+        def guardar():
+            self._guardar_valor(self._escritura, 'subido_hasta', hasta)
+        self._en_hilo(guardar)
+        self.subido_hasta = hasta
+        self.subidos += sum(1 for r in registrados if r[3])
+        self.duplicados += sum(1 for r in registrados if not r[3])
+        self.ultima_subida = time.time()
+        # Los nodos de la nube con BUS_URL=postgres actualizan sus cachés y pantallas
+        payloads = [payload_cruce(c, tiempo_id, nombre, categoria)
+                    for c, (tiempo_id, nombre, categoria, nuevo) in zip(cruces, registrados) if nuevo]
+        try:
+            for mensaje in self._aviso._trocear('cruces', payloads) if payloads else ():
+                self._aviso._enviar(mensaje)
+        except Exception as e:
+            logging.warning(f"No se pudo avisar a la nube de los cruces subidos: {e}")
+        return True
+
+    def _descargar(self, completa):
+        """Copia de la nube los inscritos y puntos de control que cambiaron."""
+        eventos = set(self._por_descargar)
+        if completa:
+            eventos |= self.eventos
+            eventos |= {r[0] for r in self._lectura.execute("SELECT DISTINCT evento FROM tiempos_actuales")}
+        for event_code in sorted(eventos):
+            with pool_db.conexion() as conn:
+                cur = conn.cursor()
+                cur.execute("""
+                    SELECT md5(string_agg(concat_ws('|', dorsal, nombre, categoria, club, rfid), ',' ORDER BY dorsal))
+                    FROM inscritos WHERE event_code = %s
+                """, (event_code,))
+                huella = cur.fetchone()[0] or ''
+                inscritos = None
+                if huella != (self._valor(f'inscritos:{event_code}') or ''):
+                    cur.execute("""
+                        SELECT dorsal, nombre, categoria, club, rfid FROM inscritos
+                        WHERE event_code = %s ORDER BY id
+                    """, (event_code,))
+                    inscritos = cur.fetchall()
+                cur.execute("""
+                    SELECT codigo, orden, nombre, distancia_m FROM puntos_control
+                    WHERE evento = %s ORDER BY orden
+                """, (event_code,))
+                puntos = [tuple(r) for r in cur.fetchall()]
+                conn.commit()
+                cur.close()
+            self._por_descargar.discard(event_code)
+            locales = self._lectura.execute("""
+                SELECT codigo, orden, nombre, distancia_m FROM puntos_control
+                WHERE evento = ? ORDER BY orden
+            """, (event_code,)).fetchall()
+            if puntos == locales:
+                puntos = None
+            if inscritos is None and puntos is None:
+                continue
+            self._en_hilo(self._reemplazar, event_code, huella, inscritos, puntos)
+            tipos = (['inscritos'] if inscritos is not None else []) + (['puntos'] if puntos is not None else [])
+            logging.info(f"Sede: {', '.join(tipos)} de {event_code} descargados de la nube")
+            bus.publicar('invalidar', {'event_code': event_code, 'tipos': tipos})
+            self._por_descargar.discard(event_code)  # la invalidación propia no pide otra descarga
+
+    def _reemplazar(self, event_code, huella, inscritos, puntos):
+        conn = self._escritura
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            if inscritos is not None:
+                conn.execute("DELETE FROM inscritos WHERE event_code = ?", (event_code,))
+                conn.executemany("""
+                    INSERT INTO inscritos (event_code, dorsal, nombre, categoria, club, rfid) VALUES (?, ?, ?, ?, ?, ?)
+                """, [(event_code, *r) for r in inscritos])
+                self._guardar_valor(conn, f'inscritos:{event_code}', huella)
+            if puntos is not None:
+                conn.execute("DELETE FROM puntos_control WHERE evento = ?", (event_code,))
+                conn.executemany("""
+                    INSERT INTO puntos_control (evento, codigo, orden, nombre, distancia_m) VALUES (?, ?, ?, ?, ?)
+                """, [(event_code, *r) for r in puntos])
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    def estado(self):
+        pendientes = self._lectura.execute("SELECT count(*) FROM tiempos WHERE id > ?",
+                                           (self.subido_hasta,)).fetchone()[0] if self.iniciado else 0
+        return {
+            "archivo": self.ruta,
+            "sincroniza": self._lock_fd is not None,
+            "pendientes": pendientes,
+            "subidos": self.subidos,
+            "duplicados": self.duplicados,
+            "ultima_subida": ms_a_iso(int(self.ultima_subida * 1000)) if self.ultima_subida else None,
+            "ultimo_error": self.ultimo_error,
+        }
+
+sede = SedeLocal(SEDE_DB, SEDE_LOTE, SEDE_SONDEO, SEDE_DESCARGA, SEDE_EVENTOS) if SEDE_DB else None
+
+# === Lecturas RFID: chip → dorsal y antirrebote ===
+RFID_VENTANA = float(os.environ.get('RFID_VENTANA', 3.0))   # s sin leer un chip que cierran su pasada
+RFID_MODO = os.environ.get('RFID_MODO', 'primera').strip()  # 'primera' lectura o 'pico' de RSSI de cada pasada
+RFID_LOTE_MAX = int(os.environ.get('RFID_LOTE_MAX', 10000)) # lecturas máximas por POST a /api/rfid
+
+def normalizar_tag(tag):
+    return str(tag or '').strip().replace(' ', '').upper()
+
+class IndiceTags:
+    """
+    Chip → dorsal de cada evento, construido desde `inscritos.rfid` la primera vez que llega una
+    lectura del evento. Se invalida con los inscritos (bus 'invalidar') y guarda a lo sumo
+    `max_eventos` eventos.
+    """
+
+    def __init__(self, max_eventos):
+        self.max_eventos = max_eventos
+        self._eventos = OrderedDict()  # event_code → [Event, dict tag→dorsal, error]
+
+    def mapa(self, event_code):
+        entrada = self._eventos.get(event_code)
+        if entrada is None:
+            entrada = [Event(), {}, None]
+            self._eventos[event_code] = entrada
+            while len(self._eventos) > self.max_eventos:
+                self._eventos.popitem(last=False)
+            try:
+                with conexion_lectura(event_code) as conn:
+                    cur = conn.cursor()
+                    cur.execute("""
+                        SELECT rfid, dorsal FROM inscritos
+                        WHERE event_code = %s AND rfid IS NOT NULL AND rfid <> ''
+                        ORDER BY id
+                    """, (event_code,))
+                    for tag, dorsal in cur.fetchall():
+                        entrada[1][normalizar_tag(tag)] = dorsal
+                    cur.close()
+            except Exception as e:
+                entrada[2] = e
+                if self._eventos.get(event_code) is entrada:
+                    del self._eventos[event_code]
+            entrada[0].set()
+        else:
+            self._eventos.move_to_end(event_code)
+            entrada[0].wait()
+        if entrada[2] is not None:
+            raise entrada[2]
+        return entrada[1]
+
+    def invalidar(self, event_code):
+        self._eventos.pop(event_code, None)
+
+indice_tags = IndiceTags(RESULTADOS_EVENTOS_MAX)
+
+class AntirreboteRFID:
+    """
+    Un lector informa cada chip decenas de veces por pasada. Las lecturas de un mismo
+    (evento, chip, action) separadas menos de `ventana` s forman una pasada, y de cada pasada
+    sale un único cruce:
+      primera → la primera lectura, registrada en cuanto llega
+      pico    → la de mayor RSSI, registrada al cerrarse la pasada (`ventana` s sin lecturas)
+    El hit_id del cruce depende del chip y de su lectura, así que reintentar no lo duplica.
+    Los cruces cuya escritura falla se reintentan desde el greenlet de barrido.
+    """
+
+    def __init__(self, ventana, modo):
+        if modo not in ('primera', 'pico'):
+            raise ValueError(f"RFID_MODO no soportado: {modo}")
+        self.ventana = ventana
+        self.ventana_ms = int(ventana * 1000)
+        self.modo = modo
+        self._pasadas = {}      # (event_code, tag, action) → [ultima_ms, llegada, dorsal, ts_ms, rssi, emitida]
+        self._pendientes = []   # cruces por escribir (cierres en modo pico, reintentos)
+        self.iniciado = False
+        self.lecturas = 0
+        self.cruces = 0
+
+    def iniciar(self):
+        self.iniciado = True
+        gevent.spawn(self._barrer)
 
-def init_db():
-    conn = get_db_conn()
-    cur = conn.cursor()
-    # Añadir columna 'reemplazado_por' si no existe
-    cur.execute("""
-        DO $$
-        BEGIN
-            IF NOT EXISTS (SELECT 1 FROM information_schema.columns 
-                           WHERE table_name='tiempos' AND column_name='reemplazado_por') THEN
-                ALTER TABLE tiempos ADD COLUMN reemplazado_por INTEGER REFERENCES tiempos(id);
-            END IF;
-        END $$;
-    """)
-    cur.execute('''
-        CREATE TABLE IF NOT EXISTS tiempos (
-            id SERIAL PRIMARY KEY,
-            evento TEXT NOT NULL,
-            dorsal TEXT NOT NULL,
-            action TEXT NOT NULL,
-            timestamp_iso TEXT NOT NULL,
-            creado_en TIMESTAMP DEFAULT NOW(),
-            reemplazado_por INTEGER REFERENCES tiempos(id)
-        )
-    ''')
-    cur.execute('''
-        CREATE TABLE IF NOT EXISTS inscritos (
-            id SERIAL PRIMARY KEY,
-            event_code TEXT NOT NULL,
-            dorsal TEXT NOT NULL,
-            nombre TEXT NOT NULL,
-            categoria TEXT NOT NULL,
-            club TEXT NOT NULL,
-            rfid TEXT,
-            creado_en TIMESTAMP DEFAULT NOW()
-        )
-    ''')
-    cur.execute('CREATE INDEX IF NOT EXISTS idx_inscritos_event ON inscritos (event_code)')
-    cur.execute('CREATE INDEX IF NOT EXISTS idx_tiempos_evento ON tiempos (evento)')
-    cur.execute('CREATE INDEX IF NOT EXISTS idx_tiempos_activos ON tiempos (evento) WHERE reemplazado_por IS NULL')
-    conn.commit()
-    cur.close()
-    conn.close()
+    def leer(self, event_code, tag, action, dorsal, ts_ms, rssi, llegada):
+        """Aplica una lectura; devuelve el Cruce a registrar ya (modo primera) o None."""
+        self.lecturas += 1
+        clave = (event_code, tag, action)
+        p = self._pasadas.get(clave)
+        if p is not None and ts_ms - p[0] <= self.ventana_ms:
+            if ts_ms > p[0]:
+                p[0] = ts_ms
+            p[1] = llegada
+            if self.modo == 'pico' and rssi is not None and (p[4] is None or rssi > p[4]):
+                p[3], p[4] = ts_ms, rssi
+            return None
+        if p is not None and not p[5]:
+            self._pendientes.append(self._cruce(clave, p))
+        emitir = self.modo == 'primera'
+        self._pasadas[clave] = [ts_ms, llegada, dorsal, ts_ms, rssi, emitir]
+        return self._cruce(clave, self._pasadas[clave]) if emitir else None
 
-# === WebSockets ===
-@socketio.on('connect')
-def handle_connect():
-    logging.info(f"Nuevo cliente conectado: {request.sid}")
+    def _cruce(self, clave, p):
+        event_code, tag, action = clave
+        self.cruces += 1
+        return Cruce(event_code, p[2], action, p[3], f"rfid:{action}:{tag}:{p[3]}")
 
-@socketio.on('disconnect')
-def handle_disconnect():
-    logging.info(f"Cliente desconectado: {request.sid}")
+    def _cerrar_vencidas(self):
+        limite = time.monotonic() - self.ventana
+        vencidas = [clave for clave, p in self._pasadas.items() if p[1] < limite]
+        for clave in vencidas:
+            p = self._pasadas.pop(clave)
+            if not p[5]:
+                self._pendientes.append(self._cruce(clave, p))
 
-@socketio.on('subscribe')
-def on_subscribe(data):
-    event_code = data.get('event_code', '').strip()
-    if event_code:
-        join_room(event_code)
-        logging.info(f"Cliente {request.sid} suscrito a evento: {event_code}")
+    def escribir(self, cruces):
+        """Registra cruces resueltos (diario o BD + bus); si falla quedan para el siguiente barrido."""
+        if not cruces:
+            return True
+        try:
+            if diario is not None:
+                diario.anotar(cruces)
+                return True
+            payloads = [payload_cruce(c, tiempo_id, nombre, categoria)
+                        for c, (tiempo_id, nombre, categoria, nuevo) in zip(cruces, registrar_cruces(cruces)) if nuevo]
+            if payloads:
+                bus.publicar('cruces', payloads)
+            return True
+        except Exception as e:
+            logging.error(f"RFID: {len(cruces)} cruces sin guardar, se reintentan: {e}")
+            self._pendientes.extend(cruces)
+            return False
+
+    def _barrer(self):
+        intervalo = max(0.05, min(self.ventana / 4, 1.0))
+        while True:
+            gevent.sleep(intervalo)
+            try:
+                self._cerrar_vencidas()
+                cruces, self._pendientes = self._pendientes, []
+                if not self.escribir(cruces):
+                    gevent.sleep(1)
+            except Exception:
+                logging.exception("Error en el barrido RFID")
+
+    def estado(self):
+        return {
+            "modo": self.modo,
+            "ventana": self.ventana,
+            "pasadas_abiertas": len(self._pasadas),
+            "pendientes": len(self._pendientes),
+            "lecturas": self.lecturas,
+            "cruces": self.cruces,
+        }
+
+antirrebote = AntirreboteRFID(RFID_VENTANA, RFID_MODO)
+
+def asegurar_servicios():
+    """Arranca, una vez por proceso (worker), el bus, el vaciado del diario, el barrido RFID y el monitor de la réplica."""
+    if not bus.iniciado:
+        bus.iniciar()
+    if monitor_replica is not None and not monitor_replica.iniciado:
+        monitor_replica.iniciar()
+    if diario is not None and not diario.iniciado:
+        diario.iniciar()
+    if not antirrebote.iniciado:
+        antirrebote.iniciar()
+    if sede is not None and not sede.iniciado:
+        sede.iniciar()
 
 # === API: Recibir tiempos ===
 @app.route('/api/crono', methods=['POST'])
 def crono():
     try:
-        init_db()
         data = request.get_json()
         if not data:
             return jsonify({"error": "JSON inválido"}), 400
 
-        dorsal = str(data.get('dorsal', '')).strip()
-        action = str(data.get('action', 'llegada')).strip().lower()
-        provided_ts = data.get('timestamp')
-        if provided_ts:
-            ts_str = str(provided_ts).strip()
-            if not ts_str.endswith('Z') and '+' not in ts_str and 'T' in ts_str:
-                ts_str = ts_str.rstrip() + 'Z'
-        else:
-            ts_str = datetime.now(timezone.utc).isoformat().replace('+00:00', 'Z')
+        try:
+            cruce = normalizar_cruce(data)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
 
-        event_code = str(data.get('event_code', 'demo')).strip()
+        if diario is not None:
+            # Modo diario: confirmado en cuanto está en disco; se escribe en la BD en segundo plano
+            hit_id, = diario.anotar([cruce])
+            return jsonify({"status": "accepted", "hit_id": hit_id}), 202
 
-        if not dorsal or not event_code:
-            return jsonify({"error": "dorsal y event_code requeridos"}), 400
+        (tiempo_id, nombre, categoria, nuevo), = registrar_cruces([cruce])
 
-        current_time = parse_iso_ts(ts_str)
+        # Un hit_id ya registrado devuelve el cruce original sin escribir ni difundir nada
+        if not nuevo:
+            return jsonify({"status": "success", "id": tiempo_id, "hit_id": cruce.hit_id, "duplicado": True}), 200
 
-        conn = get_db_conn()
-        cur = conn.cursor()
+        # Caché, clasificación y pantallas (en todos los workers)
+        bus.publicar('cruces', [payload_cruce(cruce, tiempo_id, nombre, categoria)])
 
-        # Marcar registros previos como reemplazados
-        cur.execute("""
-            UPDATE tiempos 
-            SET reemplazado_por = (
-                SELECT nextval('tiempos_id_seq')
-            )
-            WHERE evento = %s AND dorsal = %s AND action = %s AND reemplazado_por IS NULL
-        """, (event_code, dorsal, action))
-
-        if action == 'llegada':
-            # Insertar nuevo registro
-            cur.execute(
-                "INSERT INTO tiempos (evento, dorsal, action, timestamp_iso) VALUES (%s, %s, %s, %s)",
-                (event_code, dorsal, action, ts_str)
-            )
-            conn.commit()
-        else:
-            # Acciones distintas de 'llegada' (ej: 'salida') → insertar siempre
-            cur.execute(
-                "INSERT INTO tiempos (evento, dorsal, action, timestamp_iso) VALUES (%s, %s, %s, %s)",
-                (event_code, dorsal, action, ts_str)
-            )
-            conn.commit()
+        return jsonify({"status": "success", "id": tiempo_id, "hit_id": cruce.hit_id, "duplicado": False}), 201
 
-        # Obtener datos del inscrito
-        cur.execute('''
-            SELECT nombre, categoria FROM inscritos 
-            WHERE event_code = %s AND dorsal = %s
-        ''', (event_code, dorsal))
-        row = cur.fetchone()
-        nombre = row[0] if row else ""
-        categoria = row[1] if row else ""
+    except PoolAgotado as e:
+        logging.error(f"Error en /api/crono: {e}")
+        return jsonify({"error": str(e)}), 503
+    except Exception as e:
+        logging.error(f"Error en /api/crono: {e}")
+        return jsonify({"error": str(e)}), 500
 
-        cur.close()
-        conn.close()
+@app.route('/api/crono/batch', methods=['POST'])
+def crono_batch():
+    """
+    Lote de cruces de una alfombra/lector RFID: {"event_code": "...", "cruces": [{dorsal, action, timestamp, hit_id}, ...]}
+    (o directamente la lista). Cada elemento puede indicar su propio event_code y hit_id.
+    Responde con el estado de cada elemento, en el mismo orden:
+      ok          → registrado (incluye su id; "duplicado": true si su hit_id ya estaba)
+      invalido    → datos incorrectos, no reintentar
+      reintentar  → fallo de la BD, el dispositivo debe reenviarlo
+    """
+    data = request.get_json(silent=True)
+    if isinstance(data, dict):
+        items = data.get('cruces')
+        event_code_defecto = str(data.get('event_code', 'demo')).strip()
+    else:
+        items = data
+        event_code_defecto = 'demo'
+    if not isinstance(items, list):
+        return jsonify({"error": "esperaba una lista de cruces"}), 400
+    if len(items) > CRONO_LOTE_MAX:
+        return jsonify({"error": f"máximo {CRONO_LOTE_MAX} cruces por lote"}), 413
 
-        # Emitir actualización
-        socketio.emit('nuevo_tiempo', {
-            'event_code': event_code,
-            'dorsal': dorsal,
-            'action': action,
-            'timestamp': ts_str,
-            'nombre': nombre,
-            'categoria': categoria
-        }, room=event_code)
+    cuerpo, estado = ingerir_lote(items, event_code_defecto)
+    return jsonify(cuerpo), estado
 
-        return jsonify({"status": "success"}), 201
+@app.route('/api/rfid', methods=['POST'])
+def rfid():
+    """
+    Lecturas en bruto de un lector RFID:
+      {"event_code": "...", "action": "llegada", "lecturas": [{"tag": "E200...", "rssi": -52, "timestamp": "..."}, ...]}
+    Cada lectura puede llevar su propio action y la hora como "timestamp" ISO o "ms" epoch
+    (por defecto, la hora de llegada). El chip se traduce a dorsal con los inscritos del evento
+    y las lecturas repetidas se agrupan en pasadas (ver AntirreboteRFID); solo el cruce
+    resultante llega a `tiempos`.
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get('lecturas'), list):
+        return jsonify({"error": "esperaba {event_code, lecturas: [...]}"}), 400
+    lecturas = data['lecturas']
+    if len(lecturas) > RFID_LOTE_MAX:
+        return jsonify({"error": f"máximo {RFID_LOTE_MAX} lecturas por lote"}), 413
+    event_code = str(data.get('event_code', 'demo')).strip()
+    action_defecto = str(data.get('action', 'llegada')).strip().lower()
+    if not event_code:
+        return jsonify({"error": "event_code requerido"}), 400
 
+    try:
+        tags = indice_tags.mapa(event_code)
+    except PoolAgotado as e:
+        return jsonify({"error": str(e)}), 503
     except Exception as e:
-        logging.error(f"Error en /api/crono: {e}")
+        logging.error(f"Error en /api/rfid: {e}")
         return jsonify({"error": str(e)}), 500
 
+    llegada = time.monotonic()
+    ahora_ms = int(time.time() * 1000)
+    cruces = []
+    sin_dorsal = invalidas = 0
+    for lectura in lecturas:
+        try:
+            tag = normalizar_tag(lectura['tag'])
+            if 'ms' in lectura:
+                ts_ms = int(lectura['ms'])
+            elif lectura.get('timestamp'):
+                ts_ms = iso_a_ms(str(lectura['timestamp']))
+            else:
+                ts_ms = ahora_ms
+            rssi = lectura.get('rssi')
+            rssi = float(rssi) if rssi is not None else None
+            action = str(lectura.get('action') or action_defecto).strip().lower()
+        except (KeyError, TypeError, ValueError):
+            invalidas += 1
+            continue
+        dorsal = tags.get(tag)
+        if dorsal is None:
+            sin_dorsal += 1
+            continue
+        cruce = antirrebote.leer(event_code, tag, action, dorsal, ts_ms, rssi, llegada)
+        if cruce is not None:
+            cruces.append(cruce)
+
+    guardados = antirrebote.escribir(cruces)
+    return jsonify({
+        "status": "accepted",
+        "lecturas": len(lecturas),
+        "cruces": len(cruces),
+        "sin_dorsal": sin_dorsal,
+        "invalidas": invalidas,
+        "reintentando": not guardados
+    }), 202
+
+def consultar_tiempos(event_code):
+    with conexion_lectura(event_code) as conn:
+        cur = conn.cursor()
+        # Solo registros vigentes (no reemplazados)
+        cur.execute("SELECT tiempo_id, dorsal, action, ts_ms FROM tiempos_actuales WHERE evento = %s ORDER BY tiempo_id", (event_code,))
+        rows = cur.fetchall()
+        cur.close()
+    return [{
+        "id": r[0],
+        "dorsal": r[1],
+        "action": r[2],
+        "timestamp": ms_a_iso(r[3])
+    } for r in rows]
+
+def consultar_tiempos_columnas(event_code):
+    """Lo mismo que consultar_tiempos en columnas, con la hora en ms epoch (formato compacto)."""
+    with conexion_lectura(event_code) as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT tiempo_id, dorsal, action, ts_ms FROM tiempos_actuales WHERE evento = %s ORDER BY tiempo_id", (event_code,))
+        rows = cur.fetchall()
+        cur.close()
+    ids, dorsales, acciones, ms = zip(*rows) if rows else ((), (), (), ())
+    return {"id": ids, "dorsal": dorsales, "action": acciones, "ms": ms}
+
+def consultar_tiempos_ventana(event_code, desde, hasta):
+    """Tiempos vigentes con hora en [desde, hasta) (ms epoch; None = sin límite), en orden cronológico."""
+    with conexion_lectura(event_code) as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT tiempo_id, dorsal, action, ts_ms FROM tiempos_actuales
+            WHERE evento = %s AND ts_ms >= %s AND ts_ms < %s
+            ORDER BY ts_ms, tiempo_id
+        """, (event_code, desde if desde is not None else -2**63, hasta if hasta is not None else 2**63 - 1))
+        rows = cur.fetchall()
+        cur.close()
+    return [{"id": r[0], "dorsal": r[1], "action": r[2], "timestamp": ms_a_iso(r[3])} for r in rows]
+
+def parametro_hora(nombre):
+    """?desde= / ?hasta= como ms epoch o ISO 8601. ValueError si no se entiende."""
+    valor = request.args.get(nombre, '').strip()
+    if not valor:
+        return None
+    return int(valor) if valor.lstrip('-').isdigit() else iso_a_ms(valor)
+
+def consultar_tiempos_desde(event_code, since, columnas=False):
+    """
+    Cambios posteriores al cursor `since` (un tiempos.id):
+      altas → registros vigentes con id > since
+      bajas → registros que el cliente ya tenía (id <= since) y fueron reemplazados después
+    Una fila reemplazada guarda en reemplazado_por el id de la que la sustituye, así que
+    "reemplazada después de since" es reemplazado_por > since.
+    Los id salen de nextval antes del commit, pero registrar_cruces escribe cada evento bajo su
+    cerrojo (sql_cerrojo_evento): dentro de un evento se confirman en orden de id, así que nada
+    con id <= since puede aparecer después de que el cliente lo haya visto.
+    Con `columnas`, altas y bajas van en columnas y la hora de las altas en ms (formato compacto).
+    """
+    with conexion_lectura(event_code) as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT tiempo_id, dorsal, action, ts_ms, NULL FROM tiempos_actuales
+            WHERE evento = %s AND tiempo_id > %s
+            UNION ALL
+            SELECT id, dorsal, action, NULL, reemplazado_por FROM tiempos
+            WHERE evento = %s AND reemplazado_por > %s AND id <= %s
+            ORDER BY 1
+        """, (event_code, since, event_code, since, since))
+        rows = cur.fetchall()
+        cur.close()
+    cursor = since
+    altas = []
+    bajas = []
+    for tiempo_id, dorsal, action, ts, reemplazado_por in rows:
+        cursor = max(cursor, tiempo_id, reemplazado_por or 0)
+        if reemplazado_por is None:
+            altas.append({"id": tiempo_id, "dorsal": dorsal, "action": action,
+                          **({"ms": ts} if columnas else {"timestamp": ms_a_iso(ts)})})
+        else:
+            bajas.append({"id": tiempo_id, "dorsal": dorsal, "action": action})
+    if columnas:
+        altas = {k: [f[k] for f in altas] for k in ("id", "dorsal", "action", "ms")}
+        bajas = {k: [f[k] for f in bajas] for k in ("id", "dorsal", "action")}
+    return {"cursor": cursor, "altas": altas, "bajas": bajas}
+
 @app.route('/api/tiempos/<event_code>')
 def tiempos(event_code):
+    """
+    Sin parámetros: lista completa de tiempos activos (cada fila con su id; el mayor id es el cursor).
+    Con ?since=<cursor>: solo los cambios desde ese cursor y el siguiente cursor (sincronización delta);
+    con ?formato=columnas además, altas y bajas en columnas con la hora en ms.
+    Con ?desde=/?hasta= (ms epoch o ISO): los tiempos de esa franja horaria, en orden cronológico.
+    """
     try:
-        init_db()
-        conn = get_db_conn()
+        since = request.args.get('since', type=int)
+        if since is not None:
+            return jsonify(consultar_tiempos_desde(event_code, since, request.args.get('formato') == 'columnas'))
+        try:
+            desde, hasta = parametro_hora('desde'), parametro_hora('hasta')
+        except ValueError:
+            return jsonify({"error": "desde/hasta: ms epoch o ISO 8601"}), 400
+        if desde is not None or hasta is not None:
+            return jsonify(consultar_tiempos_ventana(event_code, desde, hasta))
+        return respuesta_cacheada('tiempos', event_code, consultar_tiempos, consultar_tiempos_columnas)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# === Canal de ingesta para dispositivos (Socket.IO /dispositivos) ===
+# Los dispositivos de cronometraje quedan conectados y envían sus cruces como mensajes: sin una
+# petición HTTP por cruce. Cada mensaje recibe su ack con el mismo resultado que /api/crono/batch.
+DISPOSITIVOS_TOKENS = {t.strip() for t in os.environ.get('DISPOSITIVOS_TOKENS', '').split(',') if t.strip()}  # vacío = canal cerrado
+DISPOSITIVOS_EN_VUELO = int(os.environ.get('DISPOSITIVOS_EN_VUELO', 32))  # mensajes sin ack por dispositivo
+
+m_dispositivos_ack = Histograma('crono_dispositivos_ack_segundos',
+                                'Desde que llega un mensaje de un dispositivo hasta su ack', ('estado',))
+
+def token_valido(token):
+    return any(hmac.compare_digest(token.encode(), t.encode()) for t in DISPOSITIVOS_TOKENS)
+
+class CanalDispositivo:
+    """
+    Mensajes de un dispositivo conectado. Los que llegan mientras se escribe el anterior esperan y
+    se escriben juntos en una sola llamada a ingerir_lote (un viaje a la BD); cada uno recibe su ack.
+    Con DISPOSITIVOS_EN_VUELO mensajes sin ack, los siguientes se rechazan al momento con
+    'ocupado': el dispositivo debe esperar acks antes de seguir enviando (contrapresión).
+    """
+
+    def __init__(self, nombre, event_code):
+        self.nombre = nombre
+        self.event_code = event_code  # evento por defecto de sus cruces
+        self.pendientes = deque()     # (items, AsyncResult) aún sin escribir
+        self.en_vuelo = 0
+        self.mensajes = 0
+        self.rechazados = 0
+        self._escritor = None
+
+    def recibir(self, items):
+        """Bloquea el greenlet del mensaje hasta que está escrito; devuelve el cuerpo del ack."""
+        if self.en_vuelo >= DISPOSITIVOS_EN_VUELO:
+            self.rechazados += 1
+            return {"status": "ocupado", "error": f"máximo {DISPOSITIVOS_EN_VUELO} mensajes sin ack"}
+        self.en_vuelo += 1
+        self.mensajes += 1
+        try:
+            resultado = AsyncResult()
+            self.pendientes.append((items, resultado))
+            if self._escritor is None:
+                self._escritor = gevent.spawn(self._escribir)
+            return resultado.get()
+        finally:
+            self.en_vuelo -= 1
+
+    def _escribir(self):
+        try:
+            while self.pendientes:
+                tanda = [self.pendientes.popleft()]
+                n = len(tanda[0][0])
+                while self.pendientes and n + len(self.pendientes[0][0]) <= CRONO_LOTE_MAX:
+                    tanda.append(self.pendientes.popleft())
+                    n += len(tanda[-1][0])
+                self._escribir_tanda(tanda)
+        finally:
+            self._escritor = None
+
+    def _escribir_tanda(self, tanda):
+        items = [item for mensaje, _ in tanda for item in mensaje]
+        try:
+            cuerpo, _ = ingerir_lote(items, self.event_code)
+        except Exception as e:
+            logging.error(f"Error en el canal del dispositivo {self.nombre}: {e}")
+            cuerpo = {"status": "error", "error": str(e), "resultados": [None] * len(items)}
+        inicio = 0
+        for mensaje, resultado in tanda:
+            propios = cuerpo["resultados"][inicio:inicio + len(mensaje)]
+            for i, r in enumerate(propios):
+                if r is not None:
+                    r["index"] = i
+            if cuerpo["status"] == "error":
+                ack = {"status": "error", "error": cuerpo["error"], "resultados": propios}
+            elif all(r["status"] == "ok" for r in propios):
+                ack = {"status": "accepted" if diario is not None else "success", "resultados": propios}
+            else:
+                ack = {"status": "partial", "resultados": propios}
+            ack["registrados"] = sum(1 for r in propios if r is not None and r["status"] == "ok")
+            resultado.set(ack)
+            inicio += len(mensaje)
+
+    def estado(self):
+        return {"nombre": self.nombre, "event_code": self.event_code, "en_vuelo": self.en_vuelo,
+                "mensajes": self.mensajes, "rechazados": self.rechazados}
+
+canales_dispositivos = {}  # sid → CanalDispositivo
+
+@socketio.on('connect', namespace='/dispositivos')
+def conectar_dispositivo(auth=None):
+    """
+    auth: {"token": ..., "dispositivo": "meta-1", "event_code": "maraton"} (o Authorization: Bearer <token>).
+    Al conectar recibe 'bienvenida' con los límites del canal.
+    """
+    asegurar_servicios()
+    auth = auth if isinstance(auth, dict) else {}
+    token = str(auth.get('token') or request.headers.get('Authorization', '').removeprefix('Bearer ')).strip()
+    if not token or not token_valido(token):
+        raise ConexionRechazada("token de dispositivo inválido")
+    nombre = str(auth.get('dispositivo') or request.sid)[:HIT_ID_MAX]
+    event_code = str(auth.get('event_code', 'demo')).strip() or 'demo'
+    canales_dispositivos[request.sid] = CanalDispositivo(nombre, event_code)
+    socketio.emit('bienvenida', {"en_vuelo_max": DISPOSITIVOS_EN_VUELO, "lote_max": CRONO_LOTE_MAX},
+                  to=request.sid, namespace='/dispositivos')
+    logging.info(f"Dispositivo conectado: {nombre} ({event_code})")
+
+@socketio.on('disconnect', namespace='/dispositivos')
+def desconectar_dispositivo():
+    canal = canales_dispositivos.pop(request.sid, None)
+    if canal is not None:
+        # Lo que quede pendiente se escribe igual; su ack se pierde y el dispositivo lo reenvía (hit_id)
+        logging.info(f"Dispositivo desconectado: {canal.nombre}")
+
+@socketio.on('cruces', namespace='/dispositivos')
+def cruces_dispositivo(data):
+    """
+    Un cruce ({dorsal, action, timestamp, hit_id}), una lista o {"cruces": [...]}. El ack trae
+    {"status": "success"|"accepted"|"partial"|"error"|"ocupado", "registrados": n, "resultados": [...]}
+    con un resultado por cruce del mensaje, como /api/crono/batch.
+    """
+    inicio = time.perf_counter()
+    canal = canales_dispositivos.get(request.sid)
+    if canal is None:
+        return {"status": "error", "error": "dispositivo no autenticado"}
+    if isinstance(data, dict):
+        items = data['cruces'] if isinstance(data.get('cruces'), list) else [data]
+    elif isinstance(data, list):
+        items = data
+    else:
+        return {"status": "error", "error": "esperaba un cruce o una lista de cruces"}
+    if len(items) > CRONO_LOTE_MAX:
+        ack = {"status": "error", "error": f"máximo {CRONO_LOTE_MAX} cruces por mensaje"}
+    else:
+        ack = canal.recibir(items)
+    m_dispositivos_ack.observar(time.perf_counter() - inicio, ack["status"])
+    return ack
+
+# === API: Resultados calculados en el servidor ===
+@app.route('/api/resultados/<event_code>')
+def resultados(event_code):
+    """
+    Clasificación por categoría ya calculada. Parámetros opcionales:
+      categoria=X  → solo esa categoría
+      top=N        → solo los N primeros de cada categoría
+      punto=P      → clasificación al paso por un punto de control (por defecto la meta, 'llegada')
+      dorsal=D     → posición y tiempo de un corredor (búsqueda O(log n)) y sus parciales
+    """
+    try:
+        categoria = request.args.get('categoria')
+        top = request.args.get('top', type=int)
+        if top is not None and top < 0:
+            return jsonify({"error": "top debe ser >= 0"}), 400
+        punto = request.args.get('punto', 'llegada').strip().lower()
+        est = motor_resultados.estado(event_code)
+        if punto not in est.tablas:
+            return jsonify({"error": f"punto de control desconocido: {punto}"}), 404
+
+        dorsal = request.args.get('dorsal')
+        if dorsal is not None:
+            parciales = est.parciales(dorsal)
+            fila = est.fila_dorsal(dorsal, punto)
+            if fila is None and not parciales:
+                return jsonify({"error": "dorsal sin tiempo en este evento"}), 404
+            return jsonify({**(fila or {"dorsal": dorsal, "pos": None}), "parciales": parciales})
+
+        return jsonify({
+            "event_code": event_code,
+            "punto": punto,
+            "categorias": est.tabla(categoria, top, punto)
+        })
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# === API: Puntos de control ===
+def consultar_puntos(event_code):
+    with conexion_lectura(event_code) as conn:
         cur = conn.cursor()
-        # Solo devolver registros activos (no reemplazados)
-        cur.execute("SELECT dorsal, action, timestamp_iso FROM tiempos WHERE evento = %s AND reemplazado_por IS NULL ORDER BY id", (event_code,))
+        cur.execute("SELECT codigo, nombre, distancia_m FROM puntos_control WHERE evento = %s ORDER BY orden", (event_code,))
         rows = cur.fetchall()
         cur.close()
-        conn.close()
-        return jsonify([{
-            "dorsal": r[0],
-            "action": r[1],
-            "timestamp": truncate_microseconds(r[2])
-        } for r in rows])
+    return [{"codigo": r[0], "nombre": r[1], "distancia_m": r[2]} for r in rows]
+
+def normalizar_puntos(datos):
+    """Lista de puntos intermedios en orden de paso → [(codigo, nombre, distancia_m)]. ValueError si no es válida."""
+    if not isinstance(datos, list):
+        raise ValueError("se espera una lista de puntos de control en orden de paso")
+    puntos = []
+    for p in datos:
+        if not isinstance(p, dict):
+            raise ValueError("cada punto debe ser un objeto JSON")
+        codigo = str(p.get('codigo', '')).strip().lower()  # como `action` en /api/crono
+        if not codigo:
+            raise ValueError("codigo requerido en cada punto")
+        if codigo in ('salida', 'llegada'):
+            raise ValueError("salida y llegada son implícitos; solo se definen los puntos intermedios")
+        distancia = p.get('distancia_m')
+        if distancia is not None and (not isinstance(distancia, int) or isinstance(distancia, bool) or distancia < 0):
+            raise ValueError("distancia_m debe ser un entero >= 0")
+        puntos.append((codigo, str(p.get('nombre') or codigo).strip(), distancia))
+    if len({p[0] for p in puntos}) != len(puntos):
+        raise ValueError("códigos de punto repetidos")
+    return puntos
+
+@app.route('/api/puntos/<event_code>', methods=['GET', 'PUT'])
+def manejar_puntos(event_code):
+    """
+    Puntos de control intermedios del evento, en orden de paso. Un cruce cuyo `action` es el código
+    de un punto cuenta como paso por él; PUT reemplaza la lista completa.
+    """
+    try:
+        if request.method == 'PUT':
+            try:
+                puntos = normalizar_puntos(request.get_json(silent=True))
+            except ValueError as e:
+                return jsonify({"error": str(e)}), 400
+            with pool_db.conexion() as conn:
+                cur = conn.cursor()
+                cur.execute("DELETE FROM puntos_control WHERE evento = %s", (event_code,))
+                for orden, (codigo, nombre, distancia) in enumerate(puntos, 1):
+                    cur.execute(
+                        "INSERT INTO puntos_control (evento, codigo, orden, nombre, distancia_m) VALUES (%s, %s, %s, %s, %s)",
+                        (event_code, codigo, orden, nombre, distancia))
+                conn.commit()
+                cur.close()
+            bus.publicar('invalidar', {'event_code': event_code, 'tipos': ['puntos']})
+            return jsonify({"status": "success", "count": len(puntos)}), 200
+        return jsonify(consultar_puntos(event_code))
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 # === API: Inscripciones ===
+INSCRITOS_LOTE = int(os.environ.get('INSCRITOS_LOTE', 1000))  # filas por INSERT a la tabla de carga
+CAMPOS_INSCRITO = ('dorsal', 'nombre', 'categoria', 'club', 'rfid')
+
+def consultar_inscritos(event_code):
+    with conexion_lectura(event_code) as conn:
+        cur = conn.cursor()
+        cur.execute('''
+            SELECT dorsal, nombre, categoria, club, rfid 
+            FROM inscritos 
+            WHERE event_code = %s 
+            ORDER BY dorsal
+        ''', (event_code,))
+        rows = cur.fetchall()
+        cur.close()
+    return [{
+        "dorsal": r[0], "nombre": r[1], "categoria": r[2], "club": r[3], "rfid": r[4]
+    } for r in rows]
+
+def iterar_json_lista(stream, bloque=1 << 16):
+    """Recorre un array JSON leyendo el cuerpo por bloques: nunca tiene el archivo entero en memoria."""
+    decoder = json.JSONDecoder()
+    decodificar = codecs.getincrementaldecoder('utf-8-sig')().decode
+    buf, pos, abierto, agotado = '', 0, False, False
+    while True:
+        while pos < len(buf) and buf[pos] in ' \t\r\n,':
+            pos += 1
+        if pos < len(buf):
+            if not abierto:
+                if buf[pos] != '[':
+                    raise ValueError("esperaba una lista")
+                abierto = True
+                pos += 1
+                continue
+            if buf[pos] == ']':
+                return
+            try:
+                item, fin = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                if agotado:
+                    raise ValueError("JSON inválido")
+            else:
+                yield item
+                pos = fin
+                continue
+        if agotado:
+            raise ValueError("JSON incompleto" if abierto else "esperaba una lista")
+        datos = stream.read(bloque)
+        agotado = not datos
+        buf = buf[pos:] + decodificar(datos, final=agotado)
+        pos = 0
+
+def iterar_ndjson(stream):
+    """Un objeto JSON por línea (application/x-ndjson)."""
+    for linea in io.TextIOWrapper(stream, encoding='utf-8-sig'):
+        if linea.strip():
+            try:
+                yield json.loads(linea)
+            except ValueError:
+                raise ValueError("JSON inválido")
+
+def iterar_csv(stream):
+    """CSV con cabecera (dorsal,nombre,categoria,club,rfid). Acepta ',' o ';' (Excel en español)."""
+    texto = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    cabecera = texto.readline()
+    delimitador = ';' if cabecera.count(';') > cabecera.count(',') else ','
+    columnas = [c.strip().lower() for c in next(csv.reader([cabecera], delimiter=delimitador), [])]
+    if 'dorsal' not in columnas:
+        raise ValueError("el CSV necesita cabecera con columna 'dorsal'")
+    for fila in csv.reader(texto, delimiter=delimitador):
+        if fila:
+            yield dict(zip(columnas, fila))
+
+def leer_inscritos_peticion():
+    """Elige el lector según el Content-Type (o ?formato=csv|ndjson|json) del POST."""
+    formato = request.args.get('formato') or {
+        'text/csv': 'csv', 'application/csv': 'csv',
+        'application/x-ndjson': 'ndjson', 'application/jsonl': 'ndjson',
+    }.get(request.mimetype, 'json')
+    lectores = {'csv': iterar_csv, 'ndjson': iterar_ndjson, 'json': iterar_json_lista}
+    if formato not in lectores:
+        raise ValueError(f"formato desconocido: {formato}")
+    return lectores[formato](request.stream)
+
+def importar_inscritos(event_code, items):
+    """Sustituye la lista de inscritos del evento por `items` aplicando solo las diferencias.
+
+    Las filas se vuelcan por lotes a una tabla temporal y el diff (bajas, cambios y altas por
+    dorsal) se aplica en la misma transacción: los lectores ven la lista anterior completa
+    hasta el commit y la nueva después, nunca una intermedia ni vacía.
+    """
+    t0 = time.perf_counter()
+    resumen = {"count": 0, "descartados": 0}
+    # Sin caché: otro proceso pudo borrar la partición (flush-inscritos, archivar) desde la última carga
+    particiones_listas.discard(('inscritos', event_code))
+    asegurar_particion('inscritos', event_code)
+    with pool_db.conexion() as conn:
+        cur = conn.cursor()
+        cur.execute('''
+            CREATE TEMP TABLE inscritos_carga (
+                n INTEGER NOT NULL, dorsal TEXT NOT NULL, nombre TEXT NOT NULL,
+                categoria TEXT NOT NULL, club TEXT NOT NULL, rfid TEXT
+            ) ON COMMIT DROP
+        ''')
+        lote = []
+
+        def volcar():
+            # COPY no está disponible con el wait callback de gevent: INSERT multi-fila por lote
+            filas = b','.join(cur.mogrify('(%s,%s,%s,%s,%s,%s)', f) for f in lote)
+            cur.execute(b'INSERT INTO inscritos_carga (n, dorsal, nombre, categoria, club, rfid) VALUES ' + filas)
+            lote.clear()
+
+        for item in items:
+            if not isinstance(item, dict):
+                resumen["descartados"] += 1
+                continue
+            dorsal, nombre, categoria, club, rfid = (str(item.get(c) or '').strip() for c in CAMPOS_INSCRITO)
+            if not (dorsal and nombre and categoria and club):
+                resumen["descartados"] += 1
+                continue
+            resumen["count"] += 1
+            lote.append((resumen["count"], dorsal, nombre, categoria, club, rfid))
+            if len(lote) >= INSCRITOS_LOTE:
+                volcar()
+        if lote:
+            volcar()
+        t_carga = time.perf_counter()
+
+        # Un dorsal repetido en el archivo: gana la última fila
+        cur.execute('''
+            CREATE TEMP TABLE inscritos_nuevos ON COMMIT DROP AS
+            SELECT DISTINCT ON (dorsal) dorsal, nombre, categoria, club, rfid
+            FROM inscritos_carga ORDER BY dorsal, n DESC
+        ''')
+        unicos = cur.rowcount
+        cur.execute('''
+            DELETE FROM inscritos i
+            WHERE i.event_code = %s
+              AND NOT EXISTS (SELECT 1 FROM inscritos_nuevos c WHERE c.dorsal = i.dorsal)
+        ''', (event_code,))
+        resumen["eliminados"] = cur.rowcount
+        cur.execute('''
+            UPDATE inscritos i
+            SET nombre = c.nombre, categoria = c.categoria, club = c.club, rfid = c.rfid
+            FROM inscritos_nuevos c
+            WHERE i.event_code = %s AND i.dorsal = c.dorsal
+              AND (i.nombre, i.categoria, i.club, i.rfid) IS DISTINCT FROM (c.nombre, c.categoria, c.club, c.rfid)
+        ''', (event_code,))
+        resumen["actualizados"] = cur.rowcount
+        cur.execute('''
+            INSERT INTO inscritos (event_code, dorsal, nombre, categoria, club, rfid)
+            SELECT %s, c.dorsal, c.nombre, c.categoria, c.club, c.rfid
+            FROM inscritos_nuevos c
+            WHERE NOT EXISTS (SELECT 1 FROM inscritos i WHERE i.event_code = %s AND i.dorsal = c.dorsal)
+        ''', (event_code, event_code))
+        resumen["insertados"] = cur.rowcount
+        conn.commit()
+        cur.close()
+    t_fin = time.perf_counter()
+    resumen["sin_cambios"] = unicos - resumen["actualizados"] - resumen["insertados"]
+    resumen["tiempos_ms"] = {
+        "carga": round((t_carga - t0) * 1000, 1),
+        "diff": round((t_fin - t_carga) * 1000, 1),
+        "total": round((t_fin - t0) * 1000, 1),
+    }
+    return resumen
+
 @app.route('/api/inscritos/<event_code>', methods=['POST', 'GET'])
 def manejar_inscritos(event_code):
     try:
-        init_db()
         if request.method == 'POST':
-            data = request.get_json()
-            if not isinstance(data, list):
-                return jsonify({"error": "esperaba una lista"}), 400
-
-            conn = get_db_conn()
-            cur = conn.cursor()
-            cur.execute("DELETE FROM inscritos WHERE event_code = %s", (event_code.strip(),))
-            count = 0
-            for item in data:
-                dorsal = str(item.get('dorsal', '')).strip()
-                nombre = str(item.get('nombre', '')).strip()
-                categoria = str(item.get('categoria', '')).strip()
-                club = str(item.get('club', '')).strip()
-                rfid = str(item.get('rfid', '')).strip()
-                if dorsal and nombre and categoria and club:
-                    cur.execute('''
-                        INSERT INTO inscritos (event_code, dorsal, nombre, categoria, club, rfid)
-                        VALUES (%s, %s, %s, %s, %s, %s)
-                    ''', (event_code, dorsal, nombre, categoria, club, rfid))
-                    count += 1
-            conn.commit()
-            cur.close()
-            conn.close()
-            return jsonify({"status": "success", "count": count}), 201
+            try:
+                resumen = importar_inscritos(event_code, leer_inscritos_peticion())
+            except ValueError as e:
+                return jsonify({"error": str(e)}), 400
+            bus.publicar('invalidar', {'event_code': event_code, 'tipos': ['inscritos']})
+            logging.info(f"Inscritos {event_code}: {resumen}")
+            return jsonify({"status": "success", **resumen}), 201
 
         else:  # GET
-            conn = get_db_conn()
-            cur = conn.cursor()
-            cur.execute('''
-                SELECT dorsal, nombre, categoria, club, rfid 
-                FROM inscritos 
-                WHERE event_code = %s 
-                ORDER BY dorsal
-            ''', (event_code,))
-            rows = cur.fetchall()
-            cur.close()
-            conn.close()
-            return jsonify([{
-                "dorsal": r[0], "nombre": r[1], "categoria": r[2], "club": r[3], "rfid": r[4]
-            } for r in rows])
+            return respuesta_cacheada('inscritos', event_code, consultar_inscritos)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# === API: Exportaciones en streaming (memoria constante) ===
+EXPORT_LOTE = int(os.environ.get('EXPORT_LOTE', 2000))   # filas por FETCH del cursor de servidor
+EXPORT_BLOQUE = 1 << 16                                  # bytes acumulados antes de enviar un trozo
+
+def _exportar_tiempos(fila):
+    tiempo_id, dorsal, action, ts_ms, nombre, categoria, club = fila
+    return {"id": tiempo_id, "dorsal": dorsal, "action": action, "timestamp": ms_a_iso(ts_ms),
+            "nombre": nombre, "categoria": categoria, "club": club}
+
+def _exportar_historial(fila):
+    tiempo_id, dorsal, action, ts_ms, reemplazado_por, hit_id = fila
+    return {"id": tiempo_id, "dorsal": dorsal, "action": action, "timestamp": ms_a_iso(ts_ms),
+            "reemplazado_por": reemplazado_por, "hit_id": hit_id}
+
+def _exportar_resultados(fila):
+    pos, dorsal, nombre, categoria, club, salida_ms, llegada_ms, tiempo_ms = fila
+    return {"pos": pos, "dorsal": dorsal, "nombre": nombre, "categoria": categoria, "club": club,
+            "salida": ms_a_iso(salida_ms), "llegada": ms_a_iso(llegada_ms),
+            "tiempo_ms": tiempo_ms, "tiempo": formatear_tiempo(tiempo_ms)}
+
+# datos → (consulta, convertir fila, columnas). Las consultas solo usan el evento como parámetro
+# (más SIN_CATEGORIA en resultados); el orden lo resuelve PostgreSQL, no la memoria del proceso.
+EXPORTACIONES = {
+    'tiempos': ("""
+        SELECT a.tiempo_id, a.dorsal, a.action, a.ts_ms, i.nombre, i.categoria, i.club
+        FROM tiempos_actuales a
+        LEFT JOIN inscritos i ON i.event_code = a.evento AND i.dorsal = a.dorsal
+        WHERE a.evento = %(evento)s
+        ORDER BY a.tiempo_id
+    """, _exportar_tiempos, ('id', 'dorsal', 'action', 'timestamp', 'nombre', 'categoria', 'club')),
+    'historial': ("""
+        SELECT id, dorsal, action, ts_ms, reemplazado_por, hit_id
+        FROM tiempos WHERE evento = %(evento)s
+        ORDER BY id
+    """, _exportar_historial, ('id', 'dorsal', 'action', 'timestamp', 'reemplazado_por', 'hit_id')),
+    # Misma regla que /api/resultados: última salida y última llegada vigentes, llegada >= salida,
+    # empate resuelto por dorsal (orden binario, como en Python)
+    'resultados': ("""
+        SELECT row_number() OVER (PARTITION BY categoria ORDER BY tiempo_ms, dorsal COLLATE "C"),
+               dorsal, nombre, categoria, club, salida_ms, llegada_ms, tiempo_ms
+        FROM (
+            SELECT l.dorsal, i.nombre, COALESCE(NULLIF(i.categoria, ''), %(sin_categoria)s) AS categoria,
+                   i.club, s.ts_ms AS salida_ms, l.ts_ms AS llegada_ms, l.ts_ms - s.ts_ms AS tiempo_ms
+            FROM tiempos_actuales l
+            JOIN tiempos_actuales s ON s.evento = l.evento AND s.dorsal = l.dorsal AND s.action = 'salida'
+            JOIN inscritos i ON i.event_code = l.evento AND i.dorsal = l.dorsal
+            WHERE l.evento = %(evento)s AND l.action = 'llegada' AND l.ts_ms >= s.ts_ms
+        ) r
+        ORDER BY categoria COLLATE "C", tiempo_ms, dorsal COLLATE "C"
+    """, _exportar_resultados, ('pos', 'dorsal', 'nombre', 'categoria', 'club', 'salida', 'llegada', 'tiempo_ms', 'tiempo')),
+}
+
+def filas_exportacion(datos, event_code):
+    """Recorre la consulta con un cursor con nombre (de servidor): solo EXPORT_LOTE filas en memoria."""
+    consulta, convertir, _ = EXPORTACIONES[datos]
+    with conexion_lectura(event_code, nube=True) as conn:
+        with conn.cursor(name=f'exportar_{uuid.uuid4().hex}') as cur:
+            cur.itersize = EXPORT_LOTE
+            cur.execute(consulta, {'evento': event_code, 'sin_categoria': SIN_CATEGORIA})
+            for fila in cur:
+                yield convertir(fila)
+
+def texto_exportacion(formato, columnas, filas):
+    """Serializa en trozos de ~EXPORT_BLOQUE bytes: CSV con cabecera o NDJSON (un objeto por línea)."""
+    buf = io.StringIO()
+    try:
+        if formato == 'csv':
+            escritor = csv.writer(buf, lineterminator='\n')
+            escritor.writerow(columnas)
+            for f in filas:
+                escritor.writerow([f[c] for c in columnas])
+                if buf.tell() >= EXPORT_BLOQUE:
+                    yield buf.getvalue().encode('utf-8')
+                    buf.seek(0)
+                    buf.truncate()
+        else:
+            for f in filas:
+                buf.write(json.dumps(f, ensure_ascii=False, separators=(',', ':')))
+                buf.write('\n')
+                if buf.tell() >= EXPORT_BLOQUE:
+                    yield buf.getvalue().encode('utf-8')
+                    buf.seek(0)
+                    buf.truncate()
+        if buf.tell():
+            yield buf.getvalue().encode('utf-8')
+    finally:
+        filas.close()
+
+def con_primero(primero, trozos):
+    """`primero` seguido de `trozos`, cerrando `trozos` al cerrar la respuesta (p. ej. si el cliente corta)."""
+    try:
+        yield primero
+        yield from trozos
+    finally:
+        trozos.close()
+
+def comprimir_gzip(trozos):
+    z = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31 → formato gzip
+    try:
+        for trozo in trozos:
+            comprimido = z.compress(trozo)
+            if comprimido:
+                yield comprimido
+        yield z.flush()
+    finally:
+        trozos.close()
+
+@app.route('/api/export/<event_code>')
+def exportar(event_code):
+    """
+    Descarga de un evento completo sin cargarlo en memoria:
+      ?datos=tiempos     → tiempos vigentes con nombre, categoría y club (defecto)
+      ?datos=historial   → todas las filas de `tiempos`, también las reemplazadas
+      ?datos=resultados  → tiempo neto y posición por categoría
+      ?formato=csv|ndjson (defecto csv)
+    Si el cliente acepta gzip, la respuesta va comprimida (Content-Encoding: gzip) trozo a trozo.
+    """
+    datos = request.args.get('datos', 'tiempos')
+    formato = request.args.get('formato', 'csv')
+    if datos not in EXPORTACIONES:
+        return jsonify({"error": f"datos debe ser uno de: {', '.join(EXPORTACIONES)}"}), 400
+    if formato not in ('csv', 'ndjson'):
+        return jsonify({"error": "formato debe ser csv o ndjson"}), 400
+
+    trozos = texto_exportacion(formato, EXPORTACIONES[datos][2], filas_exportacion(datos, event_code))
+    # El primer trozo se genera antes de responder: un fallo de la BD aún puede ser un 503/500
+    try:
+        primero = next(trozos, b'')
+    except PoolAgotado as e:
+        return jsonify({"error": str(e)}), 503
     except Exception as e:
+        logging.error(f"Error en /api/export: {e}")
         return jsonify({"error": str(e)}), 500
+    # Cada generador cierra al que consume: al cortar la descarga, response.close() llega hasta
+    # filas_exportacion y el cursor y la conexión vuelven al pool sin esperar al recolector
+    trozos = con_primero(primero, trozos)
+    gzip = request.accept_encodings['gzip'] > 0
+    resp = app.response_class(
+        comprimir_gzip(trozos) if gzip else trozos,
+        mimetype='text/csv' if formato == 'csv' else 'application/x-ndjson'
+    )
+    resp.headers['Content-Disposition'] = f'attachment; filename="{event_code}-{datos}.{formato}"'
+    resp.headers['Vary'] = 'Accept-Encoding'
+    if gzip:
+        resp.headers['Content-Encoding'] = 'gzip'
+    return resp
 
 # === API: Borrar datos ===
 @app.route('/api/flush-event/<event_code>', methods=['DELETE'])
 def flush_event(event_code):
     try:
-        conn = get_db_conn()
-        cur = conn.cursor()
-        cur.execute("DELETE FROM tiempos WHERE evento = %s", (event_code.strip(),))
-        count = cur.rowcount
-        conn.commit()
-        cur.close()
-        conn.close()
+        # El historial se borra desenganchando la partición del evento, no fila a fila. Con la ingesta
+        # del evento detenida: un cruce entre los dos pasos dejaría en tiempos_actuales filas sin historial
+        with pool_db.conexion(autocommit=True) as conn, ingesta_detenida(conn, event_code.strip()) as cur:
+            count = borrar_particion(cur, 'tiempos', event_code.strip())
+            cur.execute("DELETE FROM tiempos_actuales WHERE evento = %s", (event_code.strip(),))
+        if sede is not None:
+            # También lo de la sede, incluidos los cruces aún no subidos
+            sede.borrar_tiempos(event_code.strip())
+        bus.publicar('invalidar', {'event_code': event_code.strip(), 'tipos': ['tiempos']})
         return jsonify({"status": "success", "deleted": count}), 200
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -287,17 +3586,118 @@ def flush_event(event_code):
 @app.route('/api/flush-inscritos/<event_code>', methods=['DELETE'])
 def flush_inscritos(event_code):
     try:
-        conn = get_db_conn()
-        cur = conn.cursor()
-        cur.execute("DELETE FROM inscritos WHERE event_code = %s", (event_code.strip(),))
-        count = cur.rowcount
-        conn.commit()
-        cur.close()
-        conn.close()
+        with pool_db.conexion(autocommit=True) as conn:
+            cur = conn.cursor()
+            count = borrar_particion(cur, 'inscritos', event_code.strip())
+            cur.close()
+        bus.publicar('invalidar', {'event_code': event_code.strip(), 'tipos': ['inscritos']})
         return jsonify({"status": "success", "deleted": count}), 200
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+# === API: Archivo de eventos terminados ===
+# Un evento archivado deja las tablas vivas: su historial, inscritos y puntos quedan en una sola
+# fila de eventos_archivados (JSON por columnas, gzip) y sus particiones se borran.
+COLUMNAS_ARCHIVO = {
+    'tiempos': ("SELECT id, dorsal, action, ts_ms, reemplazado_por, hit_id FROM tiempos WHERE evento = %s ORDER BY id",
+                ('id', 'dorsal', 'action', 'ts_ms', 'reemplazado_por', 'hit_id')),
+    'inscritos': ("SELECT dorsal, nombre, categoria, club, rfid FROM inscritos WHERE event_code = %s ORDER BY id",
+                  ('dorsal', 'nombre', 'categoria', 'club', 'rfid')),
+    'puntos': ("SELECT codigo, orden, nombre, distancia_m FROM puntos_control WHERE evento = %s ORDER BY orden",
+               ('codigo', 'orden', 'nombre', 'distancia_m')),
+}
+
+def documento_archivo(cur, event_code):
+    """El evento completo como {tabla: {columna: [valores]}}, más las filas de cada tabla."""
+    documento = {'event_code': event_code}
+    filas = {}
+    for tabla, (consulta, columnas) in COLUMNAS_ARCHIVO.items():
+        cur.execute(consulta, (event_code,))
+        rows = cur.fetchall()
+        filas[tabla] = len(rows)
+        documento[tabla] = {c: list(valores) for c, valores in zip(columnas, zip(*rows))} if rows else {c: [] for c in columnas}
+    return documento, filas
+
+@app.route('/api/archivar/<event_code>', methods=['POST'])
+def archivar_evento(event_code):
+    event_code = event_code.strip()
+    try:
+        # Con la ingesta del evento detenida de principio a fin (las de los demás eventos siguen):
+        # lo leído es todo lo que hay y nada queda a medias entre el archivo y el borrado
+        with pool_db.conexion() as conn, ingesta_detenida(conn, event_code) as cur:
+            cur.execute("SELECT tiempos, inscritos FROM eventos_archivados WHERE evento = %s", (event_code,))
+            row = cur.fetchone()
+            if row is None:
+                documento, filas = documento_archivo(cur, event_code)
+                datos = gzip_compress(json.dumps(documento, separators=(',', ':')).encode('utf-8'),
+                                      compresslevel=9, mtime=0)
+                cur.execute('''
+                    INSERT INTO eventos_archivados (evento, tiempos, inscritos, datos)
+                    VALUES (%s, %s, %s, %s)
+                ''', (event_code, filas['tiempos'], filas['inscritos'], psycopg2.Binary(datos)))
+                row = (filas['tiempos'], filas['inscritos'])
+            else:
+                # Ya archivado: si quedan exactamente las filas archivadas es un intento anterior que
+                # falló tras guardar el archivo y solo falta la limpieza; si no, son datos nuevos
+                cur.execute('''
+                    SELECT (SELECT count(*) FROM tiempos WHERE evento = %s),
+                           (SELECT count(*) FROM inscritos WHERE event_code = %s)
+                ''', (event_code, event_code))
+                vivas = cur.fetchone()
+                if vivas != (0, 0) and vivas != row:
+                    return jsonify({"error": "evento ya archivado y con datos nuevos"}), 409
+            cur.execute("DELETE FROM tiempos_actuales WHERE evento = %s", (event_code,))
+            cur.execute("DELETE FROM puntos_control WHERE evento = %s", (event_code,))
+            conn.commit()
+            conn.autocommit = True  # DETACH ... CONCURRENTLY no admite transacción
+            borrar_particion(cur, 'tiempos', event_code)
+            borrar_particion(cur, 'inscritos', event_code)
+        bus.publicar('invalidar', {'event_code': event_code, 'tipos': ['tiempos', 'inscritos', 'puntos']})
+        return jsonify({"status": "success", "event_code": event_code, "tiempos": row[0], "inscritos": row[1]}), 200
+    except PoolAgotado as e:
+        return jsonify({"error": str(e)}), 503
+    except Exception as e:
+        logging.error(f"Error en /api/archivar: {e}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/archivo', methods=['GET'])
+def listar_archivo():
+    try:
+        with conexion_lectura(nube=True) as conn:
+            cur = conn.cursor()
+            cur.execute('''
+                SELECT evento, archivado_en, tiempos, inscritos, octet_length(datos)
+                FROM eventos_archivados ORDER BY archivado_en DESC
+            ''')
+            rows = cur.fetchall()
+            cur.close()
+        return jsonify([{
+            "event_code": r[0], "archivado_en": r[1].isoformat(), "tiempos": r[2], "inscritos": r[3], "bytes": r[4]
+        } for r in rows]), 200
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/archivo/<event_code>', methods=['GET'])
+def descargar_archivo(event_code):
+    """Se sirve tal como está guardado (gzip); solo se descomprime si el cliente no acepta gzip."""
+    try:
+        with conexion_lectura(nube=True) as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT datos FROM eventos_archivados WHERE evento = %s", (event_code.strip(),))
+            row = cur.fetchone()
+            cur.close()
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+    if row is None:
+        return jsonify({"error": "evento no archivado"}), 404
+    gzip = request.accept_encodings['gzip'] > 0
+    datos = bytes(row[0])
+    resp = app.response_class(datos if gzip else gzip_decompress(datos), mimetype='application/json')
+    resp.headers['Vary'] = 'Accept-Encoding'
+    if gzip:
+        resp.headers['Content-Encoding'] = 'gzip'
+    return resp
+
 # === Página principal ===
 @app.route('/')
 def home():
@@ -308,297 +3708,236 @@ def home():
     <p>✅ Formato Copa del Mundo<br>✅ Logo personalizable<br>✅ Agrupado por categoría</p>
     '''
 
-# === Pantalla en vivo — CRONOANDES (Formato Copa del Mundo) ===
-@app.route('/pantalla')
-def pantalla_vivo():
-    return '''
-<!DOCTYPE html>
-<html lang="es">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>🏆 CronoAndes — Resultados en Vivo</title>
-    <style>
-        body {
-            font-family: 'Segoe UI', 'Helvetica Neue', Arial, sans-serif;
-            background: #0f172a;
-            color: white;
-            margin: 0;
-            padding: 0;
-            overflow-x: hidden;
-        }
-        .header {
-            text-align: center;
-            padding: 1rem;
-            background: #1e293b;
-            border-bottom: 3px solid #38bdf8;
-        }
-        .logo {
-            max-height: 70px;
-            margin-bottom: 12px;
-            border-radius: 6px;
-        }
-        .header h1 {
-            font-size: 2.0rem;
-            margin: 0.5rem 0;
-            color: white;
-            text-shadow: 0 0 8px rgba(56, 189, 248, 0.6);
-        }
-        .contador-maestro {
-            font-size: 1.3rem;
-            font-weight: bold;
-            color: #60a5fa;
-            margin-top: 0.5rem;
-            font-family: 'Courier New', monospace;
-        }
-        .categoria-seccion {
-            margin: 2rem 1rem;
-            border: 1px solid #334155;
-            border-radius: 10px;
-            background: #1e293b;
-            box-shadow: 0 4px 6px rgba(0,0,0,0.3);
-        }
-        .categoria-titulo {
-            background: #0f172a;
-            color: #f8fafc;
-            padding: 14px;
-            font-size: 1.5rem;
-            font-weight: bold;
-            text-align: center;
-            border-bottom: 2px solid #38bdf8;
-        }
-        table {
-            width: 100%;
-            border-collapse: collapse;
-            table-layout: fixed;
-            margin-top: 8px;
-        }
-        th, td {
-            padding: 12px 10px;
-            text-align: center;
-            font-size: 1.2rem;
-            overflow: hidden;
-            text-overflow: ellipsis;
-            white-space: nowrap;
-        }
-        th {
-            background: #0f172a;
-            color: #94a3b8;
-            font-weight: bold;
-            font-size: 1.1rem;
-        }
-        .finalizado {
-            background-color: #1e293b !important;
-            color: #60a5fa !important;
-        }
-        .pos { width: 8%; }
-        .dorsal { width: 15%; }
-        .nombre { width: 35%; }
-        .categoria-col { width: 22%; }
-        .tiempo { width: 20%; }
-    </style>
-</head>
-<body>
-    <div class="header">
-        <img id="logo" class="logo" style="display:none;">
-        <h1>🏆 CronoAndes — Resultados en Vivo</h1>
-        <div class="contador-maestro">⏰ Cargando resultados en vivo...</div>
-    </div>
-    <div id="contenedor-categorias"></div>
-
-    <script>
-    document.addEventListener('DOMContentLoaded', function() {
-        const urlParams = new URLSearchParams(window.location.search);
-        let eventCode = urlParams.get('event_code');
-        const logoUrl = urlParams.get('logo_url');
-
-        if (logoUrl) {
-            const img = document.getElementById('logo');
-            img.src = logoUrl;
-            img.style.display = 'block';
-        }
+# === Recursos estáticos: /pantalla y el cliente Socket.IO, precomprimidos al arrancar ===
+ESTATICOS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+ESTATICOS_TIPOS = {'.html': 'text/html', '.js': 'text/javascript', '.css': 'text/css',
+                   '.txt': 'text/plain'}  # Flask añade charset=utf-8
+UN_ANO = 365 * 24 * 3600
 
-        if (!eventCode) {
-            eventCode = prompt("Ingresa el código del evento:");
-            if (!eventCode) {
-                document.body.innerHTML = '<div style="color:white;text-align:center;padding:4rem;font-size:1.5rem;background:#0f172a;">❌ Código del evento requerido</div>';
-                return;
-            }
-            let newUrl = `${window.location.pathname}?event_code=${encodeURIComponent(eventCode)}`;
-            if (logoUrl) newUrl += `&logo_url=${encodeURIComponent(logoUrl)}`;
-            window.history.replaceState(null, null, newUrl);
-        }
+RecursoEstatico = namedtuple('RecursoEstatico', 'version tipo variantes')  # variantes: codificación → bytes
 
-        const socket = io(window.location.origin, { transports: ['websocket'] });
-        socket.emit('subscribe', { event_code: eventCode });
-
-        let registros = {};
-        let inscritos = {};
-        let inicioOficial = null;
-        let intervalId = null;
-
-        function formatearCronometroMaestro(ms) {
-            if (ms == null || ms < 0) return '00:00.000';
-            const totalSegundos = ms / 1000;
-            const mins = Math.floor(totalSegundos / 60);
-            const segs = Math.floor(totalSegundos % 60);
-            const milis = Math.floor(ms % 1000);
-            return `${mins.toString().padStart(2, '0')}:${segs.toString().padStart(2, '0')}.${milis.toString().padStart(3, '0')}`;
-        }
+def cargar_estaticos(directorio):
+    """
+    Lee static/ una vez por proceso (antes de crear workers, así lo comparten): cada archivo queda
+    en memoria en identity, gzip y br, con su versión (hash del contenido). En los .html,
+    {{archivo}} se sustituye por la URL versionada de ese archivo, que se sirve como inmutable.
+    """
+    recursos = {}
+    nombres = sorted(os.listdir(directorio), key=lambda n: n.endswith('.html'))  # los .html al final
+    for nombre in nombres:
+        with open(os.path.join(directorio, nombre), 'rb') as f:
+            cuerpo = f.read()
+        if nombre.endswith('.html'):
+            for otro, recurso in recursos.items():
+                cuerpo = cuerpo.replace(f'{{{{{otro}}}}}'.encode(), f'/static/{recurso.version}/{otro}'.encode())
+        variantes = {'identity': cuerpo}
+        if len(cuerpo) >= COMPRESION_MIN:
+            variantes['gzip'] = gzip_compress(cuerpo, compresslevel=9, mtime=0)
+            if brotli is not None:
+                variantes['br'] = brotli.compress(cuerpo, quality=11)
+        tipo = ESTATICOS_TIPOS.get(os.path.splitext(nombre)[1], 'application/octet-stream')
+        recursos[nombre] = RecursoEstatico(hashlib.blake2b(cuerpo, digest_size=8).hexdigest(), tipo, variantes)
+    return recursos
 
-        function formatearTiempoCompetidor(ms) {
-            if (ms == null) return '';
-            const totalSegundos = ms / 1000;
-            const mins = Math.floor(totalSegundos / 60);
-            const segs = Math.floor(totalSegundos % 60);
-            const milis = Math.floor(ms % 1000);
-            return `${mins.toString().padStart(2, '0')}:${segs.toString().padStart(2, '0')}.${milis.toString().padStart(3, '0')}`;
-        }
+estaticos = cargar_estaticos(ESTATICOS_DIR)
 
-        function calcularTiempo(dorsal) {
-            const r = registros[dorsal] || { salidas: [], llegadas: [] };
-            if (!r.salidas.length || !r.llegadas.length) return null;
-            const lastSalida = r.salidas[r.salidas.length - 1];
-            const lastLlegada = r.llegadas[r.llegadas.length - 1];
-            const s = new Date(lastSalida.endsWith('Z') ? lastSalida : lastSalida + 'Z');
-            const l = new Date(lastLlegada.endsWith('Z') ? lastLlegada : lastLlegada + 'Z');
-            if (isNaN(s) || isNaN(l) || l < s) return null;
-            return l - s;
-        }
+def servir_estatico(nombre, inmutable=False):
+    recurso = estaticos.get(nombre)
+    if recurso is None:
+        return jsonify({"error": "no encontrado"}), 404
+    codificacion = request.accept_encodings.best_match([c for c in ('br', 'gzip') if c in recurso.variantes]) or 'identity'
+    resp = app.response_class(recurso.variantes[codificacion], mimetype=recurso.tipo)
+    resp.set_etag(recurso.version if codificacion == 'identity' else f"{recurso.version}-{codificacion}")
+    resp.headers['Vary'] = 'Accept-Encoding'
+    # Con la versión en la URL el contenido no cambia nunca; sin ella hay que revalidar (304 si sigue igual)
+    resp.headers['Cache-Control'] = f'public, max-age={UN_ANO}, immutable' if inmutable else 'no-cache'
+    if codificacion != 'identity':
+        resp.headers['Content-Encoding'] = codificacion
+    return resp.make_conditional(request)
 
-        function procesar(t) {
-            if (!registros[t.dorsal]) registros[t.dorsal] = { salidas: [], llegadas: [] };
-            const tsNorm = t.timestamp.endsWith('Z') ? t.timestamp : t.timestamp + 'Z';
-            const eventoTime = new Date(tsNorm);
-
-            if (t.action === 'salida') {
-                registros[t.dorsal].salidas.push(t.timestamp);
-                if (!inicioOficial) {
-                    inicioOficial = eventoTime;
-                    if (!intervalId) {
-                        intervalId = setInterval(() => {
-                            if (inicioOficial) {
-                                const ahora = new Date();
-                                const transcurrido = ahora - inicioOficial;
-                                document.querySelector('.contador-maestro').textContent = 
-                                    `⏱️ En vivo: ${formatearCronometroMaestro(transcurrido)}`;
-                            }
-                        }, 20);
-                    }
-                }
-            } else if (t.action === 'llegada') {
-                registros[t.dorsal].llegadas.push(t.timestamp);
-            }
-
-            if (t.nombre && !inscritos[t.dorsal]) {
-                inscritos[t.dorsal] = {
-                    dorsal: t.dorsal,
-                    nombre: t.nombre,
-                    categoria: t.categoria || 'SIN CATEGORÍA'
-                };
-            }
-        }
+@app.route('/static/<version>/<nombre>')
+def estatico_versionado(version, nombre):
+    recurso = estaticos.get(nombre)
+    # Una versión antigua (página cacheada de antes de un despliegue) recibe el contenido actual, sin caché larga
+    return servir_estatico(nombre, inmutable=recurso is not None and recurso.version == version)
 
-        function renderizar() {
-            const competidores = Object.keys(inscritos).map(d => {
-                const tiempo = calcularTiempo(d);
-                return tiempo !== null ? {
-                    dorsal: d,
-                    nombre: inscritos[d].nombre,
-                    categoria: inscritos[d].categoria,
-                    tiempo: tiempo
-                } : null;
-            }).filter(Boolean);
-
-            const porCategoria = {};
-            competidores.forEach(c => {
-                if (!porCategoria[c.categoria]) porCategoria[c.categoria] = [];
-                porCategoria[c.categoria].push(c);
-            });
-
-            Object.keys(porCategoria).forEach(cat => {
-                porCategoria[cat].sort((a, b) => a.tiempo - b.tiempo);
-                porCategoria[cat].forEach((c, i) => c.pos = i + 1);
-            });
-
-            const categoriasOrdenadas = Object.keys(porCategoria).sort();
-
-            let html = '';
-            if (categoriasOrdenadas.length === 0) {
-                html = '<div style="text-align:center;padding:2.5rem;color:#94a3b8;font-size:1.2rem;">Esperando primeros tiempos...</div>';
-            } else {
-                categoriasOrdenadas.forEach(cat => {
-                    const filas = porCategoria[cat].map(f => `
-                        <tr class="finalizado">
-                            <td class="pos">${f.pos}</td>
-                            <td class="dorsal">${f.dorsal}</td>
-                            <td class="nombre">${f.nombre}</td>
-                            <td class="categoria-col">${f.categoria}</td>
-                            <td class="tiempo">${formatearTiempoCompetidor(f.tiempo)}</td>
-                        </tr>
-                    `).join('');
-                    html += `
-                        <div class="categoria-seccion">
-                            <div class="categoria-titulo">${cat}</div>
-                            <table>
-                                <thead>
-                                    <tr>
-                                        <th class="pos">Pos</th>
-                                        <th class="dorsal">Dorsal</th>
-                                        <th class="nombre">Nombre</th>
-                                        <th class="categoria-col">Categoría</th>
-                                        <th class="tiempo">Tiempo</th>
-                                    </tr>
-                                </thead>
-                                <tbody>${filas}</tbody>
-                            </table>
-                        </div>
-                    `;
-                });
-            }
-
-            document.getElementById('contenedor-categorias').innerHTML = html;
-        }
+@app.route('/static/<nombre>')
+def estatico(nombre):
+    return servir_estatico(nombre)
 
-        Promise.all([
-            fetch(`/api/inscritos/${encodeURIComponent(eventCode)}`).then(r => r.ok ? r.json() : []),
-            fetch(`/api/tiempos/${encodeURIComponent(eventCode)}`).then(r => r.ok ? r.json() : [])
-        ]).then(([inscritosData, tiemposData]) => {
-            inscritos = {};
-            inscritosData.forEach(p => {
-                inscritos[p.dorsal] = {
-                    dorsal: p.dorsal,
-                    nombre: p.nombre,
-                    categoria: p.categoria || 'SIN CATEGORÍA'
-                };
-            });
-            tiemposData.forEach(t => procesar(t));
-            renderizar();
-        }).catch(err => {
-            console.error("Error al cargar datos iniciales:", err);
-        });
-
-        socket.on('nuevo_tiempo', (d) => {
-            procesar(d);
-            renderizar();
-        });
-    });
-    </script>
-    <script src="https://cdn.socket.io/4.7.4/socket.io.min.js"></script>
-</body>
-</html>
-    '''
+# === Pantalla en vivo — CRONOANDES (Formato Copa del Mundo) ===
+@app.route('/pantalla')
+def pantalla_vivo():
+    return servir_estatico('pantalla.html')
 
 # === Health check ===
 @app.route('/health')
 def health():
     try:
-        init_db()
-        return jsonify({"status": "ok", "app": "CronoAndes", "websocket_ready": True})
+        # Una sede responde aunque no haya enlace con la nube (ver "sede")
+        with (sede.conexion() if sede is not None else pool_db.conexion(autocommit=True)) as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            cur.close()
+        return jsonify({
+            "status": "ok",
+            "app": "CronoAndes",
+            "websocket_ready": True,
+            "pid": os.getpid(),
+            "db_pool": pool_db.estado(),
+            "db_lectura": {**pool_lectura.estado(),
+                           "replica": monitor_replica.estado() if monitor_replica is not None else None,
+                           "primario": pool_lectura_primario.estado() if pool_lectura_primario is not None else None},
+            "cache": cache_payloads.estado(),
+            "difusion": difusor.estado(),
+            "bus": bus.estado(),
+            "escrituras": escrituras_evento.estado(),
+            "diario": diario.estado() if diario is not None else None,
+            "rfid": antirrebote.estado(),
+            "dispositivos": [c.estado() for c in list(canales_dispositivos.values())],
+            "sede": sede.estado() if sede is not None else None
+        })
     except Exception as e:
         return jsonify({"status": "error", "msg": str(e)}), 500
 
+# === Lecturas: leer lo propio tras escribir ===
+@app.after_request
+def marcar_escritura(respuesta):
+    """
+    Con réplica de lectura, cada escritura confirmada devuelve el instante (ms epoch) en la cabecera
+    X-Crono-Escritura y en una cookie; las lecturas que lo traen no van a una réplica que aún no lo refleje.
+    """
+    if monitor_replica is not None and request.method in ('POST', 'PUT', 'DELETE') and respuesta.status_code < 400:
+        instante = str(time.time_ns() // 1000000)
+        respuesta.headers['X-Crono-Escritura'] = instante
+        respuesta.set_cookie(COOKIE_ESCRITURA, instante, max_age=60, httponly=True, samesite='Lax')
+    return respuesta
+
+# === Métricas ===
+@app.after_request
+def medir_peticion(respuesta):
+    inicio = g.get('inicio')
+    if inicio is not None:
+        # Plantilla de la ruta (no la URL) para no crear una serie por evento; en las respuestas
+        # en streaming cuenta hasta el primer trozo
+        ruta = request.url_rule.rule if request.url_rule is not None else 'sin_ruta'
+        m_http.observar(time.perf_counter() - inicio, ruta, request.method, respuesta.status_code)
+    return respuesta
+
+def suscriptores_por_sala():
+    """Clientes Socket.IO de este proceso en cada sala de evento (sin las salas propias de cada sid)."""
+    salas = socketio.server.manager.rooms.get('/', {})
+    return {(sala,): len(sids) for sala, sids in list(salas.items())
+            if sala is not None and sala not in sids}
+
+MetricaLeida('crono_socket_suscriptores', 'Clientes Socket.IO suscritos por sala', 'gauge',
+             suscriptores_por_sala, ('sala',))
+MetricaLeida('crono_difusion_cola', 'Cruces esperando difusión por sala', 'gauge',
+             lambda: {(ev,): len(c) for ev, c in list(difusor._colas.items())}, ('sala',))
+MetricaLeida('crono_difusion_envios_total', 'Lotes emitidos por el difusor', 'counter',
+             lambda: {(): difusor.envios})
+MetricaLeida('crono_difusion_descartados_total', 'Cruces descartados por desbordes de cola', 'counter',
+             lambda: {(): difusor.descartados})
+MetricaLeida('crono_difusion_omitidos_lentos_total', 'Envíos omitidos a clientes lentos', 'counter',
+             lambda: {(): difusor.omitidos_lentos})
+MetricaLeida('crono_db_pool_conexiones', 'Conexiones de cada pool por estado', 'gauge',
+             lambda: {(p.nombre, estado): n for p in pools_db
+                      for estado, n in (('en_uso', p.en_uso), ('libres', len(p._libres)))}, ('pool', 'estado'))
+MetricaLeida('crono_db_conexiones_creadas_total', 'Conexiones abiertas por cada pool', 'counter',
+             lambda: {(p.nombre,): p.creadas for p in pools_db}, ('pool',))
+MetricaLeida('crono_db_replica_retraso_segundos', 'Antigüedad de lo último que la réplica de lectura refleja', 'gauge',
+             lambda: {(): max(time.time() - monitor_replica.al_dia, 0)}
+             if monitor_replica is not None and monitor_replica.disponible else {})
+MetricaLeida('crono_db_viajes_total', 'Viajes a la BD (sentencias, BEGIN y COMMIT)', 'counter',
+             lambda: {(): ConexionContada.viajes})
+MetricaLeida('crono_cache_consultas_total', 'Consultas a la caché de payloads', 'counter',
+             lambda: {('acierto',): cache_payloads.aciertos, ('fallo',): cache_payloads.fallos}, ('resultado',))
+MetricaLeida('crono_cache_bytes', 'Bytes ocupados por la caché de payloads', 'gauge',
+             lambda: {(): cache_payloads.bytes})
+MetricaLeida('crono_bus_mensajes_total', 'Mensajes del bus entre workers', 'counter',
+             lambda: {('enviado',): bus.enviados, ('recibido',): bus.recibidos}, ('sentido',))
+MetricaLeida('crono_diario_pendientes', 'Cruces en el diario aún no escritos en la BD', 'gauge',
+             lambda: {(): diario.pendientes} if diario is not None else {})
+MetricaLeida('crono_rfid_lecturas_total', 'Lecturas RFID recibidas', 'counter',
+             lambda: {(): antirrebote.lecturas})
+MetricaLeida('crono_rfid_cruces_total', 'Cruces generados desde lecturas RFID', 'counter',
+             lambda: {(): antirrebote.cruces})
+MetricaLeida('crono_dispositivos_conectados', 'Dispositivos conectados al canal /dispositivos', 'gauge',
+             lambda: {(): len(canales_dispositivos)})
+MetricaLeida('crono_dispositivos_en_vuelo', 'Mensajes de dispositivos recibidos y aún sin ack', 'gauge',
+             lambda: {(): sum(c.en_vuelo for c in list(canales_dispositivos.values()))})
+MetricaLeida('crono_sede_pendientes', 'Cruces de la sede aún no subidos a la nube', 'gauge',
+             lambda: {(): sede.estado()["pendientes"]} if sede is not None else {})
+
+@app.route('/metrics')
+def metrics():
+    return exponer_metricas(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
 # === Iniciar ===
+def servir_workers(port, workers):
+    """
+    Varios procesos gevent aceptando conexiones del mismo socket. Las salas Socket.IO son locales
+    a cada proceso; los cruces llegan a todas las pantallas porque cada worker los recibe por el
+    bus y los difunde a sus propios clientes. La pantalla conecta por websocket, así que no hacen
+    falta sesiones pegajosas; el respaldo por long-polling sí las necesita (ver README).
+    """
+    from gevent import pywsgi
+    from geventwebsocket.handler import WebSocketHandler
+
+    directorio_bus = None
+    if type(bus) is BusLocal:
+        directorio_bus = os.path.join(tempfile.gettempdir(), f'cronoandes-bus-{os.getpid()}')
+        configurar_bus(f"unix://{directorio_bus}")
+    for pool in pools_db:
+        pool.cerrar()  # no heredar conexiones abiertas por el proceso padre
+
+    listener = pywsgi.WSGIServer.get_listener(('0.0.0.0', port), family=gevent.socket.AF_INET)
+    hijos = set()
+
+    def lanzar():
+        pid = gevent.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            asegurar_servicios()
+            pywsgi.WSGIServer(listener, app, handler_class=WebSocketHandler).serve_forever()
+            os._exit(0)
+        hijos.add(pid)
+
+    def terminar(signum, frame):
+        for pid in hijos:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        if directorio_bus:
+            shutil.rmtree(directorio_bus, ignore_errors=True)
+        sys.exit(0)
+
+    for _ in range(workers):
+        lanzar()
+    signal.signal(signal.SIGTERM, terminar)
+    signal.signal(signal.SIGINT, terminar)
+    logging.info(f"CronoAndes con {workers} workers en el puerto {port} (bus: {type(bus).__name__})")
+    while True:
+        pid, estado = os.wait()
+        hijos.discard(pid)
+        logging.warning(f"Worker {pid} terminó (estado {estado}); se reinicia")
+        time.sleep(1)
+        lanzar()
+
 if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'migrate':
+        init_db()
+        logging.info("Esquema de base de datos actualizado")
+        sys.exit(0)
+    # Con DB_AUTO_MIGRAR=0 el esquema se prepara solo con `python main.py migrate`. En una sede lo
+    # prepara la sincronización: sin enlace también debe arrancar
+    if DB_AUTO_MIGRAR and sede is None:
+        asegurar_esquema()
     port = int(os.environ.get('PORT', 5000))
-    socketio.run(app, host='0.0.0.0', port=port)
+    if WORKERS > 1:
+        servir_workers(port, WORKERS)
+    else:
+        asegurar_servicios()
+        socketio.run(app, host='0.0.0.0', port=port)
@@ -0,0 +1,342 @@
+// Pantalla en vivo de CronoAndes: clasificación por categoría actualizada por Socket.IO
+
+document.addEventListener('DOMContentLoaded', function() {
+    const urlParams = new URLSearchParams(window.location.search);
+    let eventCode = urlParams.get('event_code');
+    const logoUrl = urlParams.get('logo_url');
+
+    if (logoUrl) {
+        const img = document.getElementById('logo');
+        img.src = logoUrl;
+        img.style.display = 'block';
+    }
+
+    if (!eventCode) {
+        eventCode = prompt("Ingresa el código del evento:");
+        if (!eventCode) {
+            document.body.innerHTML = '<div style="color:white;text-align:center;padding:4rem;font-size:1.5rem;background:#0f172a;">❌ Código del evento requerido</div>';
+            return;
+        }
+        let newUrl = `${window.location.pathname}?event_code=${encodeURIComponent(eventCode)}`;
+        if (logoUrl) newUrl += `&logo_url=${encodeURIComponent(logoUrl)}`;
+        window.history.replaceState(null, null, newUrl);
+    }
+
+    // Websocket primero; si la red o un proxy lo cortan, long-polling HTTP (ver README, "Varios workers")
+    const socket = io(window.location.origin, { transports: ['websocket', 'polling'], tryAllTransports: true });
+
+    // Las categorías largas se paginan: solo existen en el DOM las filas de la página visible
+    const FILAS = parseInt(urlParams.get('filas'), 10) || 20;
+    const ROTACION_MS = (parseFloat(urlParams.get('rotacion')) || 8) * 1000;
+
+    let registros = {};         // dorsal → { salida: {id, ms}, llegada: {id, ms} } (los vigentes)
+    let inscritos = {};
+    let clasificados = {};      // dorsal → { categoria, tiempo } con que figura en su categoría
+    let categorias = {};        // nombre → { nombre, lista: [{dorsal, tiempo}] ordenada, seccion, filas, pagina, desde }
+    let orden = [];             // nombres de categoría en el orden de la pantalla
+    const sucias = new Set();   // categorías a repintar en el próximo frame
+    let pintadoPendiente = false;
+    let inicioOficial = null;   // ms epoch de la primera salida
+    let cursor = 0;             // mayor tiempos.id aplicado sin huecos
+    let ultimoEmitido = null;   // último cursor recibido por socket
+    let cargado = false;
+    let inscritosEtag = null;   // versión de los inscritos recibida por socket
+
+    const contenedor = document.getElementById('contenedor-categorias');
+    const aviso = document.getElementById('aviso');
+    const reloj = document.querySelector('.contador-maestro');
+
+    function formatearCronometroMaestro(ms) {
+        if (ms == null || ms < 0) return '00:00.000';
+        const totalSegundos = ms / 1000;
+        const mins = Math.floor(totalSegundos / 60);
+        const segs = Math.floor(totalSegundos % 60);
+        const milis = Math.floor(ms % 1000);
+        return `${mins.toString().padStart(2, '0')}:${segs.toString().padStart(2, '0')}.${milis.toString().padStart(3, '0')}`;
+    }
+
+    function formatearTiempoCompetidor(ms) {
+        if (ms == null) return '';
+        const totalSegundos = ms / 1000;
+        const mins = Math.floor(totalSegundos / 60);
+        const segs = Math.floor(totalSegundos % 60);
+        const milis = Math.floor(ms % 1000);
+        return `${mins.toString().padStart(2, '0')}:${segs.toString().padStart(2, '0')}.${milis.toString().padStart(3, '0')}`;
+    }
+
+    // Reloj maestro: un texto por frame, sin temporizadores propios
+    let textoReloj = '';
+    function tic() {
+        const texto = `⏱️ En vivo: ${formatearCronometroMaestro(Date.now() - inicioOficial)}`;
+        if (texto !== textoReloj) reloj.textContent = textoReloj = texto;
+        requestAnimationFrame(tic);
+    }
+
+    function calcularTiempo(dorsal) {
+        const r = registros[dorsal];
+        if (!r || !r.salida || !r.llegada || r.llegada.ms < r.salida.ms) return null;
+        return r.llegada.ms - r.salida.ms;
+    }
+
+    // Guarda un cruce si es el vigente de su (dorsal, action); true si algo cambió
+    function aplicarCruce(id, dorsal, action, ms) {
+        if (action !== 'salida' && action !== 'llegada') return false;
+        const r = registros[dorsal] || (registros[dorsal] = {});
+        if (r[action] && r[action].id >= id) return false;
+        r[action] = { id, ms };
+        if (action === 'salida' && inicioOficial === null) {
+            inicioOficial = ms;
+            requestAnimationFrame(tic);
+        }
+        return true;
+    }
+
+    function quitarCruce(id, dorsal, action) {
+        const r = registros[dorsal];
+        if (!r || !r[action] || r[action].id !== id) return false;
+        delete r[action];
+        return true;
+    }
+
+    // Posición de (tiempo, dorsal) en una lista ordenada, como la clasificación del servidor
+    function buscar(lista, tiempo, dorsal) {
+        let lo = 0, hi = lista.length;
+        while (lo < hi) {
+            const m = (lo + hi) >> 1;
+            const f = lista[m];
+            if (f.tiempo < tiempo || (f.tiempo === tiempo && f.dorsal < dorsal)) lo = m + 1;
+            else hi = m;
+        }
+        return lo;
+    }
+
+    function categoria(nombre) {
+        return categorias[nombre] || (categorias[nombre] = {
+            nombre, lista: [], seccion: null, titulo: null, cuerpo: null, filas: [], pagina: 0, desde: 0
+        });
+    }
+
+    function marcar(c, desde) {
+        c.desde = Math.min(c.desde, desde);
+        sucias.add(c);
+        if (!pintadoPendiente) {
+            pintadoPendiente = true;
+            requestAnimationFrame(pintar);
+        }
+    }
+
+    // Mueve un dorsal dentro de (o entre) sus categorías: O(log n) más un desplazamiento del array
+    function reclasificar(dorsal) {
+        const previo = clasificados[dorsal];
+        const ins = inscritos[dorsal];
+        const tiempo = ins ? calcularTiempo(dorsal) : null;
+        if (previo && tiempo !== null && previo.categoria === ins.categoria && previo.tiempo === tiempo) return;
+        if (previo) {
+            const c = categorias[previo.categoria];
+            const i = buscar(c.lista, previo.tiempo, dorsal);
+            c.lista.splice(i, 1);
+            marcar(c, i);
+            delete clasificados[dorsal];
+        }
+        if (tiempo === null) return;
+        const c = categoria(ins.categoria);
+        const i = buscar(c.lista, tiempo, dorsal);
+        c.lista.splice(i, 0, { dorsal, tiempo });
+        clasificados[dorsal] = { categoria: ins.categoria, tiempo };
+        marcar(c, i);
+    }
+
+    // Tras cargar todo de una vez o cambiar los inscritos: listas nuevas, un sort por categoría
+    function reconstruir() {
+        Object.values(categorias).forEach(c => { c.lista = []; });
+        clasificados = {};
+        Object.keys(registros).forEach(dorsal => {
+            const ins = inscritos[dorsal];
+            const tiempo = ins ? calcularTiempo(dorsal) : null;
+            if (tiempo === null) return;
+            categoria(ins.categoria).lista.push({ dorsal, tiempo });
+            clasificados[dorsal] = { categoria: ins.categoria, tiempo };
+        });
+        Object.values(categorias).forEach(c => {
+            c.lista.sort((a, b) => a.tiempo - b.tiempo || (a.dorsal < b.dorsal ? -1 : a.dorsal > b.dorsal ? 1 : 0));
+            marcar(c, 0);
+        });
+    }
+
+    function crearSeccion(c) {
+        c.seccion = document.createElement('div');
+        c.seccion.className = 'categoria-seccion';
+        c.seccion.innerHTML = `
+            <div class="categoria-titulo"><span></span><span class="rango"></span></div>
+            <table>
+                <thead>
+                    <tr>
+                        <th class="pos">Pos</th>
+                        <th class="dorsal">Dorsal</th>
+                        <th class="nombre">Nombre</th>
+                        <th class="categoria-col">Categoría</th>
+                        <th class="tiempo">Tiempo</th>
+                    </tr>
+                </thead>
+                <tbody></tbody>
+            </table>`;
+        c.seccion.firstElementChild.firstElementChild.textContent = c.nombre;
+        c.titulo = c.seccion.querySelector('.rango');
+        c.cuerpo = c.seccion.querySelector('tbody');
+        // Categorías en orden alfabético: se inserta antes de la siguiente ya existente
+        let lo = 0, hi = orden.length;
+        while (lo < hi) {
+            const m = (lo + hi) >> 1;
+            if (orden[m] < c.nombre) lo = m + 1; else hi = m;
+        }
+        const siguiente = orden[lo] !== undefined ? categorias[orden[lo]].seccion : null;
+        orden.splice(lo, 0, c.nombre);
+        contenedor.insertBefore(c.seccion, siguiente);
+    }
+
+    function quitarSeccion(c) {
+        if (c.seccion) {
+            c.seccion.remove();
+            orden.splice(orden.indexOf(c.nombre), 1);
+        }
+        delete categorias[c.nombre];
+    }
+
+    function fila(c, i) {
+        let tr = c.filas[i];
+        if (!tr) {
+            tr = document.createElement('tr');
+            tr.className = 'finalizado';
+            ['pos', 'dorsal', 'nombre', 'categoria-col', 'tiempo'].forEach(clase => {
+                const td = document.createElement('td');
+                td.className = clase;
+                tr.appendChild(td);
+            });
+            tr.valores = [];
+            c.cuerpo.appendChild(tr);
+            c.filas[i] = tr;
+        }
+        return tr;
+    }
+
+    // Repinta solo las filas visibles desde la primera que cambió; cada celda solo si su texto cambia
+    function pintarCategoria(c) {
+        const total = c.lista.length;
+        if (!total) return quitarSeccion(c);
+        if (!c.seccion) crearSeccion(c);
+        const paginas = Math.ceil(total / FILAS);
+        if (c.pagina >= paginas) {
+            c.pagina = 0;
+            c.desde = 0;
+        }
+        const inicio = c.pagina * FILAS;
+        const visibles = Math.min(FILAS, total - inicio);
+        for (let i = Math.max(c.desde - inicio, 0); i < visibles; i++) {
+            const f = c.lista[inicio + i];
+            const ins = inscritos[f.dorsal];
+            const tr = fila(c, i);
+            const valores = [String(inicio + i + 1), f.dorsal, ins.nombre, ins.categoria, formatearTiempoCompetidor(f.tiempo)];
+            for (let k = 0; k < valores.length; k++) {
+                if (tr.valores[k] !== valores[k]) tr.cells[k].textContent = tr.valores[k] = valores[k];
+            }
+            if (tr.hidden) tr.hidden = false;
+        }
+        for (let i = visibles; i < c.filas.length; i++) {
+            if (!c.filas[i].hidden) c.filas[i].hidden = true;
+        }
+        const rango = paginas > 1 ? `${inicio + 1}–${inicio + visibles} de ${total}` : '';
+        if (c.titulo.textContent !== rango) c.titulo.textContent = rango;
+        c.desde = Infinity;
+    }
+
+    function pintar() {
+        pintadoPendiente = false;
+        sucias.forEach(pintarCategoria);
+        sucias.clear();
+        aviso.hidden = orden.length > 0;
+    }
+
+    // Cambio de página de las categorías largas
+    setInterval(() => {
+        Object.values(categorias).forEach(c => {
+            if (c.lista.length > FILAS) {
+                c.pagina++;
+                marcar(c, 0);
+            }
+        });
+    }, ROTACION_MS);
+
+    // Los inscritos llegan por socket al suscribirse (y de nuevo si se reimportan)
+    function aplicarInscritos(m) {
+        inscritosEtag = m.etag;
+        inscritos = {};
+        m.inscritos.dorsal && m.inscritos.dorsal.forEach((d, i) => {
+            inscritos[d] = {
+                dorsal: d,
+                nombre: m.inscritos.nombre[i],
+                categoria: m.inscritos.categoria[i] || 'SIN CATEGORÍA'
+            };
+        });
+        reconstruir();
+    }
+
+    fetch(`/api/tiempos/${encodeURIComponent(eventCode)}?formato=columnas`)
+        .then(r => r.ok ? r.json() : {})
+        .then(c => {
+            if (c.id) c.id.forEach((id, i) => {
+                aplicarCruce(id, c.dorsal[i], c.action[i], c.ms[i]);
+                if (id > cursor) cursor = id;
+            });
+            cargado = true;
+            reconstruir();
+            aviso.textContent = 'Esperando primeros tiempos...';
+        }).catch(err => {
+            console.error("Error al cargar datos iniciales:", err);
+        });
+
+    // Trae solo lo ocurrido desde el último cursor (reconexión o mensajes perdidos)
+    function sincronizar() {
+        fetch(`/api/tiempos/${encodeURIComponent(eventCode)}?since=${cursor}&formato=columnas`)
+            .then(r => r.ok ? r.json() : null)
+            .then(delta => {
+                if (!delta) return;
+                const cambiados = new Set();
+                delta.bajas.id.forEach((id, i) => {
+                    if (quitarCruce(id, delta.bajas.dorsal[i], delta.bajas.action[i])) cambiados.add(delta.bajas.dorsal[i]);
+                });
+                delta.altas.id.forEach((id, i) => {
+                    if (aplicarCruce(id, delta.altas.dorsal[i], delta.altas.action[i], delta.altas.ms[i])) cambiados.add(delta.altas.dorsal[i]);
+                });
+                if (delta.cursor > cursor) cursor = delta.cursor;
+                cambiados.forEach(reclasificar);
+            })
+            .catch(err => console.error("Error al sincronizar:", err));
+    }
+
+    socket.on('connect', () => {
+        socket.emit('subscribe', { event_code: eventCode, formato: 'compacto', inscritos_etag: inscritosEtag });
+        ultimoEmitido = null;
+        if (cargado) sincronizar();
+    });
+
+    socket.on('inscritos', aplicarInscritos);
+
+    // Cada cursor sigue al anterior del lote; si el primero no sigue al último recibido, hay un hueco
+    socket.on('tiempos_compactos', (c) => {
+        const hueco = ultimoEmitido !== null && c.anterior != null && c.anterior !== ultimoEmitido;
+        const cambiados = new Set();
+        c.cursor.forEach((id, i) => {
+            ultimoEmitido = id;
+            if (aplicarCruce(id, c.dorsal[i], c.action[i], c.ms[i])) cambiados.add(c.dorsal[i]);
+            if (!hueco && id > cursor) cursor = id;
+        });
+        cambiados.forEach(reclasificar);
+        if (hueco && cargado) sincronizar();
+    });
+
+    // El servidor descartó cruces pendientes (pantalla o red lenta): pedir solo lo que falta
+    socket.on('resincronizar', () => {
+        ultimoEmitido = null;
+        if (cargado) sincronizar();
+    });
+});